@@ -1,13 +1,38 @@
-
 import streamlit as st
 import pandas as pd
-import folium
-from streamlit_folium import st_folium
-from folium.plugins import MarkerCluster
-import io
+import numpy as np
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import os
+import io
+import json
+import hashlib
+import marshal
+import threading
+import time
+import traceback
+import pstats
+from collections import OrderedDict
+from functools import partial
 from datetime import datetime
 
+from motor_sabanas import (
+    nueva_traza, etapa, cerrar_traza, leer_telemetria, resumir_telemetria,
+    crear_planificador, clave_tarea, enviar_tarea, esperar_tarea, cancelar_tarea, resumen_tareas, ESTADOS_ACTIVOS,
+    iniciar_perfil, tarea_ingesta, tarea_ranking, tarea_cruce_ubicaciones, tarea_multicruce, tarea_mapa,
+    huella_contenido, leer_expediente, tocar_sidecar, expediente_disponible,
+    filtrar_rango_fechas, mascara_pernocta, resumir_pernoctas,
+    ordenar_por_frecuencia_interacciones, numeros_comunes, filtrar_por_numeros, detalle_multicruce,
+    construir_grafo, nodo_de, vecindario, ruta_mas_corta, centralidad, comunidades,
+    tabla_centralidad, resumir_comunidades, subgrafo_visible, html_red,
+    construir_indice_numeros, buscar_fragmentos, columnas_identificador,
+    guardar_caso, listar_casos, sabanas_de_caso, volcar_expediente_bd, consultar_registros_bd,
+    rango_fechas_bd, consultar_cubo_bd, numeros_comunes_bd, LIMITE_FILAS_CONSULTA,
+    NIVELES_TESELA, construir_cubo_espacial, filtrar_cubo, agregar_cubo, top_antenas,
+    puntos_mapeables, html_mapa_compacto,
+    FORMATOS_EXPORTACION, exportar_resultados, extension_exportacion,
+)
+
 # =========================
 # CONFIGURACIÓN
 # =========================
@@ -60,156 +85,240 @@ h1 {
 """, unsafe_allow_html=True)
 
 # =========================
-# FUNCIONES
+# REGISTRO COMPARTIDO DE EXPEDIENTES
 # =========================
-def formatear_valor(valor):
-    str_valor = str(valor)
-    if '.0' in str_valor and len(str_valor) > 5:
-        return str_valor.split('.')[0]
-    return str_valor
-
-def estandarizar_df(df_temp):
-    df_temp.columns = [str(c).strip().lower() for c in df_temp.columns]
-
-    mapping = {
-        'linea a': ['linea_a', 'linea a', 'origen', 'numero_llamante', 'msisdn_a', 'abonado'],
-        'linea b': ['linea_b', 'linea b', 'destino', 'numero_marcado', 'msisdn_b', 'interlocutor'],
-        'latitud': ['latitud', 'lat', 'latitude'],
-        'longitud': ['longitud', 'lon', 'longitude'],
-        'hora': ['hora', 'time'],
-        'fecha': ['fecha', 'date'],
-        'tipo': ['tipo', 'type', 'evento', 'tipo_evento', 'tipo_comunicacion']
-    }
-
-    for col_estandar, variantes in mapping.items():
-        for var in variantes:
-            if var in df_temp.columns:
-                df_temp.rename(columns={var: col_estandar}, inplace=True)
-                break
-
-    for col in df_temp.columns:
-        if 'linea' in col or 'imei' in col or 'imsi' in col:
-            df_temp[col] = df_temp[col].apply(formatear_valor).replace('nan', 'DESCONOCIDO')
-
-    if 'latitud' in df_temp.columns and 'longitud' in df_temp.columns:
-        df_temp['latitud'] = pd.to_numeric(df_temp['latitud'], errors='coerce')
-        df_temp['longitud'] = pd.to_numeric(df_temp['longitud'], errors='coerce')
-
-    if 'fecha' in df_temp.columns:
-        df_temp['fecha_dt'] = pd.to_datetime(df_temp['fecha'], errors='coerce')
-        df_temp['fecha'] = df_temp['fecha_dt'].dt.strftime('%Y-%m-%d')
-
-    return df_temp
-
-def ordenar_por_frecuencia_interacciones(df_target):
-    if 'linea a' not in df_target.columns or 'linea b' not in df_target.columns:
-        return df_target
-
-    columnas_limpias = [c for c in df_target.columns if c != 'fecha_dt']
-    df_trabajo = df_target[columnas_limpias].copy()
-
-    todo_junto = pd.concat([df_trabajo['linea a'], df_trabajo['linea b']])
-    numero_sabana = todo_junto.value_counts().idxmax()
-
-    df_trabajo['interlocutor_externo'] = df_trabajo.apply(
-        lambda r: r['linea b'] if str(r['linea a']) == str(numero_sabana) else r['linea a'], axis=1
-    )
-
-    df_agrupado = df_trabajo.groupby('interlocutor_externo').agg(
-        total_interacciones=('interlocutor_externo', 'count'),
-        ultima_fecha=('fecha', 'max'),
-        ultima_hora=('hora', 'max'),
-        ultima_latitud=('latitud', 'last'),
-        ultima_longitud=('longitud', 'last')
-    ).reset_index()
+LIMITE_MEMORIA_MB = float(os.environ.get("SABANAS_MEMORIA_MAX_MB", "4096"))
+SESION_INACTIVA_SEG = 3600
+
+@st.cache_resource
+def registro_expedientes():
+    # Un único registro por servidor: todas las sesiones comparten el mismo DataFrame de solo lectura
+    return {'lock': threading.Lock(), 'expedientes': OrderedDict(), 'sesiones': {}}
+
+def desalojar_expedientes(registro, conservar=None, limite_mb=LIMITE_MEMORIA_MB):
+    expedientes = registro['expedientes']
+    total = sum(e['bytes'] for e in expedientes.values())
+    for huella in list(expedientes):
+        if total <= limite_mb * 1024 * 1024:
+            break
+        if huella == conservar:
+            continue
+        total -= expedientes.pop(huella)['bytes']
+
+def obtener_expediente(huella, cargar=leer_expediente):
+    registro = registro_expedientes()
+    with registro['lock']:
+        entrada = registro['expedientes'].get(huella)
+        if entrada is not None:
+            registro['expedientes'].move_to_end(huella)
+            entrada['ultimo_uso'] = time.time()
+    if entrada is not None:
+        tocar_sidecar(huella)
+        return entrada['df']
+
+    # Desalojado o nunca cargado: se relee del Parquet local, que es rápido
+    df = cargar(huella)
+    if df is None:
+        return None
+    with registro['lock']:
+        registro['expedientes'][huella] = {
+            'df': df,
+            'bytes': int(df.memory_usage(deep=True).sum()),
+            'ultimo_uso': time.time(),
+        }
+        desalojar_expedientes(registro, conservar=huella)
+    return df
+
+def seleccion_de(df_sub, df_base):
+    # Representación compacta de una selección: None (todo), slice (rango contiguo) o posiciones
+    if len(df_sub) == len(df_base):
+        return None
+    indice = df_sub.index
+    if isinstance(indice, pd.RangeIndex) and indice.step == 1:
+        return slice(indice.start, indice.stop)
+    return indice.to_numpy(dtype='int32' if len(df_base) < 2**31 else 'int64')
+
+def aplicar_seleccion(df_base, seleccion):
+    if seleccion is None:
+        return df_base
+    return df_base.iloc[seleccion]
+
+def bytes_seleccion(seleccion):
+    return seleccion.nbytes if isinstance(seleccion, np.ndarray) else 0
+
+def registrar_sesion(huella_base, huella_cruce, seleccion):
+    registro = registro_expedientes()
+    contexto = get_script_run_ctx()
+    id_sesion = contexto.session_id if contexto is not None else "local"
+    ahora = time.time()
+    with registro['lock']:
+        registro['sesiones'][id_sesion] = {
+            'expediente': huella_base,
+            'cruce': huella_cruce,
+            'bytes_seleccion': bytes_seleccion(seleccion),
+            'visto': ahora,
+        }
+        for sid in [s for s, d in registro['sesiones'].items() if ahora - d['visto'] > SESION_INACTIVA_SEG]:
+            del registro['sesiones'][sid]
+
+def resumen_memoria_servidor():
+    registro = registro_expedientes()
+    with registro['lock']:
+        expedientes = {h: dict(e) for h, e in registro['expedientes'].items()}
+        sesiones = {s: dict(d) for s, d in registro['sesiones'].items()}
+
+    usuarios = {h: 0 for h in expedientes}
+    for datos in sesiones.values():
+        for h in (datos['expediente'], datos['cruce']):
+            if h in usuarios:
+                usuarios[h] += 1
+
+    df_expedientes = pd.DataFrame([{
+        'expediente': h[:12],
+        'MB': round(e['bytes'] / 1024**2, 1),
+        'sesiones': usuarios[h],
+        'ultimo_uso': datetime.fromtimestamp(e['ultimo_uso']).strftime('%H:%M:%S'),
+    } for h, e in expedientes.items()])
+
+    filas = []
+    for sid, datos in sesiones.items():
+        compartido = 0.0
+        for h in (datos['expediente'], datos['cruce']):
+            if h in expedientes:
+                compartido += expedientes[h]['bytes'] / max(usuarios[h], 1)
+        filas.append({
+            'sesion': sid[:8],
+            'expediente': (datos['expediente'] or '')[:12],
+            'MB_seleccion': round(datos['bytes_seleccion'] / 1024**2, 2),
+            'MB_compartidos_prorrateados': round(compartido / 1024**2, 1),
+            'ultima_actividad': datetime.fromtimestamp(datos['visto']).strftime('%H:%M:%S'),
+        })
+    return df_expedientes, pd.DataFrame(filas)
+
+def expediente_en_registro(huella):
+    registro = registro_expedientes()
+    with registro['lock']:
+        return huella in registro['expedientes']
+
+def huella_archivo_subido(archivo):
+    # El contenido se lee y se resume una sola vez por archivo subido, no en cada interacción con la página
+    huellas = st.session_state.setdefault("huellas_subidas", {})
+    if archivo.file_id not in huellas:
+        huellas[archivo.file_id] = huella_contenido(archivo.getvalue())
+    return huellas[archivo.file_id]
+
+def ingestar_en_segundo_plano(archivos_subidos, descripcion):
+    # La ingesta corre en el pool; devuelve la huella o None mientras siga en curso.
+    # Los bytes se piden de forma diferida: solo se copian si la tarea tiene que ejecutarse
+    archivos = [(archivo.name, archivo.getvalue) for archivo in archivos_subidos]
+    partes = ('ingesta', sorted(huella_archivo_subido(archivo) for archivo in archivos_subidos))
+    tarea = lanzar_tarea(descripcion, partes, tarea_ingesta, archivos)
+    huella = tarea['resultado'] if tarea['estado'] == 'terminada' else None
+    if huella is not None and not expediente_en_registro(huella) and not expediente_disponible(huella):
+        # La tarea recuerda la huella, pero el sidecar se podó y el registro ya lo desalojó: se ingiere de nuevo
+        tarea = lanzar_tarea(descripcion, partes, tarea_ingesta, archivos, reintentar=True)
+    return seguir_tarea(tarea)
+
+def cargar_expediente(archivos_subidos, descripcion="📥 Ingesta"):
+    huella = ingestar_en_segundo_plano(archivos_subidos, descripcion)
+    if huella is None:
+        return None, None
+    return huella, obtener_expediente(huella)
+
+def cargar_sabana(archivo_subido):
+    return cargar_expediente([archivo_subido], f"📥 Ingesta de {archivo_subido.name}")
+
+def obtener_consulta_bd(huella, filtro):
+    # Conjunto de trabajo resuelto en la base local; se comparte entre sesiones como un expediente más
+    clave = f"{huella}?{json.dumps(filtro, sort_keys=True, default=str)}"
+    return clave, obtener_expediente(clave, lambda _: consultar_registros_bd(huella, **filtro))
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def cubo_bd_expediente(huella):
+    return consultar_cubo_bd(huella)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def grafo_expedientes(huellas, _dfs):
+    # El grafo, su PageRank y sus comunidades se calculan una vez por conjunto de sábanas
+    grafo = construir_grafo(*_dfs)
+    rango = centralidad(grafo)
+    comunidad = comunidades(grafo)
+    return grafo, rango, comunidad, tabla_centralidad(grafo, rango, comunidad)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def indice_numeros_expediente(huella, _df):
+    return construir_indice_numeros(_df)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def cubo_espacial_expediente(huella, _df):
+    return construir_cubo_espacial(_df)
 
-    df_resumen = df_agrupado.sort_values(by='total_interacciones', ascending=False).copy()
-    df_resumen.rename(columns={'interlocutor_externo': 'telefono_objetivo'}, inplace=True)
-    
-    columnas_finales = ['total_interacciones', 'telefono_objetivo', 'ultima_fecha', 'ultima_hora', 'ultima_latitud', 'ultima_longitud']
-    return df_resumen[columnas_finales]
-
-def generar_html_popup_comparativo(reg_base, reg_espejo, tipo_alerta, titulo_alerta):
-    color_banner = "#28a745" 
-    if tipo_alerta == "CRUCIAL":
-        color_banner = "#dc3545" 
-    elif tipo_alerta == "ALERTA":
-        color_banner = "#ffc107" 
-
-    text_color = '#fff' if tipo_alerta != 'ALERTA' else '#000'
-
-    html = f"""
-    <div style="font-family: monospace; min-width: 410px; color: #000; font-size: 11px;">
-        <div style="background-color: {color_banner}; color: {text_color}; padding: 6px; text-align: center; font-weight: bold; border-radius: 4px; font-size: 12px; margin-bottom: 8px;">
-            {titulo_alerta}
-        </div>
-    """
-
-    if reg_espejo is not None:
-        html += f"""
-        <div style="display: flex; gap: 10px;">
-            <div style="flex: 1; background: #f8f9fa; padding: 6px; border-radius: 4px; border-left: 3px solid #00ff88;">
-                <b style="color: #111;">📄 ALFA (S1)</b><hr style="margin: 4px 0; border: 0; border-top: 1px solid #ccc;">
-                <b>F:</b> {reg_base.get('fecha', 'N/A')}<br>
-                <b>H:</b> {reg_base.get('hora', 'N/A')}<br>
-                <b>TIPO:</b> {reg_base.get('tipo', 'N/A')}<br>
-                <b>A:</b> {reg_base.get('linea a', 'N/A')}<br>
-                <b>B:</b> {reg_base.get('linea b', 'N/A')}<br>
-                <b>GEO:</b> {reg_base.get('latitud', 'N/A')}, {reg_base.get('longitud', 'N/A')}<br>
-            </div>
-            <div style="flex: 1; background: #fdf3f3; padding: 6px; border-radius: 4px; border-left: 3px solid {color_banner};">
-                <b style="color: #111;">📑 BRAVO (S2)</b><hr style="margin: 4px 0; border: 0; border-top: 1px solid #ccc;">
-                <b>F:</b> {reg_espejo.get('fecha', 'N/A')}<br>
-                <b>H:</b> {reg_espejo.get('hora', 'N/A')}<br>
-                <b>TIPO:</b> {reg_espejo.get('tipo', 'N/A')}<br>
-                <b>A:</b> {reg_espejo.get('linea a', 'N/A')}<br>
-                <b>B:</b> {reg_espejo.get('linea b', 'N/A')}<br>
-                <b>GEO:</b> {reg_espejo.get('latitud', 'N/A')}, {reg_espejo.get('longitud', 'N/A')}<br>
-            </div>
-        </div>
-        """
-    else:
-        html += f"""
-        <div style="background: #f8f9fa; padding: 8px; border-radius: 4px;">
-            <b>Fecha:</b> {reg_base.get('fecha', 'N/A')}<br>
-            <b>Hora:</b> {reg_base.get('hora', 'N/A')}<br>
-            <b>Tipo:</b> {reg_base.get('tipo', 'N/A')}<br>
-            <b>Línea A:</b> {reg_base.get('linea a', 'N/A')}<br>
-            <b>Línea B:</b> {reg_base.get('linea b', 'N/A')}<br>
-            <b>Coordenadas:</b> {reg_base.get('latitud', 'N/A')}, {reg_base.get('longitud', 'N/A')}
-        </div>
-        """
-        
-    html += "</div>"
-    return html
-
-def aplicar_marca_agua_mapa(objeto_mapa, texto_firma):
-    codigo_marca_agua = f"""
-    <div style="
-        position: fixed; 
-        bottom: 50px; 
-        left: 20px; 
-        width: auto; 
-        height: auto; 
-        z-index: 9999; 
-        font-family: 'Courier New', monospace;
-        color: rgba(0, 0, 0, 0.25); 
-        font-weight: bold; 
-        font-size: 26px; 
-        letter-spacing: 3px;
-        white-space: nowrap;
-        pointer-events: none;
-        user-select: none;
-        transform: rotate(-15deg);
-        background: rgba(255, 255, 255, 0.5);
-        padding: 5px 15px;
-        border: 2px dashed rgba(0, 0, 0, 0.15);
-        border-radius: 5px;
-    ">
-        {texto_firma}
-    </div>
-    """
-    objeto_mapa.get_root().html.add_child(folium.Element(codigo_marca_agua))
+# =========================
+# TAREAS EN SEGUNDO PLANO
+# =========================
+ESPERA_SINCRONA_SEG = 0.5
+INTERVALO_SEGUIMIENTO_SEG = 1.0
+
+class IngestaEnCurso(Exception):
+    pass
+
+@st.cache_resource
+def planificador_tareas():
+    # Un solo pool por servidor: las sesiones que piden lo mismo comparten la tarea y su resultado
+    return crear_planificador()
+
+def firma_vista(df):
+    # Identifica las filas de una vista sobre el expediente sin copiar datos
+    indice = df.index
+    if isinstance(indice, pd.RangeIndex):
+        return [indice.start, indice.stop, indice.step]
+    return hashlib.sha1(indice.to_numpy().tobytes()).hexdigest()
+
+def lanzar_tarea(descripcion, partes, funcion, *args, reintentar=False, **kwargs):
+    clave = clave_tarea(*partes)
+    reintentar = st.session_state.pop(f"reanudar_{clave}", False) or reintentar
+    tarea = enviar_tarea(
+        planificador_tareas(), clave, funcion, *args, descripcion=descripcion, reintentar=reintentar,
+        perfilar=perfilador is not None, sesion=traza['sesion'], **kwargs
+    )
+    tareas_ejecucion.append(tarea)
+    return tarea
+
+def seguir_tarea(tarea, mostrar_parcial=None):
+    # Devuelve el resultado si la tarea terminó; si no, muestra su avance (se refresca solo) y devuelve None
+    esperar_tarea(tarea, ESPERA_SINCRONA_SEG)
+    descripcion = tarea['descripcion']
+    if tarea['estado'] == 'terminada':
+        return tarea['resultado']
+    if tarea['estado'] in ('cancelada', 'error'):
+        if tarea['estado'] == 'cancelada':
+            st.warning(f"⏹️ {descripcion}: cancelada.")
+        else:
+            st.error(f"{descripcion}: {tarea['error']}")
+            with st.expander("🧾 Detalle técnico de la tarea"):
+                st.code(tarea['detalle'], language="text")
+        if st.button("▶️ VOLVER A EJECUTAR", key=f"btn_reanudar_{tarea['clave']}"):
+            st.session_state[f"reanudar_{tarea['clave']}"] = True
+            st.rerun()
+        return None
+
+    @st.fragment(run_every=INTERVALO_SEGUIMIENTO_SEG)
+    def seguimiento():
+        if tarea['estado'] not in ESTADOS_ACTIVOS:
+            # Terminó: la página completa se vuelve a ejecutar y recoge el resultado
+            st.rerun()
+        transcurrido = time.time() - (tarea['inicio'] or tarea['creada'])
+        # La cancelación se atiende en el siguiente punto de control del trabajador
+        texto = "cancelando… (se detiene al terminar el paso en curso)" if tarea['cancelar'].is_set() else tarea['texto'] or tarea['estado']
+        st.progress(tarea['progreso'], text=f"⏳ {descripcion}: {texto} · {transcurrido:.0f} s")
+        if tarea['parcial'] is not None and mostrar_parcial is not None:
+            mostrar_parcial(tarea['parcial'])
+        if not tarea['cancelar'].is_set() and st.button("⏹️ CANCELAR", key=f"cancelar_{tarea['clave']}"):
+            cancelar_tarea(tarea)
+            st.rerun()
+
+    seguimiento()
+    return None
 
 # =========================
 # CONTROL DE ESTADO
@@ -217,6 +326,32 @@ def aplicar_marca_agua_mapa(objeto_mapa, texto_firma):
 if "opcion_activa" not in st.session_state:
     st.session_state.opcion_activa = "Vista General"
 
+# =========================
+# TELEMETRÍA DE LA EJECUCIÓN
+# =========================
+contexto_ejecucion = get_script_run_ctx()
+traza = nueva_traza(contexto_ejecucion.session_id if contexto_ejecucion is not None else "local")
+error_ejecucion = None
+# Tareas pedidas en esta ejecución: su telemetría y su perfil se toman en el hilo del pool
+tareas_ejecucion = []
+perfilador = None
+if st.session_state.pop("perfilar_siguiente", False):
+    # Perfil de una sola ejecución, a petición desde el panel de diagnóstico
+    perfilador = iniciar_perfil()
+
+def cerrar_perfil():
+    # Apaga el perfilador y guarda el perfil una sola vez por ejecución: lo llaman el finally del bloque
+    # principal (st.rerun() no pasa por los except) y el final de la página
+    perfilador.disable()
+    perfil = st.session_state.get("perfil_ultimo")
+    if perfil is None or perfil['ejecucion'] != traza['ejecucion']:
+        st.session_state.perfil_ultimo = {
+            'ejecucion': traza['ejecucion'],
+            'perfiles': [perfilador],
+            'pendientes': [t for t in tareas_ejecucion if t['perfilar']],
+            'texto': None,
+        }
+
 # =========================
 # CABECERA SUPERIOR CON LOGO
 # =========================
@@ -239,7 +374,7 @@ with col_titulo:
 # PANEL DE CONTROL
 # =========================
 st.markdown("### ⚙️ PANEL DE CONTROL")
-c1, c2, c3, c4, c5 = st.columns(5)
+c1, c2, c3, c4, c5, c6 = st.columns(6)
 
 with c1:
     if st.button("📡 GENERAL"): st.session_state.opcion_activa = "Vista General"
@@ -251,28 +386,122 @@ with c4:
     if st.button("📡 ANTENAS"): st.session_state.opcion_activa = "Top Antenas"
 with c5:
     if st.button("🧩 CRUCE"): st.session_state.opcion_activa = "Cruce de Sábanas"
+with c6:
+    if st.button("🕸️ RED"): st.session_state.opcion_activa = "Red de Vínculos"
 
 st.info(f"MODO ACTIVO: {st.session_state.opcion_activa}")
 st.write("---")
 
-uploaded_file = st.file_uploader("📂 CARGAR EXPEDIENTE TELEFÓNICO PRINCIPAL", type=["xlsx", "xls"])
+uploaded_file = st.file_uploader(
+    "📂 CARGAR EXPEDIENTE TELEFÓNICO PRINCIPAL (uno o varios archivos)",
+    type=["xlsx", "xls", "csv"],
+    accept_multiple_files=True
+)
+
+# =========================
+# BASE DE CASOS
+# =========================
+with st.expander("🗄️ BASE DE CASOS"):
+    casos = listar_casos()
+    c_abrir, c_guardar = st.columns(2)
+    with c_abrir:
+        caso_abierto = st.selectbox(
+            "📂 Abrir caso guardado (sin volver a subir archivos)", ["—"] + casos['caso'].tolist(), key="caso_abierto"
+        )
+        if not casos.empty:
+            st.dataframe(casos, use_container_width=True, hide_index=True)
+    with c_guardar:
+        nombre_caso = st.text_input("Nombre del caso", key="nombre_caso").strip()
+        if st.button("💾 GUARDAR EN CASO", disabled=not (nombre_caso and st.session_state.get("huella_expediente"))):
+            sabanas_guardar = [(st.session_state.huella_expediente, 'PRINCIPAL')]
+            if st.session_state.get("huella_cruce"):
+                sabanas_guardar.append((st.session_state.huella_cruce, 'CRUCE'))
+            try:
+                with st.spinner("Guardando en la base local..."):
+                    guardar_caso(nombre_caso, sabanas_guardar)
+                st.success(f"Caso '{nombre_caso}' guardado con {len(sabanas_guardar)} sábana(s).")
+            except FileNotFoundError as e:
+                st.error(str(e))
+    st.checkbox(
+        "Consultar directamente en la base (expedientes mayores que la RAM)",
+        key="consulta_bd",
+        help="Los filtros de fecha, Pernocta, número, antenas y cruce de números se resuelven en la base; solo las filas resultantes se cargan en memoria."
+    )
+caso_abierto = None if caso_abierto == "—" else caso_abierto
+consulta_bd = st.session_state.get("consulta_bd", False)
 
-if uploaded_file:
+if uploaded_file or caso_abierto:
     try:
-        df_base = estandarizar_df(pd.read_excel(uploaded_file))
-        
-        if "df_ejecutado" not in st.session_state:
-            st.session_state.df_ejecutado = df_base.copy()
-            st.session_state.ejecutar_cruce_inteligente = False
-            st.session_state.df_cruce_ref = None
+        barra_ingesta = st.empty()
+        def avance_ingesta(fraccion, texto):
+            barra_ingesta.progress(min(max(fraccion, 0.0), 1.0), text=texto)
+
+        sabanas_caso = {}
+        if uploaded_file:
+            with etapa(traza, "ingesta de archivos"):
+                huella_expediente = ingestar_en_segundo_plano(uploaded_file, "📥 Ingesta del expediente")
+            if huella_expediente is None:
+                # El avance se sigue mostrando; al terminar la ingesta la página se vuelve a ejecutar
+                raise IngestaEnCurso()
+        else:
+            sabanas_caso = {etiqueta: huella for huella, etiqueta in sabanas_de_caso(caso_abierto)}
+            huella_expediente = sabanas_caso['PRINCIPAL']
+        if consulta_bd:
+            with etapa(traza, "volcado a base de casos"):
+                volcar_expediente_bd(huella_expediente, progreso=avance_ingesta)
+        barra_ingesta.empty()
+
+        if st.session_state.get("origen_expediente") != (huella_expediente, consulta_bd):
+            st.session_state.origen_expediente = (huella_expediente, consulta_bd)
+            st.session_state.huella_expediente = huella_expediente
+            st.session_state.seleccion = None
+            st.session_state.filtro_cubo = {}
+            st.session_state.filtro_bd = {}
+            # Un caso reabierto recupera su sábana de cruce
+            st.session_state.huella_cruce = sabanas_caso.get('CRUCE')
+            st.session_state.ejecutar_cruce_inteligente = st.session_state.huella_cruce is not None
+
+        with etapa(traza, "consulta en base" if consulta_bd else "carga de expediente") as e:
+            if consulta_bd:
+                huella_base, df_base = obtener_consulta_bd(huella_expediente, st.session_state.filtro_bd)
+            else:
+                huella_base, df_base = huella_expediente, obtener_expediente(huella_expediente)
+            e['salida'] = df_base
+        traza['contexto']['registros'] = len(df_base)
+
+        if consulta_bd:
+            st.caption(f"🗄️ Consulta en la base local: {len(df_base):,} de {df_base.attrs.get('registros_bd', len(df_base)):,} registros cargados en memoria.")
+            if len(df_base) >= LIMITE_FILAS_CONSULTA:
+                st.warning(f"⚠️ Resultado truncado a {LIMITE_FILAS_CONSULTA:,} filas (SABANAS_FILAS_CONSULTA). Acote el rango de fechas.")
+
+        # La selección vigente es una vista (slice o posiciones) sobre el expediente compartido
+        df_ejecutado = aplicar_seleccion(df_base, st.session_state.seleccion)
+
+        memoria = df_base.attrs.get('memoria_mb')
+        if memoria:
+            st.caption(f"💾 Expediente normalizado: {memoria['despues']} MB en memoria (ahorro de {memoria['ahorrado']} MB sobre {memoria['antes']} MB).")
 
         # Contenedor visual del Buscador Temporal
-        if 'fecha_dt' in df_base.columns and not df_base['fecha_dt'].isna().all():
+        if consulta_bd:
+            min_fecha, max_fecha = rango_fechas_bd(huella_expediente)
+        elif 'fecha_dt' in df_base.columns and not df_base['fecha_dt'].isna().all():
+            min_fecha, max_fecha = df_base['fecha_dt'].min().date(), df_base['fecha_dt'].max().date()
+        else:
+            min_fecha = max_fecha = None
+
+        if min_fecha is not None:
             st.markdown("### 📅 BUSCADOR POR RANGO TEMPORAL")
             
-            min_fecha = df_base['fecha_dt'].min().date()
-            max_fecha = df_base['fecha_dt'].max().date()
-            
+            if st.session_state.opcion_activa == "Pernocta (Personalizada)":
+                c_ini, c_fin = st.columns(2)
+                with c_ini:
+                    hora_inicio = st.slider("🌙 Inicio de la noche (hora)", 0, 23, 22, key="pernocta_inicio")
+                with c_fin:
+                    hora_fin = st.slider("🌅 Fin de la noche (hora, inclusiva)", 0, 23, 7, key="pernocta_fin")
+                st.session_state.ventana_pernocta = (hora_inicio, hora_fin)
+            elif "ventana_pernocta" not in st.session_state:
+                st.session_state.ventana_pernocta = (22, 7)
+
             c_cal, c_btn1, c_btn2 = st.columns([2, 1, 1])
             
             with c_cal:
@@ -294,86 +523,264 @@ if uploaded_file:
 
             # ACCIÓN DEL BOTÓN FILTRAR
             if btn_buscar:
-                df_trabajo = df_base.copy()
+                filtro_cubo = {}
                 if isinstance(rango_seleccionado, tuple) and len(rango_seleccionado) == 2:
-                    f_inicio, f_fin = rango_seleccionado
-                    df_trabajo = df_trabajo[
-                        (df_trabajo['fecha_dt'].dt.date >= f_inicio) & 
-                        (df_trabajo['fecha_dt'].dt.date <= f_fin)
-                    ]
-                
+                    filtro_cubo.update(f_inicio=rango_seleccionado[0], f_fin=rango_seleccionado[1])
                 if st.session_state.opcion_activa == "Pernocta (Personalizada)":
-                    df_trabajo['hora_num'] = pd.to_datetime(df_trabajo['hora'].astype(str), errors='coerce').dt.hour
-                    df_trabajo = df_trabajo[(df_trabajo['hora_num'] >= 22) | (df_trabajo['hora_num'] <= 7)]
-
-                st.session_state.df_ejecutado = df_trabajo
+                    filtro_cubo['ventana'] = st.session_state.ventana_pernocta
+
+                if consulta_bd:
+                    # El filtro se resuelve en la base: solo vuelven las filas del periodo
+                    st.session_state.filtro_bd = filtro_cubo
+                    st.session_state.seleccion = None
+                    st.session_state.filtro_cubo = filtro_cubo
+                    st.rerun()
+
+                with etapa(traza, "filtro de fechas / pernocta", df_base) as e:
+                    df_trabajo = df_base
+                    if 'f_inicio' in filtro_cubo:
+                        df_trabajo = filtrar_rango_fechas(df_trabajo, filtro_cubo['f_inicio'], filtro_cubo['f_fin'])
+                    if 'ventana' in filtro_cubo:
+                        df_trabajo = df_trabajo[mascara_pernocta(df_trabajo, *filtro_cubo['ventana'])]
+                    e['salida'] = df_trabajo
+
+                st.session_state.seleccion = seleccion_de(df_trabajo, df_base)
+                df_ejecutado = df_trabajo
+                # Filtro puramente temporal: Top Antenas puede responder desde el cubo precalculado
+                st.session_state.filtro_cubo = filtro_cubo
 
             # ACCIÓN DEL BOTÓN LIMPIAR (RESTAURAR)
             if btn_limpiar:
-                st.session_state.df_ejecutado = df_base.copy()
+                st.session_state.seleccion = None
+                st.session_state.filtro_cubo = {}
+                st.session_state.filtro_bd = {}
                 st.session_state.ejecutar_cruce_inteligente = False
-                st.session_state.df_cruce_ref = None
+                st.session_state.huella_cruce = None
                 st.rerun()
 
+        # huella_render identifica el conjunto del que sale df_render en las claves de las tareas
+        df_render, huella_render = df_ejecutado, huella_base
+
         if st.session_state.opcion_activa == "Búsqueda por Número":
-            num = st.text_input("🔎 NÚMERO OBJETIVO (Escriba y presione Enter)")
-            if num:
-                st.session_state.df_ejecutado = st.session_state.df_ejecutado[
-                    st.session_state.df_ejecutado['linea a'].astype(str).str.contains(num) |
-                    st.session_state.df_ejecutado['linea b'].astype(str).str.contains(num)
-                ]
+            if consulta_bd:
+                columnas_numero = columnas_identificador(df_base)
+            else:
+                with etapa(traza, "indice de numeros", df_base):
+                    indice_numeros = indice_numeros_expediente(huella_base, df_base)
+                columnas_numero = indice_numeros['columnas']
+            c_num, c_cols = st.columns([2, 1])
+            with c_num:
+                num = st.text_input("🔎 NÚMERO(S) OBJETIVO (fragmentos separados por coma o espacio, Enter para buscar)")
+            with c_cols:
+                columnas_busqueda = st.multiselect(
+                    "Columnas",
+                    columnas_numero,
+                    default=[c for c in ['linea a', 'linea b'] if c in columnas_numero]
+                )
+            fragmentos = [f for f in num.replace(',', ' ').split() if f]
+            if fragmentos and consulta_bd:
+                # Búsqueda resuelta en la base dentro del periodo filtrado
+                with etapa(traza, "busqueda de numero (base)") as e:
+                    huella_render, df_render = obtener_consulta_bd(
+                        huella_expediente,
+                        {**st.session_state.filtro_bd, 'fragmentos': fragmentos, 'columnas_busqueda': columnas_busqueda}
+                    )
+                    e['salida'] = df_render
+                st.caption(f"🔢 {len(df_render):,} registro(s) en la base contienen: {', '.join(fragmentos)}")
+            elif fragmentos:
+                with etapa(traza, "busqueda de numero", df_render) as e:
+                    posiciones, encontrados = buscar_fragmentos(indice_numeros, fragmentos, columnas_busqueda)
+                    # La búsqueda se aplica sobre la selección vigente sin modificarla
+                    en_busqueda = np.zeros(len(df_base), dtype=bool)
+                    en_busqueda[posiciones] = True
+                    df_render = df_render[en_busqueda[df_render.index.to_numpy()]]
+                    e['salida'] = df_render
+                st.caption(f"🔢 {len(encontrados)} número(s) coinciden: {', '.join(encontrados[:20])}{' …' if len(encontrados) > 20 else ''}")
 
         elif st.session_state.opcion_activa == "Cruce de Sábanas":
             st.markdown("### 🧩 INTEL CROSS ANALYSIS")
-            tipo = st.selectbox("Modo", ["Números", "Ubicación Inteligente"])
-            file2 = st.file_uploader("📂 SEGUNDA SÁBANA", type=["xlsx", "xls"])
+            tipo = st.selectbox("Modo", ["Números", "Ubicación Inteligente", "Matriz Multisábana"])
+            if tipo == "Matriz Multisábana":
+                archivos_multi = st.file_uploader(
+                    "📂 SÁBANAS A CRUZAR (una por archivo)", type=["xlsx", "xls", "csv"], accept_multiple_files=True
+                )
+                incluir_base = st.checkbox("Incluir la sábana cargada arriba", value=True)
+                sabanas_multi = [("BASE", huella_base)] if incluir_base else []
+                for archivo in archivos_multi or []:
+                    # Solo la huella: la tarea lee cada sábana por separado, sin pasar por el registro compartido
+                    sabanas_multi.append((os.path.splitext(archivo.name)[0], ingestar_en_segundo_plano([archivo], f"📥 Ingesta de {archivo.name}")))
+                multicruce = None
+
+                if len(sabanas_multi) < 2:
+                    st.info("Cargue al menos dos sábanas para construir la matriz.")
+                elif None not in [h for _, h in sabanas_multi]:
+                    # Mientras alguna sábana siga en ingesta solo se muestra su avance
+                    with etapa(traza, "matriz multisabana"):
+                        # La matriz se reutiliza mientras no cambie el conjunto de sábanas
+                        multicruce = seguir_tarea(lanzar_tarea(
+                            "🧮 Matrices de coincidencia", ('multicruce', sabanas_multi), tarea_multicruce,
+                            {nombre: df_base if h == huella_base else h for nombre, h in sabanas_multi}
+                        ))
+                if multicruce is not None:
+                    t_int, t_col, t_pares = st.tabs(["👥 Interlocutores comunes", "📍 Mismo sitio / mismo día", "🔗 Pares"])
+                    with t_int:
+                        st.dataframe(multicruce['matriz_interlocutores'], use_container_width=True)
+                    with t_col:
+                        st.dataframe(multicruce['matriz_colocaciones'], use_container_width=True)
+                    with t_pares:
+                        st.dataframe(multicruce['pares'], use_container_width=True, hide_index=True)
+
+                    # Detalle de una celda de la matriz
+                    pares = multicruce['pares']
+                    etiquetas = [f"{a} ⟷ {b} ({n} núm. / {c} sitios)" for a, b, n, c in pares.itertuples(index=False)]
+                    if etiquetas:
+                        elegido = st.selectbox("🔎 Detalle del par", range(len(etiquetas)), format_func=lambda k: etiquetas[k])
+                        sabana_1, sabana_2 = pares.iloc[elegido][['sabana_1', 'sabana_2']]
+                        numeros_par, sitios_par = detalle_multicruce(multicruce, sabana_1, sabana_2)
+                        c_num, c_sit = st.columns(2)
+                        with c_num:
+                            st.markdown(f"**Números en común ({len(numeros_par)})**")
+                            st.dataframe(numeros_par, use_container_width=True, hide_index=True)
+                        with c_sit:
+                            st.markdown(f"**Sitios-día compartidos ({len(sitios_par)})**")
+                            st.dataframe(sitios_par, use_container_width=True, hide_index=True)
+            if tipo == "Ubicación Inteligente":
+                st.session_state.tolerancia_cruce = st.number_input(
+                    "Tolerancia de distancia (metros, 0 = coordenada exacta)",
+                    min_value=0, max_value=5000, value=int(st.session_state.get("tolerancia_cruce", 0)), step=50
+                )
+            file2 = st.file_uploader("📂 SEGUNDA SÁBANA", type=["xlsx", "xls", "csv"]) if tipo != "Matriz Multisábana" else None
 
+            huella2 = None
             if file2:
-                df2 = estandarizar_df(pd.read_excel(file2))
+                with etapa(traza, "ingesta de segunda sabana") as e:
+                    huella2, df2 = cargar_sabana(file2)
+                    e['salida'] = df2
+            if huella2 is not None:
                 if tipo == "Números":
-                    n1 = set(st.session_state.df_ejecutado['linea a']) | set(st.session_state.df_ejecutado['linea b'])
-                    n2 = set(df2['linea a']) | set(df2['linea b'])
-                    comunes = n1.intersection(n2)
-                    st.session_state.df_ejecutado = st.session_state.df_ejecutado[
-                        st.session_state.df_ejecutado['linea a'].isin(comunes) | 
-                        st.session_state.df_ejecutado['linea b'].isin(comunes)
-                    ]
+                    with etapa(traza, "cruce de numeros", df_ejecutado) as e:
+                        if consulta_bd:
+                            comunes = numeros_comunes_bd(huella_expediente, huella2)
+                        else:
+                            comunes = numeros_comunes(df_ejecutado, df2)
+                        df_ejecutado = filtrar_por_numeros(df_ejecutado, comunes)
+                        e['salida'] = df_ejecutado
+                    st.session_state.seleccion = seleccion_de(df_ejecutado, df_base)
+                    st.session_state.filtro_cubo = None
                 elif tipo == "Ubicación Inteligente":
                     st.session_state.ejecutar_cruce_inteligente = True
-                    st.session_state.df_cruce_ref = df2
+                    st.session_state.huella_cruce = huella2
+
+        elif st.session_state.opcion_activa == "Red de Vínculos":
+            st.markdown("### 🕸️ RED DE VÍNCULOS")
+            huellas_red = tuple(h for h in (huella_base, st.session_state.huella_cruce) if h)
+            with st.spinner("Construyendo grafo de comunicaciones..."), etapa(traza, "grafo de comunicaciones"):
+                grafo, rango_red, comunidad_red, df_centralidad = grafo_expedientes(
+                    huellas_red, [df_base if h == huella_base else obtener_expediente(h) for h in huellas_red]
+                )
+            st.caption(f"🕸️ {len(grafo['nodos'])} números y {grafo['aristas']} vínculos en {len(huellas_red)} sábana(s).")
+
+            c_foco, c_saltos, c_nodos = st.columns([2, 1, 1])
+            with c_foco:
+                foco = st.text_input("Número foco (vacío = red completa)", key="foco_red").strip()
+            with c_saltos:
+                saltos = st.slider("Saltos", 1, 4, 2, key="saltos_red")
+            with c_nodos:
+                max_nodos = st.slider("Nodos visibles", 50, 1000, 200, step=50, key="nodos_red")
+            if foco and nodo_de(grafo, foco) is None:
+                st.warning(f"El número {foco} no aparece en la red.")
+                foco = ""
+
+            t_red, t_cen, t_ruta, t_com = st.tabs(["🕸️ Red", "🏆 Centralidad", "🧭 Ruta", "👥 Comunidades"])
+            with t_red:
+                nodos_red, aristas_red = subgrafo_visible(
+                    grafo, rango_red, comunidad_red, centro=foco or None, saltos=saltos,
+                    max_nodos=max_nodos, max_aristas=4 * max_nodos
+                )
+                components.html(html_red(nodos_red, aristas_red), height=620)
+                if foco:
+                    df_vecindario = vecindario(grafo, foco, saltos)
+                    st.markdown(f"**Vecindario a {saltos} salto(s): {len(df_vecindario) - 1} números**")
+                    st.dataframe(df_vecindario, use_container_width=True, hide_index=True)
+            with t_cen:
+                st.dataframe(df_centralidad.head(1000), use_container_width=True, hide_index=True)
+            with t_ruta:
+                c_org, c_dst = st.columns(2)
+                with c_org:
+                    origen_ruta = st.text_input("Desde (vacío = número foco)", key="ruta_origen").strip() or foco
+                with c_dst:
+                    destino_ruta = st.text_input("Hasta", key="ruta_destino").strip()
+                if origen_ruta and destino_ruta:
+                    df_ruta = ruta_mas_corta(grafo, origen_ruta, destino_ruta)
+                    if df_ruta is None:
+                        st.warning("No hay ruta entre esos números en las sábanas cargadas.")
+                    else:
+                        st.success(f"Ruta de {len(df_ruta) - 1} salto(s).")
+                        st.dataframe(df_ruta, use_container_width=True, hide_index=True)
+            with t_com:
+                st.dataframe(resumir_comunidades(grafo, rango_red, comunidad_red), use_container_width=True, hide_index=True)
 
         # =========================
         # DESPLIEGUE DE RESULTADOS
         # =========================
-        df_render = st.session_state.df_ejecutado
+        if st.session_state.opcion_activa != "Búsqueda por Número":
+            df_render, huella_render = df_ejecutado, huella_base
+
+        registrar_sesion(huella_base, st.session_state.huella_cruce, st.session_state.seleccion)
 
         if not df_render.empty:
             st.subheader("📊 RESULTADOS DETECTADOS EN EL RANGO")
             st.caption("🔒 PROPIEDAD INTELECTUAL CLASIFICADA | PROPÓSITO FORENSE EXCLUSIVO - AUTOR: J-I-A-M")
             
-            df_tabla_final = df_render.copy()
-            if 'fecha_dt' in df_tabla_final.columns:
-                df_tabla_final.drop(columns=['fecha_dt'], inplace=True)
-
             if st.session_state.opcion_activa != "Top Antenas":
-                df_resultados_vista = ordenar_por_frecuencia_interacciones(df_tabla_final)
+                with etapa(traza, "ranking de contactos", df_render) as e:
+                    # Misma vista, mismo ranking: cambiar de modo no lo recalcula
+                    df_resultados_vista = e['salida'] = seguir_tarea(
+                        lanzar_tarea("🏆 Ranking de contactos", ('ranking', huella_render, firma_vista(df_render)), tarea_ranking, df_render),
+                        mostrar_parcial=lambda parcial: (
+                            st.caption("Vista preliminar (muestra del 10%): principales contactos"),
+                            st.dataframe(parcial, use_container_width=True)
+                        )
+                    )
             else:
-                df_antenas_clean = df_tabla_final.dropna(subset=['latitud', 'longitud'])
-                df_antenas_clean = df_antenas_clean[(df_antenas_clean['latitud'] != 0) & (df_antenas_clean['longitud'] != 0)]
-                df_resultados_vista = df_antenas_clean.groupby(['latitud', 'longitud']).size().reset_index(name='hits').sort_values('hits', ascending=False).head(15)
-
-            st.dataframe(df_resultados_vista, use_container_width=True)
+                nivel_antenas = NIVELES_TESELA[st.radio(
+                    "Resolución de agregación", list(NIVELES_TESELA), horizontal=True, key="nivel_antenas"
+                )]
+                filtro_cubo = st.session_state.get("filtro_cubo", {})
+                with etapa(traza, "ranking de antenas", df_render) as e:
+                    if filtro_cubo is not None:
+                        cubo_base = cubo_bd_expediente(huella_expediente) if consulta_bd else cubo_espacial_expediente(huella_base, df_base)
+                        cubo = filtrar_cubo(cubo_base, **filtro_cubo)
+                    else:
+                        # La selección no es solo temporal (p. ej. cruce por números): cubo sobre esas filas
+                        cubo = construir_cubo_espacial(df_render)
+                    agregado_antenas = agregar_cubo(cubo, nivel_antenas)
+                    df_resultados_vista = e['salida'] = top_antenas(agregado_antenas, nivel_antenas)
+
+            if df_resultados_vista is not None:
+                st.dataframe(df_resultados_vista, use_container_width=True)
+
+            if st.session_state.opcion_activa == "Top Antenas" and not cubo.empty:
+                st.caption("🕒 Actividad por hora del día en la selección")
+                st.bar_chart(cubo[cubo['hora'] >= 0].groupby('hora')['hits'].sum())
+
+            if st.session_state.opcion_activa == "Pernocta (Personalizada)" and 'momento' in df_render.columns:
+                st.subheader("🌙 PERNOCTA POR NOCHE")
+                st.caption("Sitio con más eventos dentro de la ventana nocturna; la madrugada cuenta para la noche anterior.")
+                with etapa(traza, "resumen de pernoctas", df_render) as e:
+                    df_pernoctas = e['salida'] = resumir_pernoctas(df_render, *st.session_state.ventana_pernocta)
+                st.dataframe(df_pernoctas, use_container_width=True)
 
             st.subheader("🗺️ MAPA TÁCTICO DEL PERIODO FILTRADO")
 
-            df_m = df_render.dropna(subset=['latitud', 'longitud']).copy()
-            if not df_m.empty:
-                df_m = df_m[(df_m['latitud'] != 0) & (df_m['longitud'] != 0)]
+            df_m = puntos_mapeables(df_render)
+            cruce = None
 
             if not df_m.empty:
                 st.success(f"🌐 Rango Acotado Sincronizado: Mapeando {len(df_m)} coordenadas correspondientes al filtro ejecutado.")
 
-                if st.session_state.ejecutar_cruce_inteligente and st.session_state.df_cruce_ref is not None:
+                cruce_activo = st.session_state.ejecutar_cruce_inteligente and st.session_state.huella_cruce is not None
+                if cruce_activo:
                     st.markdown("""
                     <div style="background-color: #0b1119; padding: 12px; border: 1px solid #00ff88; border-radius: 4px; margin-bottom: 15px;">
                         <span style="color:#00ff88; font-weight:bold; font-size:14px;">📋 LEYENDA ANALÍTICA DE CRUCE (SÁBANA 1 vs SÁBANA 2):</span><br>
@@ -383,79 +790,200 @@ if uploaded_file:
                     </div>
                     """, unsafe_allow_html=True)
 
-                m = folium.Map(
-                    location=[df_m['latitud'].mean(), df_m['longitud'].mean()],
-                    zoom_start=11,
-                    tiles="OpenStreetMap"
+                    with etapa(traza, "cruce de ubicaciones", df_m) as e:
+                        df_ref = obtener_expediente(st.session_state.huella_cruce)
+                        tolerancia = st.session_state.get("tolerancia_cruce", 0)
+                        cruce = seguir_tarea(lanzar_tarea(
+                            "🧩 Cruce de ubicaciones",
+                            ('cruce_ubicaciones', huella_render, firma_vista(df_m), st.session_state.huella_cruce, tolerancia),
+                            tarea_cruce_ubicaciones, df_m, df_ref, tolerancia
+                        ))
+                        e['salida'] = cruce[1] if cruce is not None else None
+                    if cruce is not None:
+                        etiquetas_cruce, pares_cruce = cruce
+                        conteo_alertas = etiquetas_cruce['tipo_alerta'].value_counts()
+                        st.caption(f"🔴 CRUCIAL: {conteo_alertas.get('CRUCIAL', 0)} | 🟠 ALERTA: {conteo_alertas.get('ALERTA', 0)} | 🟢 BASE: {conteo_alertas.get('BASE', 0)}")
+                    if cruce is not None and not pares_cruce.empty:
+                        st.download_button(
+                            label="📥 DESCARGAR PARES DE CRUCE (CSV)",
+                            data=partial(exportar_resultados, {'pares_cruce': pares_cruce}, 'csv'),
+                            file_name="PARES_CRUCE_UBICACION.csv",
+                            mime="text/csv",
+                            on_click="ignore"
+                        )
+
+                modo_mapa = st.radio(
+                    "Modo de mapa",
+                    ["Capa de datos (rápida)", "Popups HTML (clásico)"],
+                    horizontal=True,
+                    key="modo_mapa",
+                    help="La capa de datos envía los puntos una sola vez y arma cada popup al hacer clic."
                 )
 
-                cluster = MarkerCluster(disableClusteringAtZoom=17, maxClusterRadius=50).add_to(m)
-
-                for _, r in df_m.iterrows():
-                    color_punto = "#00ff88"  
-                    tipo_alerta = "BASE"
-                    titulo_alerta = "REGISTRO TELEFÓNICO"
-                    reg_espejo_dict = None
-
-                    if st.session_state.ejecutar_cruce_inteligente and st.session_state.df_cruce_ref is not None:
-                        coincidencias_geo = st.session_state.df_cruce_ref[
-                            (st.session_state.df_cruce_ref['latitud'] == r['latitud']) & 
-                            (st.session_state.df_cruce_ref['longitud'] == r['longitud'])
-                        ]
-                        if not coincidencias_geo.empty:
-                            mismo_dia = coincidencias_geo[coincidencias_geo['fecha'] == r['fecha']]
-                            if not mismo_dia.empty:
-                                color_punto = "red"
-                                tipo_alerta = "CRUCIAL"
-                                titulo_alerta = "💥 CRUCE: MISMO LUGAR/DÍA"
-                                reg_espejo_dict = mismo_dia.iloc[0].to_dict()
-                            else:
-                                color_punto = "orange"
-                                tipo_alerta = "ALERTA"
-                                titulo_alerta = "⏳ CRUCE: MISMO LUGAR/DIF. DÍA"
-                                reg_espejo_dict = coincidencias_geo.iloc[0].to_dict()
-
-                    popup_html = generar_html_popup_comparativo(r.to_dict(), reg_espejo_dict, tipo_alerta, titulo_alerta)
-                    
-                    iframe = folium.IFrame(popup_html, width=420, height=175)
-                    popup_obj = folium.Popup(iframe, parse_html=True)
-
-                    folium.CircleMarker(
-                        location=[r['latitud'], r['longitud']],
-                        radius=5,
-                        color=color_punto,
-                        fill=True,
-                        fill_opacity=0.7,
-                        popup=popup_obj
-                    ).add_to(cluster)
-
-                aplicar_marca_agua_mapa(m, "PROP. J-I-A-M / FORENSIC SYSTEM")
-
-                st_folium(
-                    m, 
-                    width="100%", 
-                    height=650, 
-                    key=f"mapa_completo_{st.session_state.opcion_activa}_{len(df_m)}",
-                    returned_objects=[] 
-                )
+                html_mapa = None
+                con_antenas = st.session_state.opcion_activa == "Top Antenas"
+                if not cruce_activo or cruce is not None:
+                    ligero = modo_mapa == "Capa de datos (rápida)"
+                    with etapa(traza, "construccion del mapa", df_m):
+                        # El HTML queda en la tarea: volver a este modo no reconstruye ni re-serializa el mapa
+                        html_mapa = seguir_tarea(lanzar_tarea(
+                            "🗺️ Mapa táctico",
+                            ('mapa', huella_render, firma_vista(df_m), ligero,
+                             (st.session_state.huella_cruce, tolerancia) if cruce_activo else None,
+                             nivel_antenas if con_antenas else None),
+                            tarea_mapa, df_m,
+                            etiquetas_cruce if cruce_activo else None,
+                            df_ref if cruce_activo else None,
+                            ligero=ligero,
+                            agregado_antenas=agregado_antenas if con_antenas else None
+                        ), mostrar_parcial=lambda parcial: components.html(parcial, height=650))
+
+                if html_mapa is not None:
+                    with etapa(traza, "visualizacion del mapa", df_m):
+                        components.html(html_mapa, height=650)
 
                 col_down, col_firma = st.columns([1, 1])
                 with col_down:
-                    st.download_button(
-                        label="📥 DESCARGAR MAPA HTML EN PERIODO SELECCIONADO",
-                        data=m._repr_html_(),
-                        file_name=f"MAPA_FILTRADO_{st.session_state.opcion_activa.upper()}.html",
-                        mime="text/html"
-                    )
+                    if html_mapa is not None:
+                        # Se genera solo al pulsar: plantilla fija + datos de los puntos, sin el andamiaje de folium
+                        st.download_button(
+                            label="📥 DESCARGAR MAPA HTML EN PERIODO SELECCIONADO",
+                            data=partial(
+                                html_mapa_compacto, df_m,
+                                etiquetas_cruce if cruce_activo else None,
+                                df_ref if cruce_activo else None,
+                                agregado_antenas if con_antenas else None,
+                                f"MAPA {st.session_state.opcion_activa.upper()}"
+                            ),
+                            file_name=f"MAPA_FILTRADO_{st.session_state.opcion_activa.upper()}.html",
+                            mime="text/html",
+                            on_click="ignore"
+                        )
                 with col_firma:
                     st.markdown("<p class='credito-firma' style='text-align: right;'>CREADO POR: J-I-A-M</p>", unsafe_allow_html=True)
             else:
                 st.warning("⚠️ No quedan coordenadas válidas en este periodo tras la limpieza.")
+
+            # =========================
+            # EXPORTACIÓN
+            # =========================
+            with st.expander("📦 EXPORTAR RESULTADOS"):
+                # Las tablas que no están a la vista se calculan solo al exportar
+                tablas_exportables = {'registros': df_render}
+                if st.session_state.opcion_activa != "Top Antenas" and df_resultados_vista is not None:
+                    tablas_exportables['ranking_contactos'] = df_resultados_vista
+                else:
+                    tablas_exportables['ranking_contactos'] = partial(ordenar_por_frecuencia_interacciones, df_render)
+                if st.session_state.opcion_activa == "Top Antenas":
+                    tablas_exportables['top_antenas'] = df_resultados_vista
+                elif not df_m.empty:
+                    nivel_exportacion = NIVELES_TESELA[st.session_state.get("nivel_antenas", next(iter(NIVELES_TESELA)))]
+                    tablas_exportables['top_antenas'] = lambda df=df_render, nivel=nivel_exportacion: top_antenas(
+                        agregar_cubo(construir_cubo_espacial(df), nivel), nivel
+                    )
+                if cruce is not None and not pares_cruce.empty:
+                    tablas_exportables['pares_cruce'] = pares_cruce
+
+                c_formato, c_tablas = st.columns([1, 2])
+                with c_formato:
+                    formato_exportacion, mime_exportacion = FORMATOS_EXPORTACION[st.radio(
+                        "Formato", list(FORMATOS_EXPORTACION), key="formato_exportacion"
+                    )]
+                with c_tablas:
+                    tablas_elegidas = st.multiselect(
+                        "Tablas", list(tablas_exportables), default=list(tablas_exportables),
+                        help="Excel: una hoja por tabla. Parquet/CSV: un archivo por tabla dentro de un ZIP."
+                    )
+                extension = extension_exportacion(formato_exportacion, len(tablas_elegidas))
+                st.download_button(
+                    label="📥 DESCARGAR RESULTADOS",
+                    data=partial(exportar_resultados, {t: tablas_exportables[t] for t in tablas_elegidas}, formato_exportacion),
+                    file_name=f"RESULTADOS_{st.session_state.opcion_activa.upper()}.{extension}",
+                    mime="application/zip" if extension == 'zip' else mime_exportacion,
+                    disabled=not tablas_elegidas,
+                    on_click="ignore"
+                )
         else:
             st.warning("Sin registros disponibles. Seleccione un rango válido y presione '⚡ FILTRAR EXPEDIENTE'.")
 
+    except IngestaEnCurso:
+        # Sin expediente aún no hay análisis, pero la telemetría y el perfil de la ejecución se cierran abajo
+        pass
     except Exception as e:
-        st.error(f"ERROR DE SISTEMA: {e}")
+        # Se informa la etapa que falló y el código de ejecución con el que quedó registrada en la telemetría
+        error_ejecucion = f"{type(e).__name__}: {e}"
+        st.error(f"ERROR DE SISTEMA en la etapa «{traza['etapa_fallida'] or 'preparación'}»: {error_ejecucion}")
+        with st.expander("🧾 Detalle técnico del error"):
+            st.caption(f"Ejecución {traza['ejecucion']} · adjunte este código y el detalle al reportar el fallo.")
+            st.code(traceback.format_exc(), language="text")
+    finally:
+        if perfilador is not None:
+            cerrar_perfil()
+
+# =========================
+# DIAGNÓSTICO DE RENDIMIENTO
+# =========================
+traza['contexto']['modo'] = st.session_state.opcion_activa
+total_ejecucion = cerrar_traza(traza, error_ejecucion)
+if perfilador is not None:
+    cerrar_perfil()
+perfil = st.session_state.get("perfil_ultimo")
+if perfil:
+    # Las tareas perfiladas suelen terminar en ejecuciones posteriores: su perfil se suma al llegar
+    pendientes = []
+    for tarea in perfil['pendientes']:
+        if tarea['fin'] is None:
+            pendientes.append(tarea)
+        elif tarea['perfil'] is not None:
+            perfil['perfiles'].append(tarea['perfil'])
+            perfil['texto'] = None
+    perfil['pendientes'] = pendientes
+    if perfil['texto'] is None:
+        texto_perfil = io.StringIO()
+        estadisticas = pstats.Stats(*perfil['perfiles'], stream=texto_perfil)
+        estadisticas.sort_stats('cumulative').print_stats(40)
+        perfil['texto'] = texto_perfil.getvalue()
+        perfil['prof'] = marshal.dumps(estadisticas.stats)
+
+with st.expander("🩺 DIAGNÓSTICO DE RENDIMIENTO"):
+    st.caption(f"Ejecución {traza['ejecucion']}: {total_ejecucion:.2f} s en total.")
+    if traza['etapas']:
+        st.dataframe(pd.DataFrame(traza['etapas']), use_container_width=True, hide_index=True)
+    tareas_usadas = list({t['clave']: t for t in tareas_ejecucion}.values())
+    if tareas_usadas:
+        st.caption("Tareas en segundo plano de esta ejecución, medidas en el hilo que las ejecuta (las etapas de arriba solo cuentan la espera).")
+        st.dataframe(pd.DataFrame([{
+            'tarea': t['descripcion'],
+            'estado': t['estado'],
+            **(t['traza']['etapas'][0] if t['traza'] and t['traza']['etapas'] else {}),
+        } for t in tareas_usadas]), use_container_width=True, hide_index=True)
+
+    if st.button("🧪 PERFILAR LA SIGUIENTE EJECUCIÓN (cProfile)"):
+        st.session_state.perfilar_siguiente = True
+        st.rerun()
+    if perfil:
+        en_curso = f"; {len(perfil['pendientes'])} tarea(s) perfilada(s) aún en curso" if perfil['pendientes'] else ""
+        st.caption(f"Perfil de la ejecución {perfil['ejecucion']} y de sus tareas en segundo plano (top 40 por tiempo acumulado{en_curso}).")
+        st.code(perfil['texto'], language="text")
+        st.download_button(
+            label="📥 DESCARGAR PERFIL (.prof)",
+            data=perfil['prof'],
+            file_name=f"perfil_{perfil['ejecucion']}.prof",
+            mime="application/octet-stream"
+        )
+
+    if st.toggle("Ver etapas más lentas de todos los usuarios (log local)", key="ver_telemetria"):
+        st.dataframe(resumir_telemetria(leer_telemetria()), use_container_width=True, hide_index=True)
+
+if st.query_params.get("admin") == "1":
+    with st.expander("🛠️ PANEL DE ADMINISTRACIÓN · MEMORIA DEL SERVIDOR"):
+        df_expedientes_admin, df_sesiones_admin = resumen_memoria_servidor()
+        total_mb = df_expedientes_admin['MB'].sum() if not df_expedientes_admin.empty else 0
+        st.caption(f"Expedientes en memoria: {total_mb:.1f} MB de {LIMITE_MEMORIA_MB:.0f} MB (SABANAS_MEMORIA_MAX_MB). Se desaloja el menos usado recientemente.")
+        st.dataframe(df_expedientes_admin, use_container_width=True)
+        st.dataframe(df_sesiones_admin, use_container_width=True)
+        st.caption("Tareas en segundo plano (en curso y resultados reutilizables).")
+        st.dataframe(resumen_tareas(planificador_tareas()), use_container_width=True, hide_index=True)
 
 st.markdown("---")
 st.caption("INTEL FORENSIC SYSTEM • UI MODE: COMMAND CENTER")
@@ -0,0 +1,330 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import sys
+import time
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+from datetime import datetime
+import xlsxwriter
+
+import motor_sabanas as motor
+
+# =========================
+# GENERADOR DE SÁBANAS SINTÉTICAS
+# =========================
+# Variantes de encabezado que estandarizar_df reconoce, para ejercitar el mapeo de columnas
+VARIANTES_COLUMNAS = {
+    'linea a': ['msisdn_a', 'linea_a', 'origen', 'numero_llamante', 'abonado'],
+    'linea b': ['numero_marcado', 'linea_b', 'destino', 'msisdn_b', 'interlocutor'],
+    'latitud': ['lat', 'latitud', 'latitude'],
+    'longitud': ['lon', 'longitud', 'longitude'],
+    'fecha': ['date', 'fecha'],
+    'hora': ['time', 'hora'],
+    'tipo': ['tipo', 'type', 'evento', 'tipo_evento', 'tipo_comunicacion'],
+}
+TIPOS_EVENTO = ['LLAMADA ENTRANTE', 'LLAMADA SALIENTE', 'SMS ENTRANTE', 'SMS SALIENTE', 'DATOS', 'MMS']
+PESOS_TIPO = [0.25, 0.25, 0.15, 0.15, 0.17, 0.03]
+# Actividad relativa por hora del día (madrugada baja, tarde alta)
+PERFIL_HORARIO = np.array([2, 1, 1, 1, 1, 2, 4, 6, 8, 9, 9, 9, 10, 10, 9, 9, 9, 10, 10, 9, 8, 6, 4, 3], dtype='float64')
+CENTRO_CIUDAD = (19.4326, -99.1332)
+
+def numeros_aleatorios(rng, cantidad, prefijo=55):
+    return (prefijo * 10**8 + rng.choice(10**8, size=cantidad, replace=False)).astype(str)
+
+def sitios_aleatorios(rng, cantidad, dispersion_grados=0.15):
+    # Antenas repartidas alrededor del centro, con coordenadas a 6 decimales como en los reportes
+    lat = CENTRO_CIUDAD[0] + rng.normal(0, dispersion_grados, cantidad)
+    lon = CENTRO_CIUDAD[1] + rng.normal(0, dispersion_grados, cantidad)
+    return np.round(np.column_stack([lat, lon]), 6)
+
+def crear_perfil(semilla=0, contactos=2000, sitios=400, dias=90, inicio='2024-01-01',
+                 contactos_compartidos=None, sitios_compartidos=None, solape=0.0, variantes=None):
+    # Parámetros fijos de una sábana; los bloques se generan a partir de él con el mismo resultado
+    rng = np.random.default_rng(semilla)
+    numeros = numeros_aleatorios(rng, contactos)
+    antenas = sitios_aleatorios(rng, sitios)
+    if contactos_compartidos is not None and solape > 0:
+        k = int(round(contactos * solape))
+        numeros[:k] = contactos_compartidos[:k]
+    if sitios_compartidos is not None and solape > 0:
+        k = int(round(sitios * solape))
+        antenas[:k] = sitios_compartidos[:k]
+
+    # Frecuencias tipo Zipf: pocos interlocutores concentran la mayoría de los contactos
+    pesos_contacto = 1.0 / np.arange(1, contactos + 1) ** 1.1
+    pesos_sitio = 1.0 / np.arange(1, sitios + 1) ** 0.9
+    orden_contactos, orden_sitios = rng.permutation(contactos), rng.permutation(sitios)
+    if variantes is None:
+        variantes = {c: v[int(rng.integers(len(v)))] for c, v in VARIANTES_COLUMNAS.items()}
+    return {
+        'semilla': semilla,
+        'objetivo': numeros_aleatorios(rng, 1, prefijo=56)[0],
+        'contactos': numeros,
+        'pesos_contacto': pesos_contacto[orden_contactos] / pesos_contacto.sum(),
+        'sitios': antenas,
+        'pesos_sitio': pesos_sitio[orden_sitios] / pesos_sitio.sum(),
+        'casa': int(np.argmax(pesos_sitio[orden_sitios])),
+        'inicio': pd.Timestamp(inicio),
+        'dias': dias,
+        'imei': rng.integers(35 * 10**13, 36 * 10**13, size=3).astype('float64'),
+        'imsi': (334020 * 10**9 + rng.integers(0, 10**9, size=2)).astype('float64'),
+        'variantes': variantes,
+    }
+
+def bloque_sintetico(perfil, filas, rng):
+    objetivo = perfil['objetivo']
+    interlocutor = rng.choice(perfil['contactos'], size=filas, p=perfil['pesos_contacto'])
+    saliente = rng.random(filas) < 0.5
+
+    dia = rng.integers(0, perfil['dias'], size=filas)
+    hora = rng.choice(24, size=filas, p=PERFIL_HORARIO / PERFIL_HORARIO.sum())
+    segundo = rng.integers(0, 3600, size=filas)
+    momentos = perfil['inicio'] + pd.to_timedelta(dia * 86400 + hora * 3600 + segundo, unit='s')
+
+    # De noche el objetivo suele estar en casa: sirve para probar Pernocta
+    sitio = rng.choice(len(perfil['sitios']), size=filas, p=perfil['pesos_sitio'])
+    nocturno = ((hora >= 22) | (hora <= 6)) & (rng.random(filas) < 0.8)
+    sitio[nocturno] = perfil['casa']
+    lat, lon = perfil['sitios'][sitio, 0].copy(), perfil['sitios'][sitio, 1].copy()
+    sin_ubicacion = rng.random(filas)
+    lat[sin_ubicacion < 0.01] = np.nan
+    lon[sin_ubicacion < 0.01] = np.nan
+    lat[(sin_ubicacion >= 0.01) & (sin_ubicacion < 0.015)] = 0
+
+    imei = rng.choice(perfil['imei'], size=filas, p=[0.85, 0.14, 0.01])
+    imei[rng.random(filas) < 0.02] = np.nan
+    variantes = perfil['variantes']
+    return pd.DataFrame({
+        variantes['linea a']: np.where(saliente, objetivo, interlocutor),
+        variantes['linea b']: np.where(saliente, interlocutor, objetivo),
+        variantes['fecha']: momentos.strftime('%Y-%m-%d'),
+        variantes['hora']: momentos.strftime('%H:%M:%S'),
+        variantes['tipo']: rng.choice(TIPOS_EVENTO, size=filas, p=PESOS_TIPO),
+        variantes['latitud']: lat,
+        variantes['longitud']: lon,
+        'imei': imei,
+        'imsi': rng.choice(perfil['imsi'], size=filas),
+    })
+
+def iterar_sabana(perfil, filas, filas_por_bloque=1_000_000):
+    rng = np.random.default_rng(perfil['semilla'] + 1)
+    for inicio in range(0, filas, filas_por_bloque):
+        yield bloque_sintetico(perfil, min(filas_por_bloque, filas - inicio), rng)
+
+def generar_sabana(filas, **parametros):
+    perfil = crear_perfil(**parametros)
+    return pd.concat(iterar_sabana(perfil, filas), ignore_index=True)
+
+def perfiles_par(solape=0.2, semilla=0, contactos=2000, sitios=400, **parametros):
+    # Dos sábanas que comparten una fracción 'solape' de interlocutores y de antenas en el mismo periodo
+    rng = np.random.default_rng(semilla + 10_000)
+    contactos_compartidos = numeros_aleatorios(rng, contactos)
+    sitios_compartidos = sitios_aleatorios(rng, sitios)
+    return [
+        crear_perfil(semilla=semilla + i, contactos=contactos, sitios=sitios, solape=solape,
+                     contactos_compartidos=contactos_compartidos, sitios_compartidos=sitios_compartidos, **parametros)
+        for i in (0, 1)
+    ]
+
+def escribir_sabana(perfil, filas, ruta):
+    # CSV por bloques (sirve para 10M filas); Excel limitado a 1.048.575 registros por hoja
+    if ruta.lower().endswith('.csv'):
+        for i, bloque in enumerate(iterar_sabana(perfil, filas)):
+            bloque.to_csv(ruta, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        return ruta
+    if filas > 1_048_575:
+        raise ValueError("Un libro .xlsx admite como máximo 1.048.575 registros; use formato CSV.")
+    # constant_memory exige escribir fila por fila, en orden: no sirve to_excel (escribe por columnas)
+    libro = xlsxwriter.Workbook(ruta, {'constant_memory': True})
+    hoja = libro.add_worksheet()
+    fila = 0
+    for bloque in iterar_sabana(perfil, filas):
+        if fila == 0:
+            hoja.write_row(0, 0, list(bloque.columns))
+            fila = 1
+        for registro in bloque.astype(object).where(bloque.notna(), None).itertuples(index=False, name=None):
+            hoja.write_row(fila, 0, registro)
+            fila += 1
+    libro.close()
+    return ruta
+
+# =========================
+# MEDICIÓN POR ETAPAS
+# =========================
+def medir_etapa(resultados, etapa, funcion, filas_entrada=None, memoria=True, avisar=print):
+    if memoria:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    valor = funcion()
+    segundos = time.perf_counter() - t0
+    pico = None
+    if memoria:
+        pico = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+    registro = {
+        'etapa': etapa,
+        'segundos': round(segundos, 4),
+        'pico_mb': round(pico, 2) if pico is not None else None,
+        'memoria_proceso_mb': round(motor.memoria_proceso_mb() or 0, 1),
+        'filas_entrada': filas_entrada,
+        'filas_salida': motor.filas_de(valor),
+    }
+    resultados.append(registro)
+    pico_texto = f"{pico:9.1f} MB" if pico is not None else f"{'—':>9}   "
+    avisar(f"{etapa:<40} {segundos:9.3f} s  {pico_texto}  → {registro['filas_salida']}")
+    return valor
+
+def version_codigo():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def ejecutar_benchmark(filas=100_000, solape=0.2, semilla=0, formato='csv', memoria=True, mapa_clasico_max=2000, excel_max=50_000, avisar=print):
+    etapas = []
+    perfil_1, perfil_2 = perfiles_par(solape=solape, semilla=semilla)
+
+    with tempfile.TemporaryDirectory(prefix="bench_sabanas_") as tmp:
+        motor.configurar_cache(os.path.join(tmp, 'cache'))
+        motor.RUTA_BD_CASOS = os.path.join(tmp, 'casos.sqlite')
+        ruta_1 = escribir_sabana(perfil_1, filas, os.path.join(tmp, f"sabana_1.{formato}"))
+        ruta_2 = escribir_sabana(perfil_2, max(filas // 10, 1000), os.path.join(tmp, f"sabana_2.{formato}"))
+        archivo_1, archivo_2 = motor.leer_archivo(ruta_1), motor.leer_archivo(ruta_2)
+
+        m = lambda etapa, funcion, entrada=None: medir_etapa(etapas, etapa, funcion, entrada, memoria, avisar)
+
+        # Normalización en memoria, aislada de la lectura del archivo
+        crudo = pd.concat(iterar_sabana(perfil_1, filas), ignore_index=True)
+        m("normalizacion (estandarizar_df)", lambda: motor.estandarizar_df(crudo), filas)
+        crudo = None
+
+        huella_1 = m("ingesta (archivo -> parquet)", lambda: motor.ingestar_archivos([archivo_1]), filas)
+        huella_2 = motor.ingestar_archivos([archivo_2])
+        df = m("lectura de expediente", lambda: motor.leer_expediente(huella_1), filas)
+        df_2 = motor.leer_expediente(huella_2)
+
+        dias = sorted(df['fecha'].cat.categories)
+        f_inicio, f_fin = pd.Timestamp(dias[len(dias) // 4]).date(), pd.Timestamp(dias[3 * len(dias) // 4]).date()
+        df_rango = m("filtro por fechas", lambda: motor.filtrar_rango_fechas(df, f_inicio, f_fin), len(df))
+        df_noche = m("filtro pernocta", lambda: df_rango[motor.mascara_pernocta(df_rango)], len(df_rango))
+        m("resumen de pernoctas", lambda: motor.resumir_pernoctas(df_noche), len(df_noche))
+
+        m("ranking de contactos", lambda: motor.ordenar_por_frecuencia_interacciones(df), len(df))
+        cubo = m("cubo espacial", lambda: motor.construir_cubo_espacial(df), len(df))
+        m("ranking de antenas", lambda: motor.top_antenas(motor.agregar_cubo(cubo, 17), 17), len(cubo))
+
+        indice = m("indice de numeros", lambda: motor.construir_indice_numeros(df), len(df))
+        fragmento = str(perfil_1['contactos'][0])[-5:]
+        m("busqueda de numero", lambda: motor.buscar_fragmentos(indice, [fragmento]), len(df))
+
+        m("cruce de numeros", lambda: motor.filtrar_por_numeros(df, motor.numeros_comunes(df, df_2)), len(df))
+        df_m = motor.puntos_mapeables(df)
+        m("cruce de ubicaciones", lambda: motor.cruzar_ubicaciones(df_m, df_2), len(df_m))
+        m("matriz multisabana", lambda: motor.analizar_multicruce({'1': df, '2': df_2})['pares'], len(df) + len(df_2))
+        m("grafo de comunicaciones", lambda: motor.construir_grafo(df, df_2)['nodos'], len(df) + len(df_2))
+
+        m("volcado a base de casos", lambda: motor.volcar_expediente_bd(huella_1), len(df))
+        m("consulta en base (pernocta)", lambda: motor.consultar_registros_bd(
+            huella_1, f_inicio=f_inicio, f_fin=f_fin, ventana=(22, 7)
+        ), len(df))
+
+        m("mapa HTML (capa ligera)", lambda: motor.construir_mapa(df_m, ligero=True).get_root().render(), len(df_m))
+        # El modo clásico crea un IFrame por punto: se mide sobre una muestra fija para que sea comparable
+        muestra = df_m.head(mapa_clasico_max)
+        m(f"mapa HTML (popups clasicos, {len(muestra)} pts)", lambda: motor.construir_mapa(muestra, ligero=False).get_root().render(), len(muestra))
+        m("mapa HTML compacto (descarga)", lambda: motor.html_mapa_compacto(df_m), len(df_m))
+
+        m("exportacion parquet", lambda: motor.exportar_resultados({'registros': df}, 'parquet').close(), len(df))
+        m("exportacion csv", lambda: motor.exportar_resultados({'registros': df}, 'csv').close(), len(df))
+        # Excel escribe celda a celda: también se mide sobre una muestra fija
+        muestra_excel = df.head(excel_max)
+        m(f"exportacion excel ({len(muestra_excel)} filas)", lambda: motor.exportar_resultados({'registros': muestra_excel}, 'xlsx').close(), len(muestra_excel))
+
+    return {
+        'version': version_codigo(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'entorno': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'plataforma': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'parametros': {'filas': filas, 'solape': solape, 'semilla': semilla, 'formato': formato, 'memoria': memoria},
+        'etapas': etapas,
+    }
+
+def comparar(actual, anterior, tolerancia=0.2):
+    # Etapas más lentas que la ejecución anterior por encima de la tolerancia relativa
+    previas = {e['etapa']: e for e in anterior['etapas']}
+    filas = []
+    for etapa in actual['etapas']:
+        previa = previas.get(etapa['etapa'])
+        if previa is None or not previa['segundos']:
+            continue
+        razon = etapa['segundos'] / previa['segundos']
+        filas.append({
+            'etapa': etapa['etapa'],
+            'antes_s': previa['segundos'],
+            'ahora_s': etapa['segundos'],
+            'razon': round(razon, 2),
+            'regresion': razon > 1 + tolerancia,
+        })
+    return pd.DataFrame(filas)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sábanas sintéticas y benchmark por etapas del motor de análisis.")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p_gen = sub.add_parser("generar", help="Escribe un par de sábanas sintéticas con solape configurable")
+    p_gen.add_argument("salida", help="Directorio de salida")
+    p_gen.add_argument("--filas", type=int, default=100_000)
+    p_gen.add_argument("--filas-segunda", type=int, default=None, help="Filas de la segunda sábana (por defecto, las mismas)")
+    p_gen.add_argument("--solape", type=float, default=0.2, help="Fracción de interlocutores y antenas compartidos (0-1)")
+    p_gen.add_argument("--formato", choices=["csv", "xlsx"], default="xlsx")
+    p_gen.add_argument("--semilla", type=int, default=0)
+
+    p_med = sub.add_parser("medir", help="Mide tiempo y memoria de cada etapa y guarda el resultado en JSON")
+    p_med.add_argument("--filas", type=int, default=100_000)
+    p_med.add_argument("--solape", type=float, default=0.2)
+    p_med.add_argument("--formato", choices=["csv", "xlsx"], default="csv")
+    p_med.add_argument("--semilla", type=int, default=0)
+    p_med.add_argument("--sin-memoria", action="store_true", help="No usar tracemalloc: tracemalloc encarece las etapas con muchos objetos Python")
+    p_med.add_argument("--salida", default=None, help="Archivo JSON (por defecto bench_sabanas_<filas>.json)")
+    p_med.add_argument("--comparar", default=None, help="JSON de una ejecución anterior para detectar regresiones")
+    p_med.add_argument("--tolerancia", type=float, default=0.2, help="Razón de tiempo por encima de la cual se marca regresión")
+    args = parser.parse_args(argv)
+
+    if args.comando == "generar":
+        os.makedirs(args.salida, exist_ok=True)
+        perfiles = perfiles_par(solape=args.solape, semilla=args.semilla)
+        for i, (perfil, filas) in enumerate(zip(perfiles, (args.filas, args.filas_segunda or args.filas)), start=1):
+            ruta = escribir_sabana(perfil, filas, os.path.join(args.salida, f"sabana_{i}_{perfil['objetivo']}.{args.formato}"))
+            print(f"✔ {ruta} ({filas:,} registros)")
+        return 0
+
+    resultado = ejecutar_benchmark(
+        filas=args.filas, solape=args.solape, semilla=args.semilla, formato=args.formato, memoria=not args.sin_memoria
+    )
+    salida = args.salida or f"bench_sabanas_{args.filas}.json"
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"→ {salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            tabla = comparar(resultado, json.load(f), args.tolerancia)
+        print(tabla.to_string(index=False))
+        return 1 if tabla['regresion'].any() else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
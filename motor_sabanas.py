@@ -0,0 +1,2516 @@
+import pandas as pd
+import numpy as np
+import folium
+from pandas.api.types import union_categoricals
+from folium.plugins import MarkerCluster, FastMarkerCluster, HeatMap
+from folium.template import Template
+import io
+import csv
+import html
+import shutil
+import tempfile
+import zipfile
+import sys
+import json
+import os
+import hashlib
+import sqlite3
+import time
+import threading
+import traceback
+import bisect
+import cProfile
+import logging
+from logging.handlers import RotatingFileHandler
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from itertools import combinations, count
+import openpyxl
+import xlsxwriter
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# =========================
+# CACHÉ DE INGESTA
+# =========================
+DIR_CACHE_SABANAS = os.environ.get(
+    "SABANAS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache_sabanas")
+)
+LIMITE_CACHE_MB = float(os.environ.get("SABANAS_CACHE_MAX_MB", "2048"))
+
+# =========================
+# TELEMETRÍA POR ETAPAS
+# =========================
+RUTA_TELEMETRIA = os.environ.get(
+    "SABANAS_TELEMETRIA",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".telemetria_sabanas", "etapas.jsonl")
+)
+TELEMETRIA_MAX_MB = float(os.environ.get("SABANAS_TELEMETRIA_MAX_MB", "5"))
+TELEMETRIA_ARCHIVOS = 5
+
+def memoria_proceso_mb():
+    # RSS actual (Linux: /proc/self/statm); en otros sistemas, el máximo alcanzado
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, IndexError, AttributeError):
+        if resource is None:
+            return None
+        maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maximo / 1024**2 if sys.platform == 'darwin' else maximo / 1024
+
+def registro_telemetria():
+    # Un logger con rotación por tamaño: cada línea es un JSON con una etapa
+    logger = logging.getLogger("sabanas.telemetria")
+    if not logger.handlers:
+        os.makedirs(os.path.dirname(RUTA_TELEMETRIA) or ".", exist_ok=True)
+        manejador = RotatingFileHandler(
+            RUTA_TELEMETRIA, maxBytes=int(TELEMETRIA_MAX_MB * 1024**2), backupCount=TELEMETRIA_ARCHIVOS, encoding='utf-8'
+        )
+        manejador.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(manejador)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+def nueva_traza(sesion=None, **contexto):
+    return {
+        'ejecucion': hashlib.sha1(f"{sesion}{time.time_ns()}".encode()).hexdigest()[:12],
+        'sesion': sesion,
+        'inicio': time.perf_counter(),
+        'contexto': contexto,
+        'etapas': [],
+        'etapa_fallida': None,
+    }
+
+def filas_de(valor):
+    if isinstance(valor, tuple):
+        valor = valor[0]
+    if isinstance(valor, (pd.DataFrame, pd.Series, np.ndarray, list, set)):
+        return len(valor)
+    return None
+
+@contextmanager
+def etapa(traza, nombre, entrada=None):
+    # Uso: with etapa(traza, "ranking", df) as e: ...; e['salida'] = resultado
+    registro = {'filas_entrada': filas_de(entrada) if entrada is not None else None, 'salida': None}
+    memoria_antes = memoria_proceso_mb()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield registro
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if traza is not None and traza['etapa_fallida'] is None:
+            traza['etapa_fallida'] = nombre
+        raise
+    finally:
+        if traza is not None:
+            traza['etapas'].append({
+                'etapa': nombre,
+                'segundos': round(time.perf_counter() - t0, 4),
+                'filas_entrada': registro['filas_entrada'],
+                'filas_salida': filas_de(registro['salida']) if registro['salida'] is not None else None,
+                'memoria_delta_mb': round(memoria_proceso_mb() - memoria_antes, 1) if memoria_antes is not None else None,
+                'error': error,
+            })
+
+def cerrar_traza(traza, error=None):
+    # Vuelca cada etapa de la ejecución al JSONL rotativo
+    total = round(time.perf_counter() - traza['inicio'], 4)
+    marca = datetime.now().isoformat(timespec='seconds')
+    try:
+        logger = registro_telemetria()
+        for registro in traza['etapas']:
+            logger.info(json.dumps({
+                'fecha': marca, 'ejecucion': traza['ejecucion'], 'sesion': traza['sesion'],
+                **traza['contexto'], **registro, 'total_ejecucion_s': total,
+            }, ensure_ascii=False, default=str))
+        if error is not None and traza['etapa_fallida'] is None:
+            # Fallo fuera de cualquier etapa medida
+            logger.info(json.dumps({
+                'fecha': marca, 'ejecucion': traza['ejecucion'], 'sesion': traza['sesion'], **traza['contexto'],
+                'etapa': 'sin etapa', 'error': error, 'total_ejecucion_s': total,
+            }, ensure_ascii=False, default=str))
+    except OSError:
+        # La telemetría nunca debe tumbar el análisis
+        pass
+    return total
+
+def leer_telemetria(max_lineas=20000):
+    # Últimas líneas del log actual y de sus rotaciones, de la más reciente a la más antigua
+    lineas = []
+    for i in range(TELEMETRIA_ARCHIVOS + 1):
+        ruta = RUTA_TELEMETRIA if i == 0 else f"{RUTA_TELEMETRIA}.{i}"
+        if len(lineas) >= max_lineas or not os.path.exists(ruta):
+            break
+        with open(ruta, encoding='utf-8') as f:
+            lineas = f.readlines()[-(max_lineas - len(lineas)):] + lineas
+    registros = []
+    for linea in lineas:
+        try:
+            registros.append(json.loads(linea))
+        except ValueError:
+            continue
+    return pd.DataFrame(registros)
+
+def resumir_telemetria(df_log):
+    # Percentiles por etapa para localizar los cuellos de botella entre todos los usuarios
+    if df_log.empty or 'segundos' not in df_log.columns:
+        return pd.DataFrame(columns=['etapa', 'ejecuciones', 'p50_s', 'p95_s', 'max_s', 'max_filas', 'errores'])
+    agrupado = df_log.groupby('etapa')
+    resumen = pd.DataFrame({
+        'ejecuciones': agrupado.size(),
+        'p50_s': agrupado['segundos'].median(),
+        'p95_s': agrupado['segundos'].quantile(0.95),
+        'max_s': agrupado['segundos'].max(),
+        'max_filas': agrupado['filas_entrada'].max() if 'filas_entrada' in df_log.columns else None,
+        'errores': agrupado['error'].count() if 'error' in df_log.columns else 0,
+    }).round(3).reset_index()
+    return resumen.sort_values('p95_s', ascending=False).reset_index(drop=True)
+
+# =========================
+# FUNCIONES
+# =========================
+def formatear_valor(valor):
+    str_valor = str(valor)
+    if '.0' in str_valor and len(str_valor) > 5:
+        return str_valor.split('.')[0]
+    return str_valor
+
+def normalizar_identificador(serie):
+    # Mismo resultado que formatear_valor, pero evaluado una vez por valor distinto
+    codigos, unicos = pd.factorize(serie, use_na_sentinel=False)
+    formateados = pd.Series([formatear_valor(v) for v in unicos], dtype=object)
+    formateados = formateados.replace('nan', 'DESCONOCIDO')
+    codigos_finales, categorias = pd.factorize(formateados)
+    return pd.Series(
+        pd.Categorical.from_codes(codigos_finales[codigos], categories=categorias),
+        index=serie.index,
+        name=serie.name
+    )
+
+def estandarizar_df(df_temp):
+    df_temp.columns = [str(c).strip().lower() for c in df_temp.columns]
+
+    mapping = {
+        'linea a': ['linea_a', 'linea a', 'origen', 'numero_llamante', 'msisdn_a', 'abonado'],
+        'linea b': ['linea_b', 'linea b', 'destino', 'numero_marcado', 'msisdn_b', 'interlocutor'],
+        'latitud': ['latitud', 'lat', 'latitude'],
+        'longitud': ['longitud', 'lon', 'longitude'],
+        'hora': ['hora', 'time'],
+        'fecha': ['fecha', 'date'],
+        'tipo': ['tipo', 'type', 'evento', 'tipo_evento', 'tipo_comunicacion']
+    }
+
+    for col_estandar, variantes in mapping.items():
+        for var in variantes:
+            if var in df_temp.columns:
+                df_temp.rename(columns={var: col_estandar}, inplace=True)
+                break
+
+    memoria_inicial = df_temp.memory_usage(deep=True).sum()
+
+    for col in df_temp.columns:
+        if 'linea' in col or 'imei' in col or 'imsi' in col:
+            df_temp[col] = normalizar_identificador(df_temp[col])
+
+    if 'latitud' in df_temp.columns and 'longitud' in df_temp.columns:
+        df_temp['latitud'] = pd.to_numeric(df_temp['latitud'], errors='coerce').astype('float32')
+        df_temp['longitud'] = pd.to_numeric(df_temp['longitud'], errors='coerce').astype('float32')
+
+    if 'tipo' in df_temp.columns:
+        df_temp['tipo'] = df_temp['tipo'].astype('category')
+
+    if 'fecha' in df_temp.columns:
+        df_temp['fecha_dt'] = pd.to_datetime(df_temp['fecha'], errors='coerce')
+        # strftime solo sobre los días distintos, no por registro; ordenada para que max/min sigan siendo cronológicos
+        codigos, dias = pd.factorize(df_temp['fecha_dt'].dt.normalize(), sort=True)
+        etiquetas = pd.Categorical.from_codes(codigos, categories=dias.strftime('%Y-%m-%d'), ordered=True)
+        df_temp['fecha'] = pd.Series(etiquetas, index=df_temp.index)
+        # Marca de tiempo del evento (fecha + hora) calculada una sola vez en la ingesta
+        horas = parsear_horas(df_temp['hora']) if 'hora' in df_temp.columns else None
+        df_temp['momento'] = calcular_momento_evento(df_temp, horas)
+        # Sin hora interpretable el momento es solo la fecha: no cuenta en las ventanas horarias
+        df_temp['hora_valida'] = horas.notna().to_numpy() if horas is not None else False
+
+    memoria_final = df_temp.memory_usage(deep=True).sum()
+    df_temp.attrs['memoria_mb'] = {
+        'antes': round(float(memoria_inicial) / 1024**2, 2),
+        'despues': round(float(memoria_final) / 1024**2, 2),
+        'ahorrado': round(float(memoria_inicial - memoria_final) / 1024**2, 2),
+    }
+
+    return df_temp
+
+def huella_contenido(contenido):
+    return hashlib.sha256(contenido).hexdigest()
+
+def ruta_sidecar(huella):
+    return os.path.join(DIR_CACHE_SABANAS, f"{huella}.parquet")
+
+def podar_cache_disco(limite_mb=LIMITE_CACHE_MB):
+    # LRU por fecha de último acceso (mtime se actualiza en cada lectura)
+    if not os.path.isdir(DIR_CACHE_SABANAS):
+        return
+    archivos = []
+    for nombre in os.listdir(DIR_CACHE_SABANAS):
+        if nombre.endswith(".parquet"):
+            ruta = os.path.join(DIR_CACHE_SABANAS, nombre)
+            stat = os.stat(ruta)
+            archivos.append((stat.st_mtime, stat.st_size, ruta))
+
+    total = sum(a[1] for a in archivos)
+    limite = limite_mb * 1024 * 1024
+    for _, tamano, ruta in sorted(archivos):
+        if total <= limite:
+            break
+        try:
+            os.remove(ruta)
+            total -= tamano
+        except OSError:
+            pass
+
+def tocar_sidecar(huella):
+    # Uso desde memoria: el sidecar no debe parecer el menos reciente al podar la caché
+    try:
+        os.utime(ruta_sidecar(huella), None)
+    except OSError:
+        pass
+
+def leer_sidecar(huella, columnas=None):
+    ruta = ruta_sidecar(huella)
+    if not os.path.exists(ruta):
+        return None
+    try:
+        if columnas is not None:
+            columnas = [c for c in pq.read_schema(ruta).names if c in columnas]
+        tabla = pq.read_table(ruta, columns=columnas)
+    except Exception:
+        return None
+    os.utime(ruta, None)
+
+    df = tabla_a_expediente(tabla)
+    metadatos = pq.read_metadata(ruta).metadata or {}
+    if b'sabanas_memoria' in metadatos:
+        df.attrs['memoria_mb'] = json.loads(metadatos[b'sabanas_memoria'])
+    return df
+
+def leer_expediente(huella, columnas=None):
+    # columnas: lectura parcial del sidecar (la copia en la base siempre se lee entera)
+    df = leer_sidecar(huella, columnas)
+    if df is None:
+        # La caché pudo podarse: los casos guardados se releen de la base local
+        df = leer_expediente_bd(huella)
+    if df is not None and 'momento' not in df.columns and 'fecha_dt' in df.columns:
+        # Sidecars escritos antes de que existiera la columna de momento
+        df['momento'] = calcular_momento_evento(df)
+    if df is not None and 'momento' in df.columns and 'hora_valida' not in df.columns:
+        df['hora_valida'] = mascara_hora_valida(df)
+    if df is not None and 'momento' in df.columns:
+        # Orden cronológico una sola vez: los filtros de rango pasan a ser búsquedas binarias
+        df = df.sort_values('momento', kind='stable', na_position='last').reset_index(drop=True)
+    return df
+
+# =========================
+# INGESTA POR BLOQUES
+# =========================
+FILAS_POR_BLOQUE = int(os.environ.get("SABANAS_FILAS_POR_BLOQUE", "100000"))
+
+def detectar_codificacion(contenido):
+    # Muchas exportaciones de operador vienen en Latin-1; basta con revisar el inicio del archivo
+    muestra = contenido[:1_000_000]
+    muestra = muestra[:muestra.rfind(b'\n') + 1] or muestra
+    try:
+        muestra.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+def detectar_separador(contenido, codificacion):
+    muestra = contenido[:65536].decode(codificacion, errors='ignore')
+    try:
+        return csv.Sniffer().sniff(muestra, delimiters=',;|\t').delimiter
+    except csv.Error:
+        return ','
+
+def leer_encabezado(nombre, contenido):
+    extension = os.path.splitext(nombre)[1].lower()
+    if extension == '.csv':
+        codificacion = detectar_codificacion(contenido)
+        return list(pd.read_csv(
+            io.BytesIO(contenido), nrows=0, sep=detectar_separador(contenido, codificacion), encoding=codificacion
+        ).columns)
+    if extension == '.xls':
+        return list(pd.read_excel(io.BytesIO(contenido), nrows=0).columns)
+    libro = openpyxl.load_workbook(io.BytesIO(contenido), read_only=True, data_only=True)
+    try:
+        primera = next(libro.worksheets[0].iter_rows(max_row=1, values_only=True), ())
+        return list(primera)
+    finally:
+        libro.close()
+
+def iterar_bloques(nombre, contenido, filas_por_bloque=FILAS_POR_BLOQUE):
+    # Genera (DataFrame, fracción leída del archivo) sin cargar el libro completo
+    extension = os.path.splitext(nombre)[1].lower()
+
+    if extension == '.csv':
+        buffer = io.BytesIO(contenido)
+        codificacion = detectar_codificacion(contenido)
+        separador = detectar_separador(contenido, codificacion)
+        for bloque in pd.read_csv(buffer, sep=separador, encoding=codificacion, chunksize=filas_por_bloque, dtype=str):
+            yield bloque, buffer.tell() / max(len(contenido), 1)
+        return
+
+    if extension == '.xls':
+        # xlrd no tiene modo streaming; los .xls están limitados a 65.536 filas
+        df = pd.read_excel(io.BytesIO(contenido))
+        for inicio in range(0, len(df), filas_por_bloque):
+            yield df.iloc[inicio:inicio + filas_por_bloque].copy(), min(1.0, (inicio + filas_por_bloque) / max(len(df), 1))
+        return
+
+    libro = openpyxl.load_workbook(io.BytesIO(contenido), read_only=True, data_only=True)
+    try:
+        hoja = libro.worksheets[0]
+        total = hoja.max_row or 0
+        filas = hoja.iter_rows(values_only=True)
+        encabezado = list(next(filas, ()))
+        bloque = []
+        leidas = 1
+        for fila in filas:
+            bloque.append(fila)
+            leidas += 1
+            if len(bloque) >= filas_por_bloque:
+                yield pd.DataFrame(bloque, columns=encabezado), min(1.0, leidas / total) if total else 0.0
+                bloque = []
+        if bloque:
+            yield pd.DataFrame(bloque, columns=encabezado), 1.0
+    finally:
+        libro.close()
+
+def tipo_arrow_columna(nombre):
+    if nombre in ('latitud', 'longitud'):
+        return pa.float32()
+    if nombre in ('fecha_dt', 'momento'):
+        return pa.timestamp('us')
+    if nombre == 'hora_valida':
+        return pa.bool_()
+    if nombre in ('tipo', 'fecha') or 'linea' in nombre or 'imei' in nombre or 'imsi' in nombre:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+def esquema_expediente(encabezados):
+    # Unión de columnas estandarizadas de todos los archivos, con tipo fijo por nombre
+    columnas = []
+    for encabezado in encabezados:
+        vacio = estandarizar_df(pd.DataFrame(columns=[str(c) for c in encabezado if c is not None]))
+        for col in vacio.columns:
+            if col not in columnas:
+                columnas.append(col)
+    return pa.schema([pa.field(c, tipo_arrow_columna(c)) for c in columnas])
+
+def columna_a_texto(serie):
+    texto = serie.astype(object).astype(str)
+    return texto.where(serie.notna(), None)
+
+def bloque_a_tabla(df, esquema):
+    arreglos = []
+    for campo in esquema:
+        if campo.name not in df.columns:
+            arreglos.append(pa.nulls(len(df), type=campo.type))
+            continue
+        serie = df[campo.name]
+        if pa.types.is_dictionary(campo.type):
+            arreglo = pa.array(columna_a_texto(serie), type=pa.string()).dictionary_encode()
+        elif pa.types.is_string(campo.type):
+            arreglo = pa.array(columna_a_texto(serie), type=pa.string())
+        elif pa.types.is_timestamp(campo.type):
+            arreglo = pa.array(pd.to_datetime(serie, errors='coerce').astype('datetime64[us]'), type=campo.type)
+        elif pa.types.is_boolean(campo.type):
+            arreglo = pa.array(serie.fillna(False).astype(bool).to_numpy(), type=campo.type)
+        else:
+            arreglo = pa.array(serie.to_numpy(dtype='float32', na_value=np.nan), type=campo.type, from_pandas=True)
+        arreglos.append(arreglo)
+    return pa.Table.from_arrays(arreglos, schema=esquema)
+
+def huellas_registros(df, columnas):
+    # Huella de cada registro sobre todas las columnas del expediente (las ausentes cuentan como vacías)
+    claves = pd.DataFrame({c: columna_a_texto(df[c]) if c in df.columns else None for c in columnas}, index=df.index)
+    return pd.util.hash_pandas_object(claves, index=False).to_numpy()
+
+def contiene_ordenado(ordenado, valores):
+    if len(ordenado) == 0:
+        return np.zeros(len(valores), dtype=bool)
+    posiciones = np.searchsorted(ordenado, valores)
+    return ordenado[np.minimum(posiciones, len(ordenado) - 1)] == valores
+
+def escribir_expediente(huella, archivos, progreso=None):
+    # archivos: lista de (nombre, contenido). Escribe un único Parquet deduplicado por bloques.
+    os.makedirs(DIR_CACHE_SABANAS, exist_ok=True)
+    ruta = ruta_sidecar(huella)
+    ruta_tmp = f"{ruta}.tmp"
+
+    esquema = esquema_expediente([leer_encabezado(nombre, contenido) for nombre, contenido in archivos])
+    # Huellas de los archivos ya escritos: solo se descartan registros repetidos entre exportaciones
+    # solapadas; las filas idénticas dentro de una misma exportación se conservan
+    vistos = np.empty(0, dtype='uint64')
+    memoria = {'antes': 0.0, 'despues': 0.0, 'ahorrado': 0.0}
+    registros = 0
+    duplicados = 0
+
+    try:
+        with pq.ParquetWriter(ruta_tmp, esquema) as escritor:
+            for i, (nombre, contenido) in enumerate(archivos):
+                propias = []
+                for bloque, fraccion in iterar_bloques(nombre, contenido):
+                    bloque = estandarizar_df(bloque)
+                    for clave, valor in bloque.attrs.get('memoria_mb', {}).items():
+                        memoria[clave] = round(memoria[clave] + valor, 2)
+
+                    if len(archivos) > 1:
+                        huellas = huellas_registros(bloque, esquema.names)
+                        nuevos = ~contiene_ordenado(vistos, huellas)
+                        duplicados += int((~nuevos).sum())
+                        bloque = bloque[nuevos]
+                        propias.append(huellas[nuevos])
+
+                    registros += len(bloque)
+                    if len(bloque):
+                        escritor.write_table(bloque_a_tabla(bloque, esquema))
+                    if progreso is not None:
+                        progreso((i + fraccion) / len(archivos), f"📥 {nombre}: {registros:,} registros ({duplicados:,} duplicados descartados)")
+                if propias:
+                    vistos = np.unique(np.concatenate([vistos] + propias))
+
+            escritor.add_key_value_metadata({'sabanas_memoria': json.dumps(memoria)})
+        os.replace(ruta_tmp, ruta)
+    finally:
+        if os.path.exists(ruta_tmp):
+            os.remove(ruta_tmp)
+    podar_cache_disco()
+
+def ingestar_archivos(archivos, progreso=None):
+    # archivos: lista de (nombre, contenido). Devuelve la huella del expediente ya escrito en caché.
+    archivos = sorted(archivos, key=lambda a: huella_contenido(a[1]))
+    # La huella del expediente no depende del orden en que se suban los archivos
+    huella = huella_contenido("".join(huella_contenido(c) for _, c in archivos).encode())
+    if not os.path.exists(ruta_sidecar(huella)):
+        escribir_expediente(huella, archivos, progreso)
+    return huella
+
+# =========================
+# BASE DE CASOS (SQLITE)
+# =========================
+RUTA_BD_CASOS = os.environ.get(
+    "SABANAS_BD_CASOS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".casos_sabanas", "casos.sqlite")
+)
+LIMITE_FILAS_CONSULTA = int(os.environ.get("SABANAS_FILAS_CONSULTA", "2000000"))
+# Espera ante otra conexión escribiendo (SQLite trae 5 s; guardar un caso puede coincidir con un volcado)
+ESPERA_BD_SEG = float(os.environ.get("SABANAS_BD_ESPERA_SEG", "120"))
+BLOQUEOS_VOLCADO = {}
+BLOQUEO_REGISTRO_VOLCADOS = threading.Lock()
+
+def abrir_bd(ruta=None):
+    ruta = ruta or RUTA_BD_CASOS
+    os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+    con = sqlite3.connect(ruta, timeout=ESPERA_BD_SEG, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("""CREATE TABLE IF NOT EXISTS expedientes (
+        huella TEXT PRIMARY KEY, tabla TEXT, columnas TEXT, registros INTEGER, memoria TEXT)""")
+    con.execute("""CREATE TABLE IF NOT EXISTS casos (
+        caso TEXT, huella TEXT, etiqueta TEXT, creado TEXT, PRIMARY KEY (caso, huella))""")
+    return con
+
+def columna_sql(nombre):
+    return '"' + nombre.replace('"', '""') + '"'
+
+def tipo_sql_columna(nombre):
+    tipo = tipo_arrow_columna(nombre)
+    if pa.types.is_timestamp(tipo):
+        return 'INTEGER'
+    if pa.types.is_boolean(tipo):
+        return 'BOOLEAN'
+    if pa.types.is_floating(tipo):
+        return 'REAL'
+    return 'TEXT'
+
+def bloque_a_filas_sql(df):
+    # Fechas como segundos epoch (enteros indexables); categorías y texto como TEXT; NaN -> NULL
+    columnas = {}
+    for col in df.columns:
+        serie = df[col]
+        if tipo_sql_columna(col) == 'INTEGER':
+            segundos = pd.to_datetime(serie, errors='coerce').to_numpy(dtype='datetime64[s]')
+            valores = segundos.astype('int64').astype(object)
+            valores[np.isnat(segundos)] = None
+        elif tipo_sql_columna(col) == 'REAL':
+            valores = serie.to_numpy(dtype='float64', na_value=np.nan).astype(object)
+            valores[pd.isna(valores)] = None
+        elif tipo_sql_columna(col) == 'BOOLEAN':
+            valores = serie.fillna(False).astype(bool).astype('int64').astype(object).to_numpy()
+        else:
+            valores = columna_a_texto(serie).to_numpy(dtype=object)
+        columnas[col] = valores
+    return zip(*columnas.values())
+
+def expediente_en_bd(con, huella):
+    fila = con.execute("SELECT tabla, columnas, registros FROM expedientes WHERE huella = ?", (huella,)).fetchone()
+    if fila is None:
+        return None
+    return {'tabla': fila[0], 'columnas': json.loads(fila[1]), 'registros': fila[2]}
+
+def bloqueo_volcado(huella):
+    # Un volcado por expediente a la vez; expedientes distintos se vuelcan en paralelo
+    with BLOQUEO_REGISTRO_VOLCADOS:
+        return BLOQUEOS_VOLCADO.setdefault(huella, threading.Lock())
+
+def volcar_expediente_bd(huella, con=None, progreso=None):
+    # Copia el Parquet de la caché a la base una sola vez, por bloques (no requiere cargarlo entero)
+    propia = con is None
+    con = con or abrir_bd()
+    try:
+        info = expediente_en_bd(con, huella)
+        if info is not None:
+            return info
+        with bloqueo_volcado(huella):
+            # Otra sesión pudo terminar el volcado mientras se esperaba el bloqueo
+            info = expediente_en_bd(con, huella)
+            if info is not None:
+                return info
+            ruta = ruta_sidecar(huella)
+            if not os.path.exists(ruta):
+                raise FileNotFoundError(f"El expediente {huella[:12]} no está en la caché local; vuelva a cargar el archivo.")
+
+            archivo = pq.ParquetFile(ruta)
+            columnas = archivo.schema_arrow.names
+            tabla = f"exp_{huella[:24]}"
+            # Una tabla sin su fila en 'expedientes' es un volcado interrumpido: se rehace desde cero
+            with con:
+                con.execute(f"DROP TABLE IF EXISTS {tabla}")
+                con.execute(f"CREATE TABLE IF NOT EXISTS {tabla} ({', '.join(f'{columna_sql(c)} {tipo_sql_columna(c)}' for c in columnas)})")
+            insertar = f"INSERT INTO {tabla} VALUES ({', '.join('?' * len(columnas))})"
+            registros = 0
+            for lote in archivo.iter_batches(batch_size=FILAS_POR_BLOQUE):
+                bloque = lote.to_pandas()
+                # Una transacción por bloque: el volcado no retiene la escritura de la base durante minutos
+                with con:
+                    con.executemany(insertar, bloque_a_filas_sql(bloque))
+                registros += len(bloque)
+                if progreso is not None:
+                    progreso(registros / max(archivo.metadata.num_rows, 1), f"🗄️ Guardando en la base: {registros:,} registros")
+
+            with con:
+                # Índices para las consultas que se resuelven en la base
+                for col in ('linea a', 'linea b', 'momento'):
+                    if col in columnas:
+                        con.execute(f"CREATE INDEX IF NOT EXISTS ix_{tabla}_{col.replace(' ', '_')} ON {tabla} ({columna_sql(col)})")
+                if 'latitud' in columnas and 'longitud' in columnas:
+                    con.execute(f"CREATE INDEX IF NOT EXISTS ix_{tabla}_coordenadas ON {tabla} (latitud, longitud)")
+
+                # La fila en 'expedientes' se escribe al final: marca el volcado como completo
+                memoria = (archivo.metadata.metadata or {}).get(b'sabanas_memoria', b'{}').decode()
+                con.execute(
+                    "INSERT OR IGNORE INTO expedientes VALUES (?, ?, ?, ?, ?)",
+                    (huella, tabla, json.dumps(columnas), registros, memoria)
+                )
+            return expediente_en_bd(con, huella)
+    finally:
+        if propia:
+            con.close()
+
+def guardar_caso(caso, sabanas, progreso=None):
+    # sabanas: lista de (huella, etiqueta)
+    con = abrir_bd()
+    try:
+        for huella, etiqueta in sabanas:
+            volcar_expediente_bd(huella, con, progreso)
+        with con:
+            # Guardar un caso reemplaza su conjunto de sábanas: una CRUCE retirada no debe volver al reabrirlo
+            con.execute("DELETE FROM casos WHERE caso = ?", (caso,))
+            con.executemany(
+                "INSERT OR REPLACE INTO casos VALUES (?, ?, ?, ?)",
+                [(caso, huella, etiqueta, pd.Timestamp.now().strftime('%Y-%m-%d %H:%M')) for huella, etiqueta in sabanas]
+            )
+    finally:
+        con.close()
+
+def listar_casos():
+    con = abrir_bd()
+    try:
+        return pd.read_sql_query("""
+            SELECT c.caso, COUNT(*) AS sabanas, SUM(e.registros) AS registros, MAX(c.creado) AS creado
+            FROM casos c JOIN expedientes e ON e.huella = c.huella
+            GROUP BY c.caso ORDER BY MAX(c.creado) DESC""", con)
+    finally:
+        con.close()
+
+def sabanas_de_caso(caso):
+    con = abrir_bd()
+    try:
+        return con.execute("SELECT huella, etiqueta FROM casos WHERE caso = ? ORDER BY etiqueta DESC", (caso,)).fetchall()
+    finally:
+        con.close()
+
+def tabla_a_expediente(tabla):
+    df = tabla.to_pandas()
+    if 'fecha' in df.columns and isinstance(df['fecha'].dtype, pd.CategoricalDtype):
+        df['fecha'] = df['fecha'].cat.reorder_categories(sorted(df['fecha'].cat.categories), ordered=True)
+    return df
+
+def filas_a_expediente(df, columnas):
+    # Resultado SQL -> los mismos tipos que un expediente leído del Parquet
+    for col in columnas:
+        if tipo_sql_columna(col) == 'INTEGER':
+            df[col] = pd.to_datetime(df[col], unit='s')
+        elif tipo_sql_columna(col) == 'BOOLEAN':
+            df[col] = df[col].fillna(0).astype(bool)
+    return tabla_a_expediente(bloque_a_tabla(df, pa.schema([pa.field(c, tipo_arrow_columna(c)) for c in columnas])))
+
+def condiciones_consulta(columnas, f_inicio=None, f_fin=None, ventana=None, fragmentos=None, columnas_busqueda=None, numeros=None):
+    condiciones, parametros = [], []
+    if f_inicio is not None and 'momento' in columnas:
+        condiciones.append("momento >= ?")
+        parametros.append(int(pd.Timestamp(f_inicio).timestamp()))
+    if f_fin is not None and 'momento' in columnas:
+        condiciones.append("momento < ?")
+        parametros.append(int((pd.Timestamp(f_fin) + pd.Timedelta(days=1)).timestamp()))
+    if ventana is not None and 'momento' in columnas:
+        hora_inicio, hora_fin = ventana
+        union = "OR" if hora_inicio > hora_fin else "AND"
+        condiciones.append(f"(momento % 86400 / 3600 >= ? {union} momento % 86400 / 3600 <= ?)")
+        if 'hora_valida' in columnas:
+            condiciones.append("hora_valida = 1")
+        parametros += [int(hora_inicio), int(hora_fin)]
+    if fragmentos:
+        buscar_en = [c for c in (columnas_busqueda or columnas_identificador(pd.DataFrame(columns=columnas))) if c in columnas]
+        condiciones.append("(" + " OR ".join(f"instr({columna_sql(c)}, ?) > 0" for c in buscar_en for _ in fragmentos) + ")")
+        parametros += [f for _ in buscar_en for f in fragmentos]
+    if numeros is not None:
+        lineas = [c for c in ('linea a', 'linea b') if c in columnas]
+        condiciones.append("(" + " OR ".join(f"{columna_sql(c)} IN (SELECT value FROM json_each(?))" for c in lineas) + ")")
+        parametros += [json.dumps(list(numeros))] * len(lineas)
+    return (" WHERE " + " AND ".join(condiciones)) if condiciones else "", parametros
+
+def expediente_disponible(huella):
+    # Se puede releer del sidecar o, si se podó, de la copia en la base local
+    if os.path.exists(ruta_sidecar(huella)):
+        return True
+    con = abrir_bd()
+    try:
+        return expediente_en_bd(con, huella) is not None
+    finally:
+        con.close()
+
+def leer_expediente_bd(huella):
+    con = abrir_bd()
+    try:
+        info = expediente_en_bd(con, huella)
+        if info is None:
+            return None
+        df = pd.read_sql_query(f"SELECT * FROM {info['tabla']}", con)
+        memoria = con.execute("SELECT memoria FROM expedientes WHERE huella = ?", (huella,)).fetchone()[0]
+    finally:
+        con.close()
+    df = filas_a_expediente(df, info['columnas'])
+    if memoria and memoria != '{}':
+        df.attrs['memoria_mb'] = json.loads(memoria)
+    return df
+
+def contar_registros_bd(huella, **filtros):
+    con = abrir_bd()
+    try:
+        info = volcar_expediente_bd(huella, con)
+        donde, parametros = condiciones_consulta(info['columnas'], **filtros)
+        return con.execute(f"SELECT COUNT(*) FROM {info['tabla']}{donde}", parametros).fetchone()[0]
+    finally:
+        con.close()
+
+def consultar_registros_bd(huella, limite=LIMITE_FILAS_CONSULTA, **filtros):
+    # Solo las filas que cumplen el filtro salen de la base, ya en orden cronológico
+    con = abrir_bd()
+    try:
+        info = volcar_expediente_bd(huella, con)
+        donde, parametros = condiciones_consulta(info['columnas'], **filtros)
+        orden = " ORDER BY momento IS NULL, momento" if 'momento' in info['columnas'] else ""
+        df = pd.read_sql_query(f"SELECT * FROM {info['tabla']}{donde}{orden} LIMIT ?", con, params=parametros + [int(limite)])
+    finally:
+        con.close()
+    df = filas_a_expediente(df, info['columnas'])
+    df.attrs['registros_bd'] = info['registros']
+    return df
+
+def rango_fechas_bd(huella):
+    con = abrir_bd()
+    try:
+        info = volcar_expediente_bd(huella, con)
+        if 'momento' not in info['columnas']:
+            return None, None
+        minimo, maximo = con.execute(f"SELECT MIN(momento), MAX(momento) FROM {info['tabla']}").fetchone()
+    finally:
+        con.close()
+    if minimo is None:
+        return None, None
+    return pd.Timestamp(minimo, unit='s').date(), pd.Timestamp(maximo, unit='s').date()
+
+def consultar_cubo_bd(huella):
+    # El mismo cubo que construir_cubo_espacial, agregado dentro de la base (sitio x día x hora)
+    columnas_cubo = ['x', 'y', 'dia', 'hora', 'hits', 'suma_lat', 'suma_lon']
+    con = abrir_bd()
+    try:
+        info = volcar_expediente_bd(huella, con)
+        if 'latitud' not in info['columnas'] or 'longitud' not in info['columnas']:
+            return pd.DataFrame(columns=columnas_cubo)
+        hora = "momento % 86400 / 3600"
+        if 'hora_valida' in info['columnas']:
+            hora = f"CASE WHEN hora_valida = 1 THEN {hora} END"
+        tiempo = (f"momento - momento % 86400 AS dia, {hora} AS hora"
+                  if 'momento' in info['columnas'] else "NULL AS dia, NULL AS hora")
+        sitios = pd.read_sql_query(f"""
+            SELECT latitud, longitud, {tiempo}, COUNT(*) AS hits
+            FROM {info['tabla']}
+            WHERE latitud IS NOT NULL AND longitud IS NOT NULL AND latitud != 0 AND longitud != 0
+            GROUP BY latitud, longitud, dia, hora""", con)
+    finally:
+        con.close()
+    if sitios.empty:
+        return pd.DataFrame(columns=columnas_cubo)
+
+    x, y = teselas_xy(sitios['latitud'], sitios['longitud'])
+    cubo = pd.DataFrame({
+        'x': x, 'y': y,
+        'dia': pd.to_datetime(sitios['dia'], unit='s'),
+        'hora': sitios['hora'].fillna(-1).astype('int8'),
+        'hits': sitios['hits'],
+        'suma_lat': sitios['latitud'] * sitios['hits'],
+        'suma_lon': sitios['longitud'] * sitios['hits'],
+    }).groupby(['x', 'y', 'dia', 'hora'], dropna=False).sum().reset_index()
+    return cubo[columnas_cubo]
+
+def numeros_comunes_bd(huella_1, huella_2):
+    con = abrir_bd()
+    try:
+        consultas = []
+        for huella in (huella_1, huella_2):
+            info = volcar_expediente_bd(huella, con)
+            lineas = [c for c in ('linea a', 'linea b') if c in info['columnas']]
+            if not lineas:
+                return set()
+            consultas.append(" UNION ".join(f"SELECT {columna_sql(c)} FROM {info['tabla']}" for c in lineas))
+        filas = con.execute(f"SELECT * FROM ({consultas[0]}) INTERSECT SELECT * FROM ({consultas[1]})").fetchall()
+    finally:
+        con.close()
+    return {f[0] for f in filas if f[0] is not None and f[0] != 'DESCONOCIDO'}
+
+def parsear_horas(serie):
+    # Convierte la columna hora a timedelta evaluando solo los valores distintos
+    codigos, unicos = pd.factorize(serie)
+    unicos = pd.Series(unicos, dtype=object)
+
+    es_numero = unicos.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool))
+    texto = unicos.astype(str)
+
+    # Primero el formato habitual HH:MM:SS en C; lo demás cae a los parsers genéricos
+    momentos = pd.to_datetime(texto, format='%H:%M:%S', errors='coerce')
+    deltas = momentos - momentos.dt.normalize()
+
+    faltan = deltas.isna() & ~es_numero
+    if faltan.any():
+        deltas[faltan] = pd.to_timedelta(texto[faltan], errors='coerce')
+    faltan = deltas.isna() & ~es_numero
+    if faltan.any():
+        momentos = pd.to_datetime(texto[faltan], errors='coerce', format='mixed')
+        deltas[faltan] = momentos - momentos.dt.normalize()
+
+    # Horas de Excel guardadas como fracción del día
+    if es_numero.any():
+        numericos = pd.to_numeric(unicos[es_numero], errors='coerce')
+        numericos = numericos.where(numericos.between(0, 1, inclusive='left'))
+        deltas[es_numero] = pd.to_timedelta(numericos, unit='D')
+
+    resultado = deltas.to_numpy(dtype='timedelta64[ns]')[codigos]
+    resultado[codigos == -1] = np.timedelta64('NaT')
+    return pd.Series(resultado, index=serie.index)
+
+def calcular_momento_evento(df, horas=None):
+    if 'momento' in df.columns:
+        return df['momento']
+    if 'fecha_dt' in df.columns:
+        base = df['fecha_dt']
+    elif 'fecha' in df.columns:
+        base = pd.to_datetime(df['fecha'].astype(object), errors='coerce')
+    else:
+        return pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+
+    base = base.dt.normalize()
+    if horas is None and 'hora' in df.columns:
+        horas = parsear_horas(df['hora'])
+    if horas is not None:
+        return base + horas.fillna(pd.Timedelta(0))
+    return base
+
+def mascara_hora_valida(df):
+    # Registros con hora interpretable; los demás solo tienen fecha y quedan fuera de las ventanas horarias
+    if 'hora_valida' in df.columns:
+        return df['hora_valida'].to_numpy(dtype=bool)
+    if 'hora' not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    return parsear_horas(df['hora']).notna().to_numpy()
+
+# =========================
+# ÍNDICE TEMPORAL Y PERNOCTA
+# =========================
+def filtrar_rango_fechas(df, f_inicio, f_fin):
+    # df viene ordenado por 'momento' (NaT al final): el rango es un corte iloc, sin copias
+    if 'momento' not in df.columns:
+        fechas = df['fecha_dt'].dt.date
+        return df[(fechas >= f_inicio) & (fechas <= f_fin)]
+
+    momentos = df['momento'].to_numpy()
+    validos = len(momentos) - int(np.isnat(momentos).sum())
+    inicio = np.datetime64(pd.Timestamp(f_inicio))
+    fin = np.datetime64(pd.Timestamp(f_fin) + pd.Timedelta(days=1))
+    i = np.searchsorted(momentos[:validos], inicio, side='left')
+    j = np.searchsorted(momentos[:validos], fin, side='left')
+    return df.iloc[i:j]
+
+def horas_en_ventana(horas, hora_inicio=22, hora_fin=7):
+    # Ventana por hora del día, inclusiva en ambos extremos (22 a 7 = 22:00-07:59).
+    # Horas desconocidas (NaN o -1) nunca caen dentro.
+    if hora_inicio > hora_fin:
+        return (horas >= 0) & ((horas >= hora_inicio) | (horas <= hora_fin))
+    return (horas >= hora_inicio) & (horas <= hora_fin)
+
+def mascara_pernocta(df, hora_inicio=22, hora_fin=7):
+    horas = df['momento'].dt.hour.to_numpy(dtype='float64', na_value=np.nan)
+    horas[~mascara_hora_valida(df)] = np.nan
+    return horas_en_ventana(horas, hora_inicio, hora_fin)
+
+def asignar_noche(momentos, hora_inicio=22, hora_fin=7):
+    # Si la ventana cruza la medianoche, la madrugada pertenece a la noche que empezó el día anterior
+    if hora_inicio > hora_fin:
+        momentos = momentos - pd.Timedelta(hours=hora_fin + 1)
+    return momentos.dt.normalize()
+
+def resumir_pernoctas(df, hora_inicio=22, hora_fin=7):
+    columnas = ['noche', 'eventos', 'primer_evento', 'ultimo_evento', 'latitud', 'longitud', 'eventos_en_sitio']
+    if df.empty or 'momento' not in df.columns:
+        return pd.DataFrame(columns=columnas)
+    df = df[mascara_hora_valida(df)]
+    if df.empty:
+        return pd.DataFrame(columns=columnas)
+
+    noches = pd.DataFrame({
+        'noche': asignar_noche(df['momento'], hora_inicio, hora_fin).to_numpy(),
+        'momento': df['momento'].to_numpy(),
+    })
+    resumen = noches.groupby('noche').agg(
+        eventos=('momento', 'size'),
+        primer_evento=('momento', 'min'),
+        ultimo_evento=('momento', 'max')
+    )
+
+    if 'latitud' in df.columns and 'longitud' in df.columns:
+        noches['latitud'] = df['latitud'].to_numpy()
+        noches['longitud'] = df['longitud'].to_numpy()
+        con_geo = noches.dropna(subset=['latitud', 'longitud'])
+        con_geo = con_geo[(con_geo['latitud'] != 0) & (con_geo['longitud'] != 0)]
+        # Sitio dominante de cada noche = dónde pernoctó el objetivo
+        sitios = con_geo.groupby(['noche', 'latitud', 'longitud']).size().reset_index(name='eventos_en_sitio')
+        sitios = sitios.sort_values(['noche', 'eventos_en_sitio'], ascending=[True, False]).drop_duplicates('noche')
+        resumen = resumen.join(sitios.set_index('noche'))
+
+    resumen = resumen.reset_index()
+    resumen['noche'] = resumen['noche'].dt.strftime('%Y-%m-%d')
+    return resumen.reindex(columns=columnas)
+
+def clasificar_tipo_evento(texto):
+    texto = str(texto).upper()
+    if 'SMS' in texto or 'MENSAJE' in texto or 'MSG' in texto:
+        return 'sms'
+    if 'DAT' in texto or 'GPRS' in texto or 'INTERNET' in texto or 'DATA' in texto:
+        return 'datos'
+    if 'VOZ' in texto or 'LLAM' in texto or 'CALL' in texto or 'VOICE' in texto:
+        return 'llamadas'
+    return 'otros'
+
+CLASES_EVENTO = ['llamadas', 'sms', 'datos', 'otros']
+
+def codificar_lineas(*series):
+    # Códigos enteros comunes para varias columnas de números (categóricas tras estandarizar_df)
+    if all(isinstance(s.dtype, pd.CategoricalDtype) for s in series):
+        union = union_categoricals([s.array for s in series])
+        return union.codes, union.categories.to_numpy(dtype=object)
+    codigos, numeros = pd.factorize(pd.concat(series, ignore_index=True).astype(object))
+    return codigos, numeros
+
+def ordenar_por_frecuencia_interacciones(df_target, progreso=None):
+    # progreso(fraccion, texto) se llama entre pasos; en una tarea es además su punto de cancelación
+    if 'linea a' not in df_target.columns or 'linea b' not in df_target.columns:
+        return df_target
+    avisar = progreso or (lambda fraccion, texto: None)
+
+    n = len(df_target)
+    codigos, numeros = codificar_lineas(df_target['linea a'], df_target['linea b'])
+    cod_a, cod_b = codigos[:n], codigos[n:]
+
+    if len(numeros) == 0:
+        return pd.DataFrame(columns=['total_interacciones', 'telefono_objetivo'])
+
+    conteo_lineas = np.bincount(codigos[codigos >= 0], minlength=len(numeros))
+    cod_objetivo = int(conteo_lineas.argmax())
+
+    # Contraparte: si la línea A es la de la sábana, el interlocutor es B; si no, A
+    cod_contraparte = np.where(cod_a == cod_objetivo, cod_b, cod_a)
+    validos = cod_contraparte >= 0
+    cod_contraparte = cod_contraparte[validos]
+
+    avisar(0.3, "agrupando por interlocutor")
+    momento = calcular_momento_evento(df_target).to_numpy()[validos]
+    momento_ns = momento.astype('datetime64[ns]').view('int64')
+
+    conteo = np.bincount(cod_contraparte, minlength=len(numeros))
+    grupos = np.flatnonzero(conteo)
+    posicion_grupo = np.full(len(numeros), -1)
+    posicion_grupo[grupos] = np.arange(len(grupos))
+    inversa = posicion_grupo[cod_contraparte]
+    total = conteo[grupos]
+
+    resumen = pd.DataFrame({
+        'total_interacciones': total,
+        'telefono_objetivo': numeros[grupos],
+    })
+
+    # Primer/último contacto real según fecha+hora (NaT se ignora)
+    avisar(0.5, "primer y último contacto")
+    extremos = pd.Series(momento).groupby(inversa).agg(['min', 'max'])
+    resumen['primer_contacto'] = extremos['min'].to_numpy()
+    resumen['ultimo_contacto'] = extremos['max'].to_numpy()
+    resumen['ultima_fecha'] = resumen['ultimo_contacto'].dt.strftime('%Y-%m-%d')
+    resumen['ultima_hora'] = resumen['ultimo_contacto'].dt.strftime('%H:%M:%S')
+
+    # Última posición conocida: el registro con coordenadas más reciente de cada interlocutor
+    resumen['ultima_latitud'] = np.nan
+    resumen['ultima_longitud'] = np.nan
+    if 'latitud' in df_target.columns and 'longitud' in df_target.columns:
+        avisar(0.7, "última posición conocida")
+        lat = df_target['latitud'].to_numpy()[validos]
+        lon = df_target['longitud'].to_numpy()[validos]
+        con_geo = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+        if len(con_geo):
+            orden = con_geo[np.lexsort((momento_ns[con_geo], inversa[con_geo]))]
+            es_ultimo = np.r_[inversa[orden][1:] != inversa[orden][:-1], True]
+            ultimos = orden[es_ultimo]
+            resumen.loc[inversa[ultimos], 'ultima_latitud'] = lat[ultimos]
+            resumen.loc[inversa[ultimos], 'ultima_longitud'] = lon[ultimos]
+
+    columnas_tipo = []
+    if 'tipo' in df_target.columns:
+        avisar(0.9, "conteo por tipo de evento")
+        cod_tipo, tipos = pd.factorize(df_target['tipo'].astype(object))
+        clase_por_tipo = np.array([CLASES_EVENTO.index(clasificar_tipo_evento(t)) for t in tipos] + [CLASES_EVENTO.index('otros')])
+        clase = clase_por_tipo[cod_tipo[validos]]
+        matriz = np.bincount(
+            inversa * len(CLASES_EVENTO) + clase, minlength=len(grupos) * len(CLASES_EVENTO)
+        ).reshape(len(grupos), len(CLASES_EVENTO))
+        for i, nombre in enumerate(CLASES_EVENTO):
+            resumen[nombre] = matriz[:, i]
+        columnas_tipo = CLASES_EVENTO
+
+    resumen = resumen.sort_values(by='total_interacciones', ascending=False, kind='stable')
+
+    columnas_finales = ['total_interacciones', 'telefono_objetivo', 'ultima_fecha', 'ultima_hora', 'ultima_latitud', 'ultima_longitud', 'primer_contacto', 'ultimo_contacto'] + columnas_tipo
+    return resumen[columnas_finales].reset_index(drop=True)
+
+RADIO_TIERRA_M = 6371008.8
+
+def distancia_haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype='float64')) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_M * np.arcsin(np.sqrt(a))
+
+def emparejar_sitios(sitios1, sitios2, tolerancia_m, progreso=None):
+    # Pares (sitio1, sitio2, distancia) entre coordenadas únicas de ambas sábanas
+    if tolerancia_m <= 0:
+        pares = sitios1.merge(sitios2, on=['latitud', 'longitud'], suffixes=('_1', '_2'))
+        pares['distancia_m'] = 0.0
+        return pares[['id_sitio_1', 'id_sitio_2', 'distancia_m']]
+
+    # Rejilla de celdas del tamaño de la tolerancia: solo se comparan las 9 celdas vecinas
+    lat_ref = np.cos(np.radians(float(sitios1['latitud'].mean())))
+    grados_lat = tolerancia_m / 111320.0
+    grados_lon = tolerancia_m / (111320.0 * max(lat_ref, 1e-6))
+
+    def celdas(sitios):
+        return sitios.assign(
+            celda_y=np.floor(sitios['latitud'].astype('float64') / grados_lat).astype('int64'),
+            celda_x=np.floor(sitios['longitud'].astype('float64') / grados_lon).astype('int64')
+        )
+
+    c1, c2 = celdas(sitios1), celdas(sitios2)
+    bloques = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if progreso is not None:
+                progreso(len(bloques) / 9, f"emparejando sitios: celda vecina {len(bloques) + 1} de 9")
+            vecinos = c2.assign(celda_y=c2['celda_y'] + dy, celda_x=c2['celda_x'] + dx)
+            bloques.append(c1.merge(vecinos, on=['celda_y', 'celda_x'], suffixes=('_1', '_2')))
+    pares = pd.concat(bloques, ignore_index=True)
+    pares['distancia_m'] = distancia_haversine_m(
+        pares['latitud_1'], pares['longitud_1'], pares['latitud_2'], pares['longitud_2']
+    )
+    pares = pares[pares['distancia_m'] <= tolerancia_m]
+    return pares[['id_sitio_1', 'id_sitio_2', 'distancia_m']]
+
+def cruzar_ubicaciones(df1, df2, tolerancia_m=0, progreso=None):
+    # Clasifica cada registro de df1 en CRUCIAL (mismo lugar y día en df2), ALERTA (mismo lugar,
+    # otro día) o BASE, y devuelve el registro espejo de df2 elegido para cada coincidencia.
+    avisar = progreso or (lambda fraccion, texto: None)
+    resultado = pd.DataFrame({
+        'tipo_alerta': 'BASE',
+        'pos_espejo': -1,
+        'distancia_m': np.nan,
+    }, index=df1.index)
+    columnas = ['latitud', 'longitud', 'fecha']
+    if df2 is None or any(c not in df1.columns or c not in df2.columns for c in columnas):
+        return resultado, pd.DataFrame()
+
+    def preparar(df):
+        d = pd.DataFrame({
+            'latitud': df['latitud'].to_numpy(),
+            'longitud': df['longitud'].to_numpy(),
+            'fecha': df['fecha'].astype(object).to_numpy(),
+            'pos': np.arange(len(df)),
+        })
+        d = d.dropna(subset=['latitud', 'longitud'])
+        return d[(d['latitud'] != 0) & (d['longitud'] != 0)]
+
+    d1, d2 = preparar(df1), preparar(df2)
+    if d1.empty or d2.empty:
+        return resultado, pd.DataFrame()
+
+    # Índices hash sobre coordenadas únicas: el trabajo depende de sitios, no de registros
+    avisar(0.1, "sitios únicos de ambas sábanas")
+    sitios1 = d1[['latitud', 'longitud']].drop_duplicates().reset_index(drop=True)
+    sitios1['id_sitio'] = np.arange(len(sitios1))
+    sitios2 = d2[['latitud', 'longitud']].drop_duplicates().reset_index(drop=True)
+    sitios2['id_sitio'] = np.arange(len(sitios2))
+    d1 = d1.merge(sitios1, on=['latitud', 'longitud'])
+    d2 = d2.merge(sitios2, on=['latitud', 'longitud'])
+
+    pares_sitios = emparejar_sitios(
+        sitios1, sitios2, tolerancia_m, lambda fraccion, texto: avisar(0.2 + 0.4 * fraccion, texto)
+    )
+    avisar(0.6, f"clasificando {len(pares_sitios):,} pares de sitios")
+    if pares_sitios.empty:
+        return resultado, pd.DataFrame()
+
+    # Primer registro de df2 por sitio y por sitio+día (mismo criterio que iloc[0])
+    primero_sitio = d2.sort_values('pos').drop_duplicates('id_sitio')[['id_sitio', 'pos']]
+    primero_dia = d2.sort_values('pos').drop_duplicates(['id_sitio', 'fecha'])[['id_sitio', 'fecha', 'pos']]
+
+    claves1 = d1[['id_sitio', 'fecha']].drop_duplicates().rename(columns={'id_sitio': 'id_sitio_1'})
+    candidatos = claves1.merge(pares_sitios, on='id_sitio_1')
+
+    mismo_dia = candidatos.merge(
+        primero_dia.rename(columns={'id_sitio': 'id_sitio_2'}), on=['id_sitio_2', 'fecha']
+    )
+    mismo_dia = mismo_dia[mismo_dia['fecha'].notna()]
+    mismo_dia = mismo_dia.sort_values(['distancia_m', 'pos']).drop_duplicates(['id_sitio_1', 'fecha'])
+    mismo_dia['tipo_alerta'] = 'CRUCIAL'
+
+    otro_dia = candidatos.merge(primero_sitio.rename(columns={'id_sitio': 'id_sitio_2'}), on='id_sitio_2')
+    otro_dia = otro_dia.sort_values(['distancia_m', 'pos']).drop_duplicates(['id_sitio_1', 'fecha'])
+    otro_dia['tipo_alerta'] = 'ALERTA'
+
+    elegidos = pd.concat([mismo_dia, otro_dia], ignore_index=True).drop_duplicates(['id_sitio_1', 'fecha'])
+    elegidos = elegidos.rename(columns={'id_sitio_1': 'id_sitio', 'pos': 'pos_espejo'})
+
+    avisar(0.8, "armando los pares de registros")
+    asignados = d1.merge(
+        elegidos[['id_sitio', 'fecha', 'pos_espejo', 'distancia_m', 'tipo_alerta']], on=['id_sitio', 'fecha']
+    )
+    filas = asignados['pos'].to_numpy()
+    resultado.iloc[filas, resultado.columns.get_loc('tipo_alerta')] = asignados['tipo_alerta'].to_numpy()
+    resultado.iloc[filas, resultado.columns.get_loc('pos_espejo')] = asignados['pos_espejo'].to_numpy()
+    resultado.iloc[filas, resultado.columns.get_loc('distancia_m')] = asignados['distancia_m'].to_numpy()
+
+    columnas_par = [c for c in ['fecha', 'hora', 'tipo', 'linea a', 'linea b', 'latitud', 'longitud'] if c in df1.columns and c in df2.columns]
+    lado1 = df1.iloc[filas][columnas_par].reset_index(drop=True).add_suffix(' (S1)')
+    lado2 = df2.iloc[asignados['pos_espejo'].to_numpy()][columnas_par].reset_index(drop=True).add_suffix(' (S2)')
+    pares = pd.concat([
+        asignados[['tipo_alerta', 'distancia_m']].reset_index(drop=True), lado1, lado2
+    ], axis=1)
+    pares['prioridad'] = pares['tipo_alerta'].map({'CRUCIAL': 0, 'ALERTA': 1})
+    pares = pares.sort_values(['prioridad', 'distancia_m'], kind='stable').drop(columns='prioridad').reset_index(drop=True)
+    return resultado, pares
+
+def numeros_comunes(df1, df2):
+    n1 = set(df1['linea a']) | set(df1['linea b'])
+    n2 = set(df2['linea a']) | set(df2['linea b'])
+    return n1.intersection(n2)
+
+def filtrar_por_numeros(df, numeros):
+    return df[df['linea a'].isin(numeros) | df['linea b'].isin(numeros)]
+
+def generar_html_popup_comparativo(reg_base, reg_espejo, tipo_alerta, titulo_alerta):
+    color_banner = "#28a745" 
+    if tipo_alerta == "CRUCIAL":
+        color_banner = "#dc3545" 
+    elif tipo_alerta == "ALERTA":
+        color_banner = "#ffc107" 
+
+    text_color = '#fff' if tipo_alerta != 'ALERTA' else '#000'
+
+    html = f"""
+    <div style="font-family: monospace; min-width: 410px; color: #000; font-size: 11px;">
+        <div style="background-color: {color_banner}; color: {text_color}; padding: 6px; text-align: center; font-weight: bold; border-radius: 4px; font-size: 12px; margin-bottom: 8px;">
+            {titulo_alerta}
+        </div>
+    """
+
+    if reg_espejo is not None:
+        html += f"""
+        <div style="display: flex; gap: 10px;">
+            <div style="flex: 1; background: #f8f9fa; padding: 6px; border-radius: 4px; border-left: 3px solid #00ff88;">
+                <b style="color: #111;">📄 ALFA (S1)</b><hr style="margin: 4px 0; border: 0; border-top: 1px solid #ccc;">
+                <b>F:</b> {reg_base.get('fecha', 'N/A')}<br>
+                <b>H:</b> {reg_base.get('hora', 'N/A')}<br>
+                <b>TIPO:</b> {reg_base.get('tipo', 'N/A')}<br>
+                <b>A:</b> {reg_base.get('linea a', 'N/A')}<br>
+                <b>B:</b> {reg_base.get('linea b', 'N/A')}<br>
+                <b>GEO:</b> {reg_base.get('latitud', 'N/A')}, {reg_base.get('longitud', 'N/A')}<br>
+            </div>
+            <div style="flex: 1; background: #fdf3f3; padding: 6px; border-radius: 4px; border-left: 3px solid {color_banner};">
+                <b style="color: #111;">📑 BRAVO (S2)</b><hr style="margin: 4px 0; border: 0; border-top: 1px solid #ccc;">
+                <b>F:</b> {reg_espejo.get('fecha', 'N/A')}<br>
+                <b>H:</b> {reg_espejo.get('hora', 'N/A')}<br>
+                <b>TIPO:</b> {reg_espejo.get('tipo', 'N/A')}<br>
+                <b>A:</b> {reg_espejo.get('linea a', 'N/A')}<br>
+                <b>B:</b> {reg_espejo.get('linea b', 'N/A')}<br>
+                <b>GEO:</b> {reg_espejo.get('latitud', 'N/A')}, {reg_espejo.get('longitud', 'N/A')}<br>
+            </div>
+        </div>
+        """
+    else:
+        html += f"""
+        <div style="background: #f8f9fa; padding: 8px; border-radius: 4px;">
+            <b>Fecha:</b> {reg_base.get('fecha', 'N/A')}<br>
+            <b>Hora:</b> {reg_base.get('hora', 'N/A')}<br>
+            <b>Tipo:</b> {reg_base.get('tipo', 'N/A')}<br>
+            <b>Línea A:</b> {reg_base.get('linea a', 'N/A')}<br>
+            <b>Línea B:</b> {reg_base.get('linea b', 'N/A')}<br>
+            <b>Coordenadas:</b> {reg_base.get('latitud', 'N/A')}, {reg_base.get('longitud', 'N/A')}
+        </div>
+        """
+        
+    html += "</div>"
+    return html
+
+def html_marca_agua(texto_firma):
+    return f"""
+    <div style="
+        position: fixed; 
+        bottom: 50px; 
+        left: 20px; 
+        width: auto; 
+        height: auto; 
+        z-index: 9999; 
+        font-family: 'Courier New', monospace;
+        color: rgba(0, 0, 0, 0.25); 
+        font-weight: bold; 
+        font-size: 26px; 
+        letter-spacing: 3px;
+        white-space: nowrap;
+        pointer-events: none;
+        user-select: none;
+        transform: rotate(-15deg);
+        background: rgba(255, 255, 255, 0.5);
+        padding: 5px 15px;
+        border: 2px dashed rgba(0, 0, 0, 0.15);
+        border-radius: 5px;
+    ">
+        {texto_firma}
+    </div>
+    """
+
+def aplicar_marca_agua_mapa(objeto_mapa, texto_firma):
+    objeto_mapa.get_root().html.add_child(folium.Element(html_marca_agua(texto_firma)))
+
+# =========================
+# CRUCE MÚLTIPLE (N SÁBANAS)
+# =========================
+COLUMNAS_MULTICRUCE = ['linea a', 'linea b', 'latitud', 'longitud', 'fecha']
+
+def conjunto_interlocutores(df):
+    # Números presentes en la sábana con su número de interacciones y una clave entera (hash)
+    codigos, numeros = codificar_lineas(df['linea a'], df['linea b'])
+    conteo = np.bincount(codigos[codigos >= 0], minlength=len(numeros))
+    usados = np.flatnonzero(conteo)
+    conjunto = pd.DataFrame({'numero': numeros[usados], 'interacciones': conteo[usados]})
+    conjunto = conjunto[conjunto['numero'] != 'DESCONOCIDO'].reset_index(drop=True)
+    conjunto['clave'] = pd.util.hash_pandas_object(conjunto['numero'].astype(str), index=False).to_numpy()
+    return conjunto
+
+def conjunto_colocaciones(df):
+    # Sitios-día (coordenada exacta + fecha) visitados por la sábana
+    if any(c not in df.columns for c in ('latitud', 'longitud', 'fecha')):
+        return pd.DataFrame(columns=['latitud', 'longitud', 'fecha', 'eventos', 'clave'])
+    puntos = puntos_mapeables(df)
+    conjunto = pd.DataFrame({
+        'latitud': puntos['latitud'].to_numpy(),
+        'longitud': puntos['longitud'].to_numpy(),
+        'fecha': puntos['fecha'].astype(object).to_numpy(),
+    }).dropna(subset=['fecha']).groupby(['latitud', 'longitud', 'fecha']).size().reset_index(name='eventos')
+    conjunto['clave'] = pd.util.hash_pandas_object(
+        conjunto[['latitud', 'longitud', 'fecha']].astype({'fecha': str}), index=False
+    ).to_numpy()
+    return conjunto
+
+def matriz_coincidencias(claves, procesos=None, progreso=None):
+    # claves: arreglos de enteros únicos; intersección ordenada por pares repartida por filas
+    n = len(claves)
+    matriz = np.zeros((n, n), dtype='int64')
+    unicas = []
+    for i, c in enumerate(claves):
+        if progreso is not None:
+            progreso(0.1 * i / n, f"claves de la sábana {i + 1} de {n}")
+        unicas.append(np.unique(c))
+        matriz[i, i] = len(unicas[-1])
+    claves = unicas
+
+    # progreso se llama tras cada par desde los hilos de las filas: si cancela, las filas en curso se
+    # detienen en su siguiente par y las que no empezaron ya no se ejecutan
+    total = max(n * (n - 1) // 2, 1)
+    hechos = count(1)
+
+    def fila(i):
+        valores = []
+        for j in range(i + 1, n):
+            valores.append(np.intersect1d(claves[i], claves[j], assume_unique=True).size)
+            if progreso is not None:
+                k = next(hechos)
+                progreso(0.1 + 0.9 * k / total, f"par {k:,} de {total:,}")
+        return i, valores
+
+    pool = ThreadPoolExecutor(max_workers=procesos)
+    try:
+        for i, valores in pool.map(fila, range(n)):
+            matriz[i, i + 1:] = valores
+            matriz[i + 1:, i] = valores
+    finally:
+        pool.shutdown(cancel_futures=True)
+    return matriz
+
+def analizar_multicruce(sabanas, procesos=None):
+    # sabanas: dict nombre -> DataFrame estandarizado
+    interlocutores = {n: conjunto_interlocutores(df) for n, df in sabanas.items()}
+    colocaciones = {n: conjunto_colocaciones(df) for n, df in sabanas.items()}
+    return matrices_multicruce(interlocutores, colocaciones, procesos)
+
+def matrices_multicruce(interlocutores, colocaciones, procesos=None, progreso=None):
+    nombres = list(interlocutores)
+    avisar = progreso or (lambda fraccion, texto: None)
+    matriz_int = matriz_coincidencias(
+        [interlocutores[n]['clave'].to_numpy() for n in nombres], procesos,
+        lambda fraccion, texto: avisar(0.5 * fraccion, f"interlocutores comunes: {texto}")
+    )
+    matriz_col = matriz_coincidencias(
+        [colocaciones[n]['clave'].to_numpy() for n in nombres], procesos,
+        lambda fraccion, texto: avisar(0.5 + 0.5 * fraccion, f"sitios-día compartidos: {texto}")
+    )
+
+    i, j = np.triu_indices(len(nombres), k=1)
+    pares = pd.DataFrame({
+        'sabana_1': [nombres[k] for k in i],
+        'sabana_2': [nombres[k] for k in j],
+        'interlocutores_comunes': matriz_int[i, j],
+        'colocaciones_mismo_dia': matriz_col[i, j],
+    }).sort_values(['interlocutores_comunes', 'colocaciones_mismo_dia'], ascending=False).reset_index(drop=True)
+
+    return {
+        'nombres': nombres,
+        'interlocutores': interlocutores,
+        'colocaciones': colocaciones,
+        'matriz_interlocutores': pd.DataFrame(matriz_int, index=nombres, columns=nombres),
+        'matriz_colocaciones': pd.DataFrame(matriz_col, index=nombres, columns=nombres),
+        'pares': pares,
+    }
+
+def detalle_multicruce(resultado, sabana_1, sabana_2):
+    # Contenido de una celda de las matrices: números comunes y sitios-día compartidos
+    int_1, int_2 = resultado['interlocutores'][sabana_1], resultado['interlocutores'][sabana_2]
+    numeros = int_1.merge(int_2[['clave', 'interacciones']], on='clave', suffixes=(f' {sabana_1}', f' {sabana_2}'))
+    numeros = numeros.drop(columns='clave')
+    numeros['total'] = numeros.iloc[:, 1] + numeros.iloc[:, 2]
+    numeros = numeros.sort_values('total', ascending=False).reset_index(drop=True)
+
+    col_1, col_2 = resultado['colocaciones'][sabana_1], resultado['colocaciones'][sabana_2]
+    sitios = col_1.merge(col_2[['clave', 'eventos']], on='clave', suffixes=(f' {sabana_1}', f' {sabana_2}'))
+    sitios = sitios.drop(columns='clave').sort_values('fecha').reset_index(drop=True)
+    return numeros, sitios
+
+# =========================
+# ÍNDICE DE NÚMEROS
+# =========================
+def columnas_identificador(df):
+    return [c for c in df.columns if 'linea' in c or 'imei' in c or 'imsi' in c]
+
+def construir_indice_numeros(df):
+    # Arreglo de sufijos sobre los valores únicos + lista invertida (valor -> filas) por columna
+    columnas = columnas_identificador(df)
+    codigos, valores = codificar_lineas(*[df[c] for c in columnas]) if columnas else (np.empty(0, dtype='int64'), np.empty(0, dtype=object))
+    valores = [str(v) for v in valores]
+
+    # Posiciones en int32 e ids de columna en int8: la lista invertida ocupa 5 bytes por celda en vez de 16
+    n = len(df)
+    filas = np.tile(np.arange(n, dtype='int32'), len(columnas))
+    col_ids = np.repeat(np.arange(len(columnas), dtype='int8' if len(columnas) < 128 else 'int16'), n)
+    validos = codigos >= 0
+    codigos, filas, col_ids = codigos[validos], filas[validos], col_ids[validos]
+    orden = np.argsort(codigos, kind='stable')
+    inicios = np.searchsorted(codigos[orden], np.arange(len(valores) + 1))
+
+    # Los valores van en un solo búfer separados por \0; cada sufijo es solo su desplazamiento (4 bytes)
+    texto = "\0".join(valores).encode('utf-8') + b"\0"
+    bytes_texto = np.frombuffer(texto, dtype='uint8')
+    tipo_posicion = 'int32' if len(texto) < 2**31 else 'int64'
+    sufijos = np.flatnonzero(bytes_texto != 0).astype(tipo_posicion)
+    comienzos = np.r_[0, np.flatnonzero(bytes_texto == 0)[:-1] + 1].astype(tipo_posicion)
+    # Orden por los primeros bytes de cada sufijo sin crear una cadena por sufijo: los bytes presentes se
+    # renumeran conservando su orden (\0 queda en 0) y los primeros que caben se empaquetan en una clave
+    # uint64 (16 dígitos); buscar_valores verifica a mano lo que exceda ese ancho
+    presentes = np.bincount(bytes_texto, minlength=256) > 0
+    bits = max(int(presentes.sum() - 1).bit_length(), 1)
+    ancho = min(max((len(v) for v in valores), default=1), 64 // bits)
+    simbolos = (np.cumsum(presentes) - 1).astype('uint8')[np.r_[bytes_texto, np.zeros(ancho, dtype='uint8')]]
+    claves = np.zeros(len(bytes_texto), dtype='uint64')
+    for j in range(ancho):
+        claves <<= np.uint64(bits)
+        claves |= simbolos[j:j + len(bytes_texto)]
+    sufijos = sufijos[np.argsort(claves[sufijos])]
+    claves = simbolos = None
+
+    return {
+        'columnas': columnas,
+        'total_filas': n,
+        'valores': np.array(valores, dtype=object),
+        'texto': texto,
+        'comienzos': comienzos,
+        'sufijos': sufijos,
+        'ancho_orden': ancho,
+        'filas': filas[orden],
+        'col_ids': col_ids[orden],
+        'inicios': inicios,
+    }
+
+def buscar_valores(indice, fragmento):
+    # Todo valor que contiene el fragmento tiene un sufijo que empieza por él: un rango contiguo.
+    # El orden solo está garantizado en los primeros bytes: se busca por ese prefijo y se verifica el resto.
+    texto, sufijos = indice['texto'], indice['sufijos']
+    buscado = fragmento.encode('utf-8')
+    prefijo = buscado[:indice['ancho_orden']]
+    largo = len(prefijo)
+    i = bisect.bisect_left(sufijos, prefijo, key=lambda p: texto[p:p + largo])
+    j = bisect.bisect_right(sufijos, prefijo, lo=i, key=lambda p: texto[p:p + largo])
+    encontrados = sufijos[i:j]
+    if len(buscado) > largo:
+        encontrados = np.array([p for p in encontrados if texto[p:p + len(buscado)] == buscado], dtype=sufijos.dtype)
+    duenos = np.searchsorted(indice['comienzos'], encontrados, side='right') - 1
+    return np.unique(duenos)
+
+def buscar_fragmentos(indice, fragmentos, columnas=None):
+    # Devuelve (posiciones de fila ordenadas, valores completos encontrados)
+    ids = [buscar_valores(indice, f) for f in fragmentos if f]
+    ids = np.unique(np.concatenate(ids)) if ids else np.empty(0, dtype='int64')
+    if len(ids) == 0:
+        return np.empty(0, dtype='int64'), []
+
+    inicios, fines = indice['inicios'][ids], indice['inicios'][ids + 1]
+    largos = fines - inicios
+    tramos = np.arange(largos.sum()) - np.repeat(np.cumsum(largos) - largos - inicios, largos)
+    if columnas is not None:
+        permitidas = np.isin(indice['columnas'], columnas)
+        tramos = tramos[permitidas[indice['col_ids'][tramos]]]
+
+    marcadas = np.zeros(indice['total_filas'], dtype=bool)
+    marcadas[indice['filas'][tramos]] = True
+    return np.flatnonzero(marcadas), list(indice['valores'][ids])
+
+# =========================
+# GRAFO DE COMUNICACIONES
+# =========================
+def construir_grafo(*dfs, vida_media_dias=30):
+    # Grafo no dirigido en CSR: nodos enteros, aristas con conteo, última fecha y peso que decae con la antigüedad
+    dfs = [df for df in dfs if 'linea a' in df.columns and 'linea b' in df.columns]
+    codigos, numeros = codificar_lineas(*[df['linea a'] for df in dfs], *[df['linea b'] for df in dfs])
+    numeros = np.asarray(numeros, dtype=object)
+    total = sum(len(df) for df in dfs)
+    cod_a, cod_b = codigos[:total].astype('int64'), codigos[total:].astype('int64')
+    momentos = np.concatenate([
+        pd.to_datetime(calcular_momento_evento(df)).to_numpy(dtype='datetime64[s]') for df in dfs
+    ]) if dfs else np.empty(0, dtype='datetime64[s]')
+
+    validos = (cod_a >= 0) & (cod_b >= 0) & (cod_a != cod_b)
+    desconocido = np.flatnonzero(numeros == 'DESCONOCIDO')
+    if len(desconocido):
+        validos &= (cod_a != desconocido[0]) & (cod_b != desconocido[0])
+    cod_a, cod_b, momentos = cod_a[validos], cod_b[validos], momentos[validos]
+
+    # Solo los números que participan en alguna arista, renumerados 0..N-1
+    usados = np.unique(np.concatenate([cod_a, cod_b]))
+    nodos = numeros[usados]
+    n = len(nodos)
+    cod_a, cod_b = np.searchsorted(usados, cod_a), np.searchsorted(usados, cod_b)
+
+    u, v = np.minimum(cod_a, cod_b), np.maximum(cod_a, cod_b)
+    claves, inverso = np.unique(u * n + v, return_inverse=True)
+    u, v = claves // n, claves % n
+    conteo = np.bincount(inverso, minlength=len(claves))
+
+    segundos = momentos.astype('int64').astype('float64')
+    segundos[np.isnat(momentos)] = -np.inf
+    ultimo = np.full(len(claves), -np.inf)
+    np.maximum.at(ultimo, inverso, segundos)
+    referencia = ultimo.max() if len(ultimo) else -np.inf
+    if np.isfinite(referencia):
+        edad_dias = np.where(np.isfinite(ultimo), (referencia - ultimo) / 86400.0, 0.0)
+    else:
+        edad_dias = np.zeros(len(claves))
+    peso = conteo * 0.5 ** (edad_dias / vida_media_dias)
+
+    # Cada arista se guarda en ambos sentidos, ordenada por nodo de origen
+    origen, destino = np.concatenate([u, v]), np.concatenate([v, u])
+    orden = np.argsort(origen, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(origen, minlength=n))])
+    ultimo = np.where(np.isfinite(ultimo), ultimo, np.nan)
+    return {
+        'nodos': nodos,
+        'posicion': pd.Index(nodos),
+        'indptr': indptr,
+        'indices': destino[orden],
+        'conteo': np.concatenate([conteo, conteo])[orden],
+        'peso': np.concatenate([peso, peso])[orden],
+        'ultimo': pd.to_datetime(np.concatenate([ultimo, ultimo])[orden], unit='s').to_numpy(),
+        'grado': np.diff(indptr),
+        'interacciones': np.bincount(origen, weights=np.concatenate([conteo, conteo]), minlength=n).astype('int64'),
+        'fuerza': np.bincount(origen, weights=np.concatenate([peso, peso]), minlength=n),
+        'aristas': len(claves),
+    }
+
+def nodo_de(grafo, numero):
+    pos = grafo['posicion'].get_indexer([str(numero).strip()])[0]
+    return None if pos < 0 else int(pos)
+
+def expandir_vecinos(grafo, nodos):
+    # (origen, destino, posición de arista) para todas las aristas que salen de 'nodos'
+    inicios, fines = grafo['indptr'][nodos], grafo['indptr'][nodos + 1]
+    largos = fines - inicios
+    posiciones = np.arange(largos.sum()) - np.repeat(np.cumsum(largos) - largos - inicios, largos)
+    return np.repeat(nodos, largos), grafo['indices'][posiciones], posiciones
+
+def vecindario(grafo, numero, saltos=2):
+    inicio = nodo_de(grafo, numero)
+    if inicio is None:
+        return pd.DataFrame(columns=['numero', 'salto', 'grado', 'interacciones'])
+    salto = np.full(len(grafo['nodos']), -1, dtype='int64')
+    salto[inicio] = 0
+    frontera = np.array([inicio])
+    for k in range(1, saltos + 1):
+        _, destinos, _ = expandir_vecinos(grafo, frontera)
+        frontera = np.unique(destinos[salto[destinos] < 0])
+        if len(frontera) == 0:
+            break
+        salto[frontera] = k
+    ids = np.flatnonzero(salto >= 0)
+    return pd.DataFrame({
+        'numero': grafo['nodos'][ids],
+        'salto': salto[ids],
+        'grado': grafo['grado'][ids],
+        'interacciones': grafo['interacciones'][ids],
+    }).sort_values(['salto', 'interacciones'], ascending=[True, False]).reset_index(drop=True)
+
+def ruta_mas_corta(grafo, origen, destino, max_saltos=8):
+    # Búsqueda en anchura por niveles; devuelve la cadena de números o None
+    a, b = nodo_de(grafo, origen), nodo_de(grafo, destino)
+    if a is None or b is None:
+        return None
+    padre = np.full(len(grafo['nodos']), -1, dtype='int64')
+    padre[a] = a
+    frontera = np.array([a])
+    for _ in range(max_saltos):
+        if padre[b] >= 0 or len(frontera) == 0:
+            break
+        origenes, destinos, _ = expandir_vecinos(grafo, frontera)
+        nuevos = padre[destinos] < 0
+        frontera, primero = np.unique(destinos[nuevos], return_index=True)
+        padre[frontera] = origenes[nuevos][primero]
+    if padre[b] < 0:
+        return None
+
+    cadena = [b]
+    while cadena[-1] != a:
+        cadena.append(int(padre[cadena[-1]]))
+    cadena.reverse()
+    contactos = [0]
+    for previo, actual in zip(cadena, cadena[1:]):
+        fila = slice(grafo['indptr'][previo], grafo['indptr'][previo + 1])
+        contactos.append(int(grafo['conteo'][fila][grafo['indices'][fila] == actual][0]))
+    return pd.DataFrame({'paso': range(len(cadena)), 'numero': grafo['nodos'][cadena], 'contactos_con_anterior': contactos})
+
+def centralidad(grafo, iteraciones=30, amortiguacion=0.85):
+    # PageRank ponderado por el peso de las aristas (producto matriz dispersa-vector con bincount)
+    n = len(grafo['nodos'])
+    if n == 0:
+        return np.empty(0)
+    origenes = np.repeat(np.arange(n), grafo['grado'])
+    transicion = grafo['peso'] / grafo['fuerza'][origenes]
+    rango = np.full(n, 1.0 / n)
+    for _ in range(iteraciones):
+        rango = (1 - amortiguacion) / n + amortiguacion * np.bincount(
+            grafo['indices'], weights=rango[origenes] * transicion, minlength=n
+        )
+    return rango
+
+def comunidades(grafo, iteraciones=10, semilla=0):
+    # Propagación de etiquetas ponderada; comunidad 0 = la más numerosa
+    n = len(grafo['nodos'])
+    etiqueta = np.arange(n, dtype='int64')
+    if n == 0:
+        return etiqueta
+    origenes = np.repeat(np.arange(n), grafo['grado'])
+    azar = np.random.default_rng(semilla)
+    for _ in range(iteraciones):
+        claves, inverso = np.unique(origenes * n + etiqueta[grafo['indices']], return_inverse=True)
+        suma = np.bincount(inverso, weights=grafo['peso'])
+        nodo, candidata = claves // n, claves % n
+        orden = np.lexsort((-suma, nodo))
+        primero = orden[np.r_[True, nodo[orden][1:] != nodo[orden][:-1]]]
+        mejor = etiqueta.copy()
+        mejor[nodo[primero]] = candidata[primero]
+        if np.array_equal(mejor, etiqueta):
+            break
+        # Actualización parcial para evitar oscilaciones entre vecinos
+        cambia = azar.random(n) < 0.5
+        etiqueta[cambia] = mejor[cambia]
+    _, etiqueta, tamanos = np.unique(etiqueta, return_inverse=True, return_counts=True)
+    rango = np.empty(len(tamanos), dtype='int64')
+    rango[np.argsort(-tamanos, kind='stable')] = np.arange(len(tamanos))
+    return rango[etiqueta]
+
+def tabla_centralidad(grafo, rango, comunidad):
+    return pd.DataFrame({
+        'numero': grafo['nodos'],
+        'grado': grafo['grado'],
+        'interacciones': grafo['interacciones'],
+        'fuerza': grafo['fuerza'].round(2),
+        'pagerank': rango,
+        'comunidad': comunidad,
+    }).sort_values('pagerank', ascending=False).reset_index(drop=True)
+
+def resumir_comunidades(grafo, rango, comunidad, principales=5, limite=200):
+    # Las comunidades vienen numeradas por tamaño: basta con las primeras 'limite'
+    orden = np.lexsort((-rango, comunidad))
+    ids, inicios, tamanos = np.unique(comunidad[orden], return_index=True, return_counts=True)
+    filas = []
+    for c, i, t in zip(ids[:limite], inicios[:limite], tamanos[:limite]):
+        miembros = orden[i:i + t]
+        filas.append({
+            'comunidad': int(c),
+            'miembros': int(t),
+            'interacciones': int(grafo['interacciones'][miembros].sum()),
+            'principales': ", ".join(grafo['nodos'][miembros[:principales]]),
+        })
+    return pd.DataFrame(filas)
+
+def subgrafo_visible(grafo, rango, comunidad, centro=None, saltos=2, max_nodos=200, max_aristas=800):
+    # Nivel de detalle: solo los nodos más centrales (o del vecindario del foco) y sus aristas más pesadas
+    n = len(grafo['nodos'])
+    if centro is not None and nodo_de(grafo, centro) is not None:
+        candidatos = grafo['posicion'].get_indexer(vecindario(grafo, centro, saltos)['numero'])
+        foco = nodo_de(grafo, centro)
+    else:
+        candidatos, foco = np.arange(n), None
+    candidatos = candidatos[np.argsort(-rango[candidatos], kind='stable')[:max_nodos]]
+    if foco is not None and foco not in candidatos:
+        candidatos = np.r_[foco, candidatos[:-1]]
+
+    visibles = np.zeros(n, dtype=bool)
+    visibles[candidatos] = True
+    origenes, destinos, posiciones = expandir_vecinos(grafo, np.sort(candidatos))
+    quedan = visibles[destinos] & (origenes < destinos)
+    origenes, destinos, posiciones = origenes[quedan], destinos[quedan], posiciones[quedan]
+    mejores = np.argsort(-grafo['peso'][posiciones], kind='stable')[:max_aristas]
+    origenes, destinos, posiciones = origenes[mejores], destinos[mejores], posiciones[mejores]
+
+    nodos = pd.DataFrame({
+        'id': candidatos,
+        'numero': grafo['nodos'][candidatos],
+        'grado': grafo['grado'][candidatos],
+        'interacciones': grafo['interacciones'][candidatos],
+        'pagerank': rango[candidatos],
+        'comunidad': comunidad[candidatos],
+        'foco': candidatos == foco if foco is not None else False,
+    })
+    aristas = pd.DataFrame({
+        'origen': origenes,
+        'destino': destinos,
+        'conteo': grafo['conteo'][posiciones],
+        'peso': grafo['peso'][posiciones],
+        'ultimo': grafo['ultimo'][posiciones],
+    })
+    return nodos, aristas
+
+PALETA_COMUNIDADES = ['#00ff88', '#ff4b4b', '#1f77b4', '#ffbf00', '#c77dff', '#00d4ff', '#ff8c42', '#9acd32', '#ff66c4', '#a0a0a0']
+
+def html_red(nodos, aristas, alto_px=600):
+    # Vista interactiva (vis-network): tamaño por PageRank, color por comunidad, grosor por peso
+    escala = nodos['pagerank'] / max(nodos['pagerank'].max(), 1e-12)
+    datos_nodos = [{
+        'id': int(fila.id),
+        'label': str(fila.numero),
+        'title': f"{fila.numero} | grado {fila.grado} | {fila.interacciones} interacciones | comunidad {fila.comunidad}",
+        'value': float(e),
+        'color': '#ffffff' if fila.foco else PALETA_COMUNIDADES[int(fila.comunidad) % len(PALETA_COMUNIDADES)],
+    } for fila, e in zip(nodos.itertuples(index=False), escala)]
+    ultimo = pd.to_datetime(aristas['ultimo']).dt.strftime('%Y-%m-%d').fillna('')
+    datos_aristas = [{
+        'from': int(a.origen),
+        'to': int(a.destino),
+        'value': float(np.log1p(a.peso)),
+        'title': f"{a.conteo} contactos | último {u}",
+    } for a, u in zip(aristas.itertuples(index=False), ultimo)]
+    return f"""
+    <div id="red" style="height:{alto_px}px; background:#0e1117; border:1px solid #333;"></div>
+    <script src="https://unpkg.com/vis-network@9.1.9/standalone/umd/vis-network.min.js"></script>
+    <script>
+      var red = new vis.Network(document.getElementById('red'), {{
+        nodes: new vis.DataSet({json_incrustable(datos_nodos)}),
+        edges: new vis.DataSet({json_incrustable(datos_aristas)})
+      }}, {{
+        nodes: {{shape: 'dot', scaling: {{min: 4, max: 30}}, font: {{color: '#ddd', size: 11}}}},
+        edges: {{color: {{color: '#555', highlight: '#00ff88'}}, scaling: {{min: 0.5, max: 6}}, smooth: false}},
+        physics: {{solver: 'barnesHut', stabilization: {{iterations: 150}}}},
+        interaction: {{hover: true, tooltipDelay: 100, hideEdgesOnDrag: true}}
+      }});
+      // Tras estabilizar se congela la física para que arrastrar y hacer zoom sea fluido
+      red.once('stabilizationIterationsDone', function () {{ red.setOptions({{physics: false}}); }});
+    </script>
+    """
+
+# =========================
+# TESELAS Y CUBOS ESPACIALES
+# =========================
+NIVEL_TESELA_BASE = 20
+NIVELES_TESELA = {
+    "Antena (z20 ≈ 35 m)": 20,
+    "Manzana (z17 ≈ 300 m)": 17,
+    "Barrio (z15 ≈ 1 km)": 15,
+    "Ciudad (z12 ≈ 9 km)": 12,
+}
+
+def teselas_xy(lat, lon, nivel=NIVEL_TESELA_BASE):
+    # Índices de tesela Web Mercator (los mismos que usan los mosaicos del mapa)
+    lat = np.clip(np.asarray(lat, dtype='float64'), -85.05112878, 85.05112878)
+    lon = np.asarray(lon, dtype='float64')
+    n = 2 ** nivel
+    x = np.floor((lon + 180.0) / 360.0 * n).astype('int64')
+    y = np.floor((1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * n).astype('int64')
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+def quadkey(x, y, nivel):
+    digitos = []
+    for i in range(nivel, 0, -1):
+        mascara = 1 << (i - 1)
+        digitos.append(str((1 if x & mascara else 0) + (2 if y & mascara else 0)))
+    return "".join(digitos)
+
+def construir_cubo_espacial(df):
+    # Hits por tesela base x día x hora del día, con sumas de coordenadas para el centroide real
+    columnas = ['x', 'y', 'dia', 'hora', 'hits', 'suma_lat', 'suma_lon']
+    if 'latitud' not in df.columns or 'longitud' not in df.columns:
+        return pd.DataFrame(columns=columnas)
+
+    lat = df['latitud'].to_numpy(dtype='float64', na_value=np.nan)
+    lon = df['longitud'].to_numpy(dtype='float64', na_value=np.nan)
+    validos = ~np.isnan(lat) & ~np.isnan(lon) & (lat != 0) & (lon != 0)
+    if not validos.any():
+        return pd.DataFrame(columns=columnas)
+
+    x, y = teselas_xy(lat[validos], lon[validos])
+    if 'momento' in df.columns:
+        momentos = df['momento'][validos]
+        dia = momentos.dt.normalize().to_numpy()
+        hora = np.where(mascara_hora_valida(df)[validos], momentos.dt.hour.fillna(-1), -1).astype('int8')
+    else:
+        dia = np.full(int(validos.sum()), np.datetime64('NaT'), dtype='datetime64[ns]')
+        hora = np.full(int(validos.sum()), -1, dtype='int8')
+
+    cubo = pd.DataFrame({
+        'x': x, 'y': y, 'dia': dia, 'hora': hora,
+        'lat': lat[validos], 'lon': lon[validos],
+    }).groupby(['x', 'y', 'dia', 'hora'], dropna=False).agg(
+        hits=('lat', 'size'), suma_lat=('lat', 'sum'), suma_lon=('lon', 'sum')
+    ).reset_index()
+    return cubo[columnas]
+
+def filtrar_cubo(cubo, f_inicio=None, f_fin=None, ventana=None):
+    if f_inicio is not None and f_fin is not None:
+        cubo = cubo[(cubo['dia'] >= pd.Timestamp(f_inicio)) & (cubo['dia'] <= pd.Timestamp(f_fin))]
+    if ventana is not None:
+        cubo = cubo[horas_en_ventana(cubo['hora'].to_numpy(), *ventana)]
+    return cubo
+
+def agregar_cubo(cubo, nivel=NIVEL_TESELA_BASE):
+    # Agregado a cualquier nivel <= base desplazando bits: las teselas padre contienen a sus hijas
+    desplazamiento = NIVEL_TESELA_BASE - nivel
+    agregado = cubo.assign(
+        x=cubo['x'].to_numpy() >> desplazamiento, y=cubo['y'].to_numpy() >> desplazamiento
+    ).groupby(['x', 'y']).agg(
+        hits=('hits', 'sum'), suma_lat=('suma_lat', 'sum'), suma_lon=('suma_lon', 'sum'),
+        dias_activos=('dia', 'nunique')
+    ).reset_index()
+
+    agregado['latitud'] = (agregado['suma_lat'] / agregado['hits']).round(6)
+    agregado['longitud'] = (agregado['suma_lon'] / agregado['hits']).round(6)
+    agregado = agregado.sort_values('hits', ascending=False, kind='stable').reset_index(drop=True)
+    return agregado[['x', 'y', 'latitud', 'longitud', 'hits', 'dias_activos']]
+
+def top_antenas(agregado, nivel, limite=15):
+    tabla = agregado.head(limite).copy()
+    tabla.insert(0, 'celda', [quadkey(x, y, nivel) for x, y in zip(tabla['x'], tabla['y'])])
+    return tabla.drop(columns=['x', 'y'])
+
+# =========================
+# CAPA LIGERA DEL MAPA
+# =========================
+CAMPOS_POPUP = ['fecha', 'hora', 'tipo', 'linea a', 'linea b']
+CODIGO_ALERTA = {'BASE': 0, 'ALERTA': 1, 'CRUCIAL': 2}
+
+JS_CALLBACK_PUNTOS = """
+(function () {
+    var dic = %(diccionarios)s;
+    var espejos = %(espejos)s;
+    var campos = %(campos)s;
+    var colores = ["#00ff88", "orange", "red"];
+    var banners = ["#28a745", "#ffc107", "#dc3545"];
+    var titulos = ["REGISTRO TELEFÓNICO", "⏳ CRUCE: MISMO LUGAR/DIF. DÍA", "💥 CRUCE: MISMO LUGAR/DÍA"];
+    var lienzo = L.canvas({padding: 0.5});
+
+    function esc(v) {
+        return String(v).replace(/[&<>"']/g, function (c) {
+            return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"}[c];
+        });
+    }
+    function valor(row, k) {
+        var c = row[4 + k];
+        return c < 0 ? "N/A" : esc(dic[campos[k]][c]);
+    }
+    function bloque(f, h, t, a, b, geo) {
+        return "<b>F:</b> " + f + "<br><b>H:</b> " + h + "<br><b>TIPO:</b> " + t +
+            "<br><b>A:</b> " + a + "<br><b>B:</b> " + b + "<br><b>GEO:</b> " + geo + "<br>";
+    }
+    function popup(row) {
+        var alerta = row[2];
+        var html = '<div style="font-family: monospace; min-width: 410px; color: #000; font-size: 11px;">' +
+            '<div style="background-color: ' + banners[alerta] + '; color: ' + (alerta === 1 ? "#000" : "#fff") +
+            '; padding: 6px; text-align: center; font-weight: bold; border-radius: 4px; font-size: 12px; margin-bottom: 8px;">' +
+            titulos[alerta] + '</div>';
+        var geo = row[0] + ", " + row[1];
+        if (row[3] >= 0) {
+            var e = espejos[row[3]].map(esc);
+            html += '<div style="display: flex; gap: 10px;">' +
+                '<div style="flex: 1; background: #f8f9fa; padding: 6px; border-radius: 4px; border-left: 3px solid #00ff88;">' +
+                '<b style="color: #111;">📄 ALFA (S1)</b><hr style="margin: 4px 0; border: 0; border-top: 1px solid #ccc;">' +
+                bloque(valor(row, 0), valor(row, 1), valor(row, 2), valor(row, 3), valor(row, 4), geo) + '</div>' +
+                '<div style="flex: 1; background: #fdf3f3; padding: 6px; border-radius: 4px; border-left: 3px solid ' + banners[alerta] + ';">' +
+                '<b style="color: #111;">📑 BRAVO (S2)</b><hr style="margin: 4px 0; border: 0; border-top: 1px solid #ccc;">' +
+                bloque(e[0], e[1], e[2], e[3], e[4], e[5] + ", " + e[6]) + '</div></div>';
+        } else {
+            html += '<div style="background: #f8f9fa; padding: 8px; border-radius: 4px;">' +
+                '<b>Fecha:</b> ' + valor(row, 0) + '<br><b>Hora:</b> ' + valor(row, 1) +
+                '<br><b>Tipo:</b> ' + valor(row, 2) + '<br><b>Línea A:</b> ' + valor(row, 3) +
+                '<br><b>Línea B:</b> ' + valor(row, 4) + '<br><b>Coordenadas:</b> ' + geo + '</div>';
+        }
+        return html + '</div>';
+    }
+
+    return function (row) {
+        var marcador = L.circleMarker([row[0], row[1]], {
+            radius: 5, color: colores[row[2]], fill: true, fillOpacity: 0.7, renderer: lienzo
+        });
+        marcador.bindPopup(function () { return popup(row); }, {maxWidth: 460});
+        return marcador;
+    };
+})()
+"""
+
+class CapaPuntosSabana(FastMarkerCluster):
+    # FastMarkerCluster con alta masiva (addLayers + chunkedLoading) y filas ya validadas
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                {{ this.callback }}
+
+                var data = {{ this.data|tojson }};
+                var cluster = L.markerClusterGroup({{ this.options|tojavascript }});
+                var marcadores = new Array(data.length);
+                for (var i = 0; i < data.length; i++) {
+                    marcadores[i] = callback(data[i]);
+                }
+                cluster.addLayers(marcadores);
+                cluster.addTo({{ this._parent.get_name() }});
+                return cluster;
+            })();
+        {% endmacro %}""")
+
+    def __init__(self, filas, callback, **kwargs):
+        super().__init__([], callback=callback, **kwargs)
+        self._name = "CapaPuntosSabana"
+        self.data = filas
+
+def payload_capa_puntos(df_m, etiquetas_cruce=None, df_ref=None):
+    # Un único payload compacto: filas [lat, lon, alerta, espejo, códigos...] + diccionarios de valores
+    n = len(df_m)
+    diccionarios = {}
+    columnas = []
+    for campo in CAMPOS_POPUP:
+        if campo in df_m.columns:
+            codigos, unicos = pd.factorize(df_m[campo].astype(object))
+            diccionarios[campo] = [str(u) for u in unicos]
+        else:
+            codigos = np.full(n, -1)
+            diccionarios[campo] = []
+        columnas.append(codigos.tolist())
+
+    alerta = np.zeros(n, dtype='int64')
+    espejo = np.full(n, -1)
+    espejos = []
+    if etiquetas_cruce is not None and df_ref is not None:
+        alerta = etiquetas_cruce['tipo_alerta'].map(CODIGO_ALERTA).fillna(0).astype('int64').to_numpy()
+        pos = etiquetas_cruce['pos_espejo'].to_numpy()
+        con_espejo = pos >= 0
+        if con_espejo.any():
+            codigos, unicos = pd.factorize(pos[con_espejo])
+            espejo[con_espejo] = codigos
+            registros = df_ref.iloc[unicos]
+            for _, reg in registros.iterrows():
+                espejos.append(
+                    [str(reg.get(c, 'N/A')) for c in CAMPOS_POPUP] +
+                    [str(round(float(reg[c]), 5)) for c in ['latitud', 'longitud']]
+                )
+
+    filas = list(zip(
+        # float32 solo conserva ~5 decimales en grados; más dígitos son ruido en el payload
+        df_m['latitud'].astype('float64').round(5).tolist(),
+        df_m['longitud'].astype('float64').round(5).tolist(),
+        alerta.tolist(),
+        espejo.tolist(),
+        *columnas
+    ))
+
+    return filas, diccionarios, espejos
+
+ESCAPES_SCRIPT = {ord('<'): '\\u003c', ord('>'): '\\u003e', ord('&'): '\\u0026'}
+
+def json_incrustable(valor):
+    # Valores de la sábana dentro de <script>: sin "<", ">" ni "&" literales no pueden cerrar
+    # la etiqueta ("</script>") ni abrir comentarios ("<!--"); JSON.parse y JS los leen igual
+    return json.dumps(valor, ensure_ascii=False, separators=(',', ':')).translate(ESCAPES_SCRIPT)
+
+def callback_capa_puntos(diccionarios, espejos):
+    return JS_CALLBACK_PUNTOS % {
+        'diccionarios': json_incrustable(diccionarios),
+        'espejos': json_incrustable(espejos),
+        'campos': json.dumps(CAMPOS_POPUP),
+    }
+
+def preparar_capa_puntos(df_m, etiquetas_cruce=None, df_ref=None):
+    filas, diccionarios, espejos = payload_capa_puntos(df_m, etiquetas_cruce, df_ref)
+    callback = callback_capa_puntos(diccionarios, espejos)
+    return CapaPuntosSabana(
+        filas, callback,
+        disableClusteringAtZoom=17, maxClusterRadius=50, chunkedLoading=True
+    )
+
+# =========================
+# MAPA TÁCTICO
+# =========================
+FIRMA_MAPA = "PROP. J-I-A-M / FORENSIC SYSTEM"
+
+def puntos_mapeables(df):
+    df_m = df.dropna(subset=['latitud', 'longitud'])
+    return df_m[(df_m['latitud'] != 0) & (df_m['longitud'] != 0)]
+
+def construir_mapa(df_m, etiquetas_cruce=None, df_ref=None, ligero=True, agregado_antenas=None):
+    m = folium.Map(
+        location=[df_m['latitud'].mean(), df_m['longitud'].mean()],
+        zoom_start=11,
+        tiles="OpenStreetMap"
+    )
+    cruce_activo = etiquetas_cruce is not None and df_ref is not None
+
+    if ligero:
+        preparar_capa_puntos(
+            df_m,
+            etiquetas_cruce if cruce_activo else None,
+            df_ref if cruce_activo else None
+        ).add_to(m)
+    else:
+        cluster = MarkerCluster(disableClusteringAtZoom=17, maxClusterRadius=50).add_to(m)
+
+        titulos_alerta = {
+            "CRUCIAL": ("red", "💥 CRUCE: MISMO LUGAR/DÍA"),
+            "ALERTA": ("orange", "⏳ CRUCE: MISMO LUGAR/DIF. DÍA"),
+        }
+
+        for i, (_, r) in enumerate(df_m.iterrows()):
+            color_punto = "#00ff88"  
+            tipo_alerta = "BASE"
+            titulo_alerta = "REGISTRO TELEFÓNICO"
+            reg_espejo_dict = None
+
+            if cruce_activo:
+                tipo_alerta = etiquetas_cruce['tipo_alerta'].iat[i]
+                if tipo_alerta in titulos_alerta:
+                    color_punto, titulo_alerta = titulos_alerta[tipo_alerta]
+                    reg_espejo_dict = df_ref.iloc[etiquetas_cruce['pos_espejo'].iat[i]].to_dict()
+
+            popup_html = generar_html_popup_comparativo(r.to_dict(), reg_espejo_dict, tipo_alerta, titulo_alerta)
+        
+            iframe = folium.IFrame(popup_html, width=420, height=175)
+            popup_obj = folium.Popup(iframe, parse_html=True)
+
+            folium.CircleMarker(
+                location=[r['latitud'], r['longitud']],
+                radius=5,
+                color=color_punto,
+                fill=True,
+                fill_opacity=0.7,
+                popup=popup_obj
+            ).add_to(cluster)
+
+    if agregado_antenas is not None and not agregado_antenas.empty:
+        HeatMap(
+            agregado_antenas[['latitud', 'longitud', 'hits']].to_numpy().tolist(),
+            name="🔥 Densidad de actividad",
+            radius=18,
+            blur=14,
+        ).add_to(m)
+        folium.LayerControl(collapsed=True).add_to(m)
+
+    aplicar_marca_agua_mapa(m, FIRMA_MAPA)
+    return m
+
+# =========================
+# EXPORTACIÓN DE RESULTADOS
+# =========================
+FILAS_EXPORTACION_BLOQUE = 50000
+LIMITE_FILAS_EXCEL = 1048575  # filas de datos por hoja (la primera es el encabezado)
+FORMATOS_EXPORTACION = {
+    'Excel (.xlsx)': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'CSV': ('csv', 'text/csv'),
+}
+
+def bloques_exportacion(df, inicio=0, fin=None, filas_por_bloque=FILAS_EXPORTACION_BLOQUE):
+    fin = len(df) if fin is None else fin
+    for desde in range(inicio, fin, filas_por_bloque):
+        yield df.iloc[desde:min(desde + filas_por_bloque, fin)]
+
+def columnas_legibles(bloque):
+    # float32 solo conserva ~5 decimales en grados: se redondea para no exportar ruido (19.40999984741211)
+    flotantes = bloque.select_dtypes('float32').columns
+    if len(flotantes):
+        bloque = bloque.astype({c: 'float64' for c in flotantes}).round({c: 5 for c in flotantes})
+    return bloque
+
+def filas_exportables(bloque):
+    # Valores nativos por fila: NaN/NaT -> celda vacía, categorías -> texto
+    bloque = columnas_legibles(bloque).astype(object)
+    return bloque.where(bloque.notna(), None).itertuples(index=False, name=None)
+
+def exportar_excel(tablas, destino):
+    # constant_memory: cada fila se vuelca a disco al escribirse; una hoja por tabla (y por millón de filas)
+    libro = xlsxwriter.Workbook(destino, {
+        'constant_memory': True,
+        'remove_timezone': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+    })
+    encabezado = libro.add_format({'bold': True})
+    for nombre, df in tablas.items():
+        for parte, inicio in enumerate(range(0, max(len(df), 1), LIMITE_FILAS_EXCEL)):
+            hoja = libro.add_worksheet(nombre[:31] if parte == 0 else f"{nombre[:25]} ({parte + 1})")
+            hoja.write_row(0, 0, [str(c) for c in df.columns], encabezado)
+            fila = 1
+            for bloque in bloques_exportacion(df, inicio, min(inicio + LIMITE_FILAS_EXCEL, len(df))):
+                for valores in filas_exportables(bloque):
+                    hoja.write_row(fila, 0, valores)
+                    fila += 1
+    libro.close()
+
+def exportar_csv(df, destino):
+    texto = io.TextIOWrapper(destino, encoding='utf-8', newline='', write_through=True)
+    df.iloc[:0].to_csv(texto, index=False)
+    for bloque in bloques_exportacion(df):
+        columnas_legibles(bloque).to_csv(texto, index=False, header=False)
+    texto.detach()
+
+def esquema_exportacion(df):
+    esquema = pa.Schema.from_pandas(df.iloc[:FILAS_EXPORTACION_BLOQUE], preserve_index=False)
+    # Columnas vacías en la muestra: se declaran como texto para que los bloques siguientes encajen
+    return pa.schema(
+        [pa.field(c.name, pa.string()) if pa.types.is_null(c.type) else c for c in esquema],
+        metadata=esquema.metadata
+    )
+
+def exportar_parquet(df, destino):
+    esquema = esquema_exportacion(df)
+    with pq.ParquetWriter(destino, esquema) as escritor:
+        for bloque in bloques_exportacion(df):
+            escritor.write_table(pa.Table.from_pandas(bloque, schema=esquema, preserve_index=False))
+
+EXPORTADORES = {'csv': exportar_csv, 'parquet': exportar_parquet}
+
+def exportar_resultados(tablas, formato):
+    # tablas: dict nombre -> DataFrame (o función que lo calcula al exportar).
+    # Se escribe por bloques en un temporal de disco y se devuelve abierto, listo para leer.
+    tablas = {nombre: tabla() if callable(tabla) else tabla for nombre, tabla in tablas.items()}
+    destino = tempfile.TemporaryFile()
+    if formato == 'xlsx':
+        exportar_excel(tablas, destino)
+    elif len(tablas) == 1:
+        EXPORTADORES[formato](next(iter(tablas.values())), destino)
+    else:
+        # Varias tablas en CSV/Parquet: un ZIP con un archivo por tabla
+        with zipfile.ZipFile(destino, 'w', zipfile.ZIP_DEFLATED) as paquete:
+            for nombre, df in tablas.items():
+                with tempfile.TemporaryFile() as parte:
+                    EXPORTADORES[formato](df, parte)
+                    parte.seek(0)
+                    with paquete.open(f"{nombre}.{formato}", 'w', force_zip64=True) as salida:
+                        shutil.copyfileobj(parte, salida)
+    destino.seek(0)
+    # Lector de solo lectura sobre el temporal (se borra al cerrarlo): es lo que aceptan las descargas diferidas
+    return io.BufferedReader(destino)
+
+def extension_exportacion(formato, n_tablas):
+    return formato if formato == 'xlsx' or n_tablas == 1 else 'zip'
+
+PLANTILLA_MAPA_COMPACTO = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>__TITULO__</title>
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css">
+<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.css">
+<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.Default.css">
+<script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+<script src="https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/leaflet.markercluster.js"></script>
+<script src="https://cdn.jsdelivr.net/gh/python-visualization/folium@main/folium/templates/leaflet_heat.min.js"></script>
+<style>html, body, #mapa { height: 100%; margin: 0; }</style>
+</head>
+<body>
+<div id="mapa"></div>
+__MARCA__
+<script type="application/json" id="datos">__DATOS__</script>
+<script>
+var datos = JSON.parse(document.getElementById("datos").textContent);
+var mapa = L.map("mapa").setView(datos.centro, 11);
+L.tileLayer("https://tile.openstreetmap.org/{z}/{x}/{y}.png", {
+    maxZoom: 19, attribution: "&copy; OpenStreetMap contributors"
+}).addTo(mapa);
+var callback = __CALLBACK__;
+var cluster = L.markerClusterGroup({disableClusteringAtZoom: 17, maxClusterRadius: 50, chunkedLoading: true});
+cluster.addLayers(datos.filas.map(callback));
+mapa.addLayer(cluster);
+if (datos.calor.length) {
+    L.control.layers(null, {"🔥 Densidad de actividad": L.heatLayer(datos.calor, {radius: 18, blur: 14}).addTo(mapa)}).addTo(mapa);
+}
+</script>
+</body>
+</html>
+"""
+
+def html_mapa_compacto(df_m, etiquetas_cruce=None, df_ref=None, agregado_antenas=None, titulo="MAPA TÁCTICO"):
+    # Plantilla fija + payload de la capa ligera: sin el andamiaje de folium ni un popup HTML por punto
+    filas, diccionarios, espejos = payload_capa_puntos(df_m, etiquetas_cruce, df_ref)
+    calor = []
+    if agregado_antenas is not None and not agregado_antenas.empty:
+        calor = agregado_antenas[['latitud', 'longitud', 'hits']].astype('float64').round(5).to_numpy().tolist()
+    datos = {
+        'centro': [round(float(df_m['latitud'].mean()), 5), round(float(df_m['longitud'].mean()), 5)],
+        'filas': filas,
+        'calor': calor,
+    }
+    return (PLANTILLA_MAPA_COMPACTO
+            .replace('__TITULO__', html.escape(titulo))
+            .replace('__MARCA__', html_marca_agua(FIRMA_MAPA))
+            .replace('__CALLBACK__', callback_capa_puntos(diccionarios, espejos).strip())
+            .replace('__DATOS__', json_incrustable(datos)))
+
+# =========================
+# TAREAS EN SEGUNDO PLANO
+# =========================
+TRABAJADORES_TAREAS = int(os.environ.get("SABANAS_TRABAJADORES", "4"))
+MAX_TAREAS = int(os.environ.get("SABANAS_TAREAS_MAX", "32"))
+FILAS_RANKING_PROGRESIVO = 200000
+PUNTOS_MAPA_PROGRESIVO = 20000
+MUESTRA_PARCIAL = 5000
+ESTADOS_ACTIVOS = ('en cola', 'en curso')
+
+class TareaCancelada(Exception):
+    pass
+
+def crear_planificador(trabajadores=TRABAJADORES_TAREAS, max_tareas=MAX_TAREAS):
+    # Un pool de hilos compartido; numpy, pandas y pyarrow liberan el GIL en el trabajo pesado
+    return {
+        'pool': ThreadPoolExecutor(max_workers=trabajadores, thread_name_prefix="sabanas"),
+        'tareas': OrderedDict(),
+        'lock': threading.Lock(),
+        'max_tareas': max_tareas,
+    }
+
+def clave_tarea(*partes):
+    # La clave identifica expediente + parámetros: la misma petición reutiliza la misma tarea
+    return hashlib.sha1(json.dumps(partes, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def reportar(tarea, fraccion=None, texto=None, parcial=None):
+    # Punto de control del trabajador: publica el avance y atiende la cancelación
+    if tarea['cancelar'].is_set():
+        raise TareaCancelada()
+    if fraccion is not None:
+        tarea['progreso'] = min(max(float(fraccion), 0.0), 1.0)
+    if texto is not None:
+        tarea['texto'] = texto
+    if parcial is not None:
+        tarea['parcial'] = parcial
+
+def podar_tareas(planificador):
+    # Se descartan las tareas terminadas menos usadas; las activas nunca se tocan
+    tareas = planificador['tareas']
+    sobrantes = len(tareas) - planificador['max_tareas']
+    for clave in list(tareas):
+        if sobrantes <= 0:
+            break
+        if tareas[clave]['estado'] not in ESTADOS_ACTIVOS:
+            del tareas[clave]
+            sobrantes -= 1
+
+def iniciar_perfil():
+    # cProfile solo ve el hilo que lo activa: cada tarea perfilada lleva el suyo.
+    # Desde Python 3.12 el perfilador es global y no admite dos a la vez; entonces no se perfila.
+    perfilador = cProfile.Profile()
+    try:
+        perfilador.enable()
+    except ValueError:
+        return None
+    return perfilador
+
+def ejecutar_tarea(tarea, funcion, args, kwargs):
+    # La telemetría y el perfil se toman aquí, en el hilo que hace el trabajo, no en la espera de la página
+    tarea['estado'] = 'en curso'
+    tarea['inicio'] = time.time()
+    traza = tarea['traza'] = nueva_traza(tarea['sesion'], tarea=tarea['descripcion'], clave=tarea['clave'])
+    entrada = next((a for a in args if isinstance(a, pd.DataFrame)), None)
+    perfilador = iniciar_perfil() if tarea['perfilar'] else None
+    error = None
+    try:
+        with etapa(traza, funcion.__name__, entrada) as e:
+            reportar(tarea)
+            tarea['resultado'] = e['salida'] = funcion(tarea, *args, **kwargs)
+        tarea['progreso'] = 1.0
+        tarea['estado'] = 'terminada'
+    except TareaCancelada:
+        tarea['estado'] = 'cancelada'
+    except Exception as e:
+        error = tarea['error'] = f"{type(e).__name__}: {e}"
+        tarea['detalle'] = traceback.format_exc()
+        tarea['estado'] = 'error'
+    finally:
+        if perfilador is not None:
+            perfilador.disable()
+            tarea['perfil'] = perfilador
+        tarea['fin'] = time.time()
+        if tarea['estado'] == 'terminada':
+            tarea['parcial'] = None
+        cerrar_traza(traza, error)
+
+def enviar_tarea(planificador, clave, funcion, *args, descripcion="", reintentar=False, perfilar=False, sesion=None, **kwargs):
+    # funcion(tarea, *args, **kwargs) se ejecuta una sola vez por clave: las peticiones repetidas
+    # recuperan la tarea en curso o su resultado. Una tarea ya inactiva solo se relanza si se pide.
+    with planificador['lock']:
+        tarea = planificador['tareas'].get(clave)
+        if tarea is not None and not (reintentar and tarea['estado'] not in ESTADOS_ACTIVOS):
+            planificador['tareas'].move_to_end(clave)
+            tarea['ultimo_uso'] = time.time()
+            return tarea
+        tarea = {
+            'clave': clave,
+            'descripcion': descripcion,
+            'estado': 'en cola',
+            'progreso': 0.0,
+            'texto': "",
+            'parcial': None,
+            'resultado': None,
+            'error': None,
+            'detalle': None,
+            'cancelar': threading.Event(),
+            'creada': time.time(),
+            'inicio': None,
+            'fin': None,
+            'ultimo_uso': time.time(),
+            'sesion': sesion,
+            'perfilar': perfilar,
+            'traza': None,
+            'perfil': None,
+        }
+        planificador['tareas'][clave] = tarea
+        podar_tareas(planificador)
+        tarea['futuro'] = planificador['pool'].submit(ejecutar_tarea, tarea, funcion, args, kwargs)
+    return tarea
+
+def esperar_tarea(tarea, segundos=None):
+    # True si la tarea ya no está activa (terminada, cancelada o con error)
+    try:
+        tarea['futuro'].result(timeout=segundos)
+    except FuturesTimeout:
+        pass
+    return tarea['estado'] not in ESTADOS_ACTIVOS
+
+def cancelar_tarea(tarea):
+    tarea['cancelar'].set()
+    # Si aún no empezó, no llega a ejecutarse
+    if tarea['futuro'].cancel():
+        tarea['estado'] = 'cancelada'
+        tarea['fin'] = time.time()
+
+def resumen_tareas(planificador):
+    ahora = time.time()
+    with planificador['lock']:
+        tareas = list(planificador['tareas'].values())
+    return pd.DataFrame([{
+        'tarea': t['descripcion'],
+        'clave': t['clave'],
+        'estado': t['estado'],
+        'progreso': round(t['progreso'] * 100),
+        'segundos': round((t['fin'] or ahora) - t['inicio'], 2) if t['inicio'] else None,
+        'ultimo_uso': datetime.fromtimestamp(t['ultimo_uso']).strftime('%H:%M:%S'),
+        'error': t['error'],
+    } for t in tareas], columns=['tarea', 'clave', 'estado', 'progreso', 'segundos', 'ultimo_uso', 'error'])
+
+def muestra_uniforme(n, tamano):
+    # Posiciones repartidas por todo el rango para que el avance parcial sea representativo
+    return np.unique(np.linspace(0, n - 1, min(n, tamano)).astype('int64'))
+
+def tarea_ingesta(tarea, archivos):
+    # El contenido puede llegar diferido (una función que lo devuelve): solo se lee si la tarea llega a correr
+    archivos = [(nombre, contenido() if callable(contenido) else contenido) for nombre, contenido in archivos]
+    return ingestar_archivos(archivos, lambda fraccion, texto: reportar(tarea, fraccion, texto))
+
+def tarea_ranking(tarea, df, principales=50):
+    # En selecciones grandes se publica primero un ranking sobre una muestra uniforme
+    if len(df) > FILAS_RANKING_PROGRESIVO:
+        muestra = df.iloc[muestra_uniforme(len(df), len(df) // 10)]
+        reportar(tarea, 0.1, "ranking preliminar sobre una muestra del 10%",
+                 ordenar_por_frecuencia_interacciones(muestra).head(principales))
+    reportar(tarea, 0.2, f"ranking completo de {len(df):,} registros")
+    return ordenar_por_frecuencia_interacciones(
+        df, lambda fraccion, texto: reportar(tarea, 0.2 + 0.8 * fraccion, f"ranking completo: {texto}")
+    )
+
+def tarea_cruce_ubicaciones(tarea, df_m, df_ref, tolerancia_m=0):
+    reportar(tarea, 0.0, f"cruzando {len(df_m):,} puntos contra {len(df_ref):,} registros")
+    return cruzar_ubicaciones(df_m, df_ref, tolerancia_m, lambda fraccion, texto: reportar(tarea, fraccion, texto))
+
+def tarea_multicruce(tarea, sabanas):
+    # sabanas: nombre -> huella (o el DataFrame que ya está en memoria). Cada sábana se lee, se reduce a
+    # sus conjuntos de claves y se libera antes de la siguiente: la tarea nunca retiene más de una
+    interlocutores, colocaciones = {}, {}
+    for i, (nombre, sabana) in enumerate(sabanas.items()):
+        reportar(tarea, i / (len(sabanas) + 1), f"conjuntos de {nombre}")
+        df = leer_expediente(sabana, COLUMNAS_MULTICRUCE) if isinstance(sabana, str) else sabana
+        if df is None:
+            raise FileNotFoundError(f"La sábana {nombre} ya no está en la caché local; vuelva a cargar el archivo.")
+        interlocutores[nombre] = conjunto_interlocutores(df)
+        colocaciones[nombre] = conjunto_colocaciones(df)
+        df = None
+    inicio = len(sabanas) / (len(sabanas) + 1)
+    reportar(tarea, inicio, "matrices de coincidencia")
+    return matrices_multicruce(
+        interlocutores, colocaciones,
+        progreso=lambda fraccion, texto: reportar(tarea, inicio + (1 - inicio) * fraccion, texto)
+    )
+
+def tarea_mapa(tarea, df_m, etiquetas_cruce=None, df_ref=None, ligero=True, agregado_antenas=None):
+    # Devuelve el HTML ya renderizado; con muchos puntos se publica antes un mapa de muestra
+    if len(df_m) > PUNTOS_MAPA_PROGRESIVO:
+        posiciones = muestra_uniforme(len(df_m), MUESTRA_PARCIAL)
+        muestra = construir_mapa(
+            df_m.iloc[posiciones],
+            etiquetas_cruce.iloc[posiciones] if etiquetas_cruce is not None else None,
+            df_ref, ligero, agregado_antenas
+        )
+        reportar(tarea, 0.2, f"vista previa con {len(posiciones):,} de {len(df_m):,} puntos", muestra.get_root().render())
+    reportar(tarea, 0.3, f"construyendo el mapa con {len(df_m):,} puntos")
+    m = construir_mapa(df_m, etiquetas_cruce, df_ref, ligero, agregado_antenas)
+    reportar(tarea, 0.8, "renderizando el mapa")
+    return m.get_root().render()
+
+# =========================
+# PROCESAMIENTO POR LOTES
+# =========================
+EXTENSIONES_SABANA = ('.xlsx', '.xls', '.csv')
+
+def configurar_cache(dir_cache):
+    global DIR_CACHE_SABANAS
+    DIR_CACHE_SABANAS = dir_cache
+
+def leer_archivo(ruta):
+    with open(ruta, 'rb') as f:
+        return os.path.basename(ruta), f.read()
+
+def nombre_sabana(ruta):
+    return os.path.splitext(os.path.basename(ruta))[0]
+
+def procesar_sabana(ruta, dir_salida):
+    nombre = nombre_sabana(ruta)
+    huella = ingestar_archivos([leer_archivo(ruta)])
+    df = leer_expediente(huella)
+    carpeta = os.path.join(dir_salida, nombre)
+    os.makedirs(carpeta, exist_ok=True)
+
+    contactos = ordenar_por_frecuencia_interacciones(df)
+    contactos.to_csv(os.path.join(carpeta, 'contactos.csv'), index=False)
+
+    agregado = agregar_cubo(construir_cubo_espacial(df))
+    antenas = top_antenas(agregado, NIVEL_TESELA_BASE, limite=len(agregado))
+    antenas.to_csv(os.path.join(carpeta, 'antenas.csv'), index=False)
+
+    df_m = puntos_mapeables(df)
+    if not df_m.empty:
+        construir_mapa(df_m, agregado_antenas=agregado).save(os.path.join(carpeta, 'mapa.html'))
+
+    return {
+        'sabana': nombre,
+        'huella': huella,
+        'registros': len(df),
+        'puntos_mapa': len(df_m),
+        'interlocutores': len(contactos),
+        'antenas': len(antenas),
+    }
+
+def procesar_cruce(sabana_1, sabana_2, dir_salida, tolerancia_m=0):
+    # sabana_n: dict devuelto por procesar_sabana (se relee el Parquet por huella, no el Excel)
+    df1 = leer_expediente(sabana_1['huella'])
+    df2 = leer_expediente(sabana_2['huella'])
+    carpeta = os.path.join(dir_salida, 'cruces')
+    os.makedirs(carpeta, exist_ok=True)
+    prefijo = os.path.join(carpeta, f"{sabana_1['sabana']}__{sabana_2['sabana']}")
+
+    comunes = sorted(numeros_comunes(df1, df2))
+    pd.DataFrame({'numero_comun': comunes}).to_csv(f"{prefijo}_numeros_comunes.csv", index=False)
+
+    df_m = puntos_mapeables(df1)
+    etiquetas, pares = cruzar_ubicaciones(df_m, df2, tolerancia_m)
+    pares.to_csv(f"{prefijo}_pares_ubicacion.csv", index=False)
+    if not df_m.empty and not pares.empty:
+        construir_mapa(df_m, etiquetas, df2).save(f"{prefijo}_mapa.html")
+
+    conteo = etiquetas['tipo_alerta'].value_counts()
+    return {
+        'sabana_1': sabana_1['sabana'],
+        'sabana_2': sabana_2['sabana'],
+        'numeros_comunes': len(comunes),
+        'crucial': int(conteo.get('CRUCIAL', 0)),
+        'alerta': int(conteo.get('ALERTA', 0)),
+    }
+
+def procesar_directorio(dir_entrada, dir_salida, procesos=None, tolerancia_m=0, cruces=True, avisar=print):
+    rutas = sorted(
+        os.path.join(dir_entrada, n) for n in os.listdir(dir_entrada)
+        if n.lower().endswith(EXTENSIONES_SABANA) and not n.startswith('~$')
+    )
+    os.makedirs(dir_salida, exist_ok=True)
+    resumen = {'sabanas': [], 'cruces': [], 'errores': []}
+
+    with ProcessPoolExecutor(max_workers=procesos, initializer=configurar_cache, initargs=(DIR_CACHE_SABANAS,)) as pool:
+        tareas = {pool.submit(procesar_sabana, ruta, dir_salida): ruta for ruta in rutas}
+        for tarea in as_completed(tareas):
+            ruta = tareas[tarea]
+            try:
+                resumen['sabanas'].append(tarea.result())
+                avisar(f"✔ {os.path.basename(ruta)}")
+            except Exception as e:
+                resumen['errores'].append({'archivo': os.path.basename(ruta), 'error': str(e)})
+                avisar(f"✖ {os.path.basename(ruta)}: {e}")
+
+        if cruces:
+            sabanas = sorted(resumen['sabanas'], key=lambda s: s['sabana'])
+            tareas = {
+                pool.submit(procesar_cruce, a, b, dir_salida, tolerancia_m): (a['sabana'], b['sabana'])
+                for a, b in combinations(sabanas, 2)
+            }
+            for tarea in as_completed(tareas):
+                par = tareas[tarea]
+                try:
+                    resumen['cruces'].append(tarea.result())
+                    avisar(f"✔ cruce {par[0]} × {par[1]}")
+                except Exception as e:
+                    resumen['errores'].append({'archivo': f"{par[0]} × {par[1]}", 'error': str(e)})
+                    avisar(f"✖ cruce {par[0]} × {par[1]}: {e}")
+
+            if len(sabanas) > 1:
+                # Matrices N-vías: solo se retienen los conjuntos de claves de cada sábana, no los datos
+                interlocutores, colocaciones = {}, {}
+                for sabana in sabanas:
+                    df = leer_expediente(sabana['huella'], COLUMNAS_MULTICRUCE)
+                    interlocutores[sabana['sabana']] = conjunto_interlocutores(df)
+                    colocaciones[sabana['sabana']] = conjunto_colocaciones(df)
+                    del df
+                multicruce = matrices_multicruce(interlocutores, colocaciones, procesos)
+                multicruce['matriz_interlocutores'].to_csv(os.path.join(dir_salida, 'matriz_interlocutores.csv'))
+                multicruce['matriz_colocaciones'].to_csv(os.path.join(dir_salida, 'matriz_colocaciones.csv'))
+                multicruce['pares'].to_csv(os.path.join(dir_salida, 'matriz_pares.csv'), index=False)
+
+    resumen['sabanas'].sort(key=lambda s: s['sabana'])
+    resumen['cruces'].sort(key=lambda c: (c['sabana_1'], c['sabana_2']))
+    with open(os.path.join(dir_salida, 'resumen.json'), 'w', encoding='utf-8') as f:
+        json.dump(resumen, f, ensure_ascii=False, indent=2)
+    return resumen
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Procesa un directorio de sábanas sin interfaz: contactos, antenas, mapas, cruces por pares y matrices N-vías."
+    )
+    parser.add_argument("entrada", help="Directorio con sábanas .xlsx/.xls/.csv")
+    parser.add_argument("salida", help="Directorio donde se escriben resultados y mapas")
+    parser.add_argument("--procesos", type=int, default=None, help="Procesos en paralelo (por defecto, todos los núcleos)")
+    parser.add_argument("--tolerancia", type=float, default=0, help="Tolerancia en metros para el cruce de ubicaciones")
+    parser.add_argument("--sin-cruces", action="store_true", help="No calcular cruces entre pares de sábanas")
+    parser.add_argument("--cache", default=None, help="Directorio de caché Parquet (por defecto SABANAS_CACHE_DIR)")
+    args = parser.parse_args(argv)
+
+    if args.cache:
+        configurar_cache(args.cache)
+    resumen = procesar_directorio(
+        args.entrada, args.salida,
+        procesos=args.procesos, tolerancia_m=args.tolerancia, cruces=not args.sin_cruces
+    )
+    print(f"{len(resumen['sabanas'])} sábanas, {len(resumen['cruces'])} cruces, {len(resumen['errores'])} errores → {args.salida}")
+    return 1 if resumen['errores'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+import json
+import re
+
+import pandas as pd
+
+from motor_sabanas import construir_grafo, centralidad, comunidades, subgrafo_visible, html_red
+
+MALICIOSO = "</script><script>alert(1)</script>"
+
+
+def test_html_red_no_cierra_el_script_con_valores_de_la_sabana():
+    df = pd.DataFrame({
+        'linea a': ['5512345678', '5512345678', MALICIOSO],
+        'linea b': [MALICIOSO, '5598765432', '5598765432'],
+        'fecha': ['2024-01-01', '2024-01-02', '2024-01-03'],
+    })
+    grafo = construir_grafo(df)
+    rango = centralidad(grafo)
+    nodos, aristas = subgrafo_visible(grafo, rango, comunidades(grafo))
+    salida = html_red(nodos, aristas)
+
+    assert MALICIOSO in set(nodos['numero'])
+    # Solo las dos etiquetas <script> de la plantilla; el valor no abre ni cierra ninguna
+    assert salida.count("<script") == 2
+    assert salida.count("</script>") == 2
+
+    # El valor llega intacto a vis-network
+    literal = re.search(r"nodes: new vis\.DataSet\((.*)\),\n", salida).group(1)
+    assert MALICIOSO in {n['label'] for n in json.loads(literal)}